@@ -0,0 +1,486 @@
+"""性能测试：合成LHM数据 + 本地HTTP服务 + 本地MQTT桩，测量各阶段耗时
+
+用法示例：
+    python bench.py --hosts 40 --duration 30 --cores 16 --gpus 2 --drives 8
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import statistics
+import struct
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+import main
+
+# SENSOR_RULES 里使用的网卡
+MAIN_NIC = "%7B3946F6E6-AFE8-4E7E-8839-2719C6CFA81C%7D"
+
+# 压测不读写部署目录中的自动发现缓存和累计量文件，每次运行的结果可以重复
+NO_STATE_SETTINGS = {"discovery_cache_file": "", "totals_dir": ""}
+
+
+# ==================== 合成数据 ====================
+class _Sensor:
+    __slots__ = ("sensor_id", "text", "sensor_type", "unit", "low", "high")
+
+    def __init__(self, sensor_id, text, sensor_type, unit, low, high):
+        self.sensor_id = sensor_id
+        self.text = text
+        self.sensor_type = sensor_type
+        self.unit = unit
+        self.low = low
+        self.high = high
+
+
+def _group(text: str, children: list) -> dict:
+    return {"id": 0, "Text": text, "Min": "", "Value": "", "Max": "", "ImageURL": "", "Children": children}
+
+
+def _hardware(text: str, hardware_id: str, groups: Dict[str, List[_Sensor]], depth: int) -> dict:
+    node = _group(text, [_group(name, sensors) for name, sensors in groups.items() if sensors])
+    node["HardwareId"] = hardware_id
+    # 额外的嵌套层级（类似主板下的SuperIO芯片）
+    for level in range(depth):
+        node = _group(f"{text} #{level}", [node])
+    return node
+
+
+def generate_lhm_tree(cpus: int = 1, cores: int = 8, gpus: int = 1, nics: int = 2,
+                      drives: int = 2, fans: int = 4, depth: int = 0, seed: int = 0):
+    """生成LHM data.json结构，返回 (树, 传感器列表)；树中的叶子是 _Sensor，需要经 render 填充数值"""
+    rng = random.Random(seed)
+    hardware = []
+
+    mb = "/lpc/nct6687d/0"
+    hardware.append(_hardware("Motherboard", mb, {
+        "Temperatures": [_Sensor(f"{mb}/temperature/{i}", f"Temp #{i}", "Temperature", "°C", 25, 60) for i in range(6)],
+        "Fans": [_Sensor(f"{mb}/fan/{i}", f"Fan #{i}", "Fan", "RPM", 500, 2000) for i in range(fans)],
+        "Voltages": [_Sensor(f"{mb}/voltage/{i}", f"Voltage #{i}", "Voltage", "V", 0.8, 12.2) for i in range(8)],
+    }, depth))
+
+    for c in range(cpus):
+        cpu = f"/amdcpu/{c}"
+        hardware.append(_hardware(f"AMD Ryzen #{c}", cpu, {
+            "Clocks": [_Sensor(f"{cpu}/clock/{i}", f"Core #{i}", "Clock", "MHz", 3000, 5200) for i in range(cores + 1)],
+            "Temperatures": [_Sensor(f"{cpu}/temperature/{i}", f"Tctl #{i}", "Temperature", "°C", 35, 90) for i in range(4)],
+            "Load": [_Sensor(f"{cpu}/load/{i}", f"Core #{i}", "Load", "%", 0, 100) for i in range(cores + 1)],
+            "Powers": [_Sensor(f"{cpu}/power/{i}", f"Power #{i}", "Power", "W", 10, 170) for i in range(cores + 1)],
+        }, depth))
+
+    hardware.append(_hardware("Memory", "/ram", {
+        "Load": [_Sensor("/ram/load/0", "Memory", "Load", "%", 20, 90)],
+        "Data": [_Sensor("/ram/data/0", "Used", "Data", "GB", 4, 28), _Sensor("/ram/data/1", "Available", "Data", "GB", 4, 28)],
+    }, depth))
+
+    for g in range(gpus):
+        gpu = f"/gpu-amd/{g}"
+        hardware.append(_hardware(f"Radeon #{g}", gpu, {
+            "Temperatures": [_Sensor(f"{gpu}/temperature/{i}", f"GPU Temp #{i}", "Temperature", "°C", 35, 95) for i in range(3)],
+            "Load": [_Sensor(f"{gpu}/load/{i}", f"GPU Load #{i}", "Load", "%", 0, 100) for i in range(4)],
+            "Powers": [_Sensor(f"{gpu}/power/{i}", f"GPU Power #{i}", "Power", "W", 10, 300) for i in range(4)],
+            "Data": [_Sensor(f"{gpu}/smalldata/{i}", f"VRAM #{i}", "SmallData", "MB", 500, 16000) for i in range(2)],
+        }, depth))
+
+    for n in range(nics):
+        guid = MAIN_NIC if n == 0 else f"%7B{rng.getrandbits(128):032X}%7D"
+        nic = f"/nic/{guid}"
+        hardware.append(_hardware(f"Ethernet #{n}", nic, {
+            "Data": [_Sensor(f"{nic}/data/{i}", f"Data #{i}", "Data", "GB", 0, 1000) for i in range(2)],
+            "Load": [_Sensor(f"{nic}/load/1", "Utilization", "Load", "%", 0, 100)],
+            "Throughput": [_Sensor(f"{nic}/throughput/{i}", f"Speed #{i}", "Throughput", "MB/s", 0, 100) for i in (7, 8)],
+        }, depth))
+
+    for d in range(drives):
+        drive = f"/nvme/{d}"
+        hardware.append(_hardware(f"NVMe #{d}", drive, {
+            "Temperatures": [_Sensor(f"{drive}/temperature/{i}", f"Temp #{i}", "Temperature", "°C", 30, 70) for i in range(2)],
+            "Load": [_Sensor(f"{drive}/load/{i}", f"Activity #{i}", "Load", "%", 0, 100) for i in range(3)],
+            "Data": [_Sensor(f"{drive}/data/{i}", f"Data #{i}", "Data", "GB", 0, 10000) for i in range(2)],
+            "Throughput": [_Sensor(f"{drive}/throughput/{i}", f"Rate #{i}", "Throughput", "MB/s", 0, 3000) for i in range(2)],
+        }, depth))
+
+    tree = _group("Sensor", [_group("BENCH-PC", hardware)])
+    sensors = []
+
+    def _collect(node):
+        for child in node["Children"]:
+            if isinstance(child, _Sensor):
+                sensors.append(child)
+            else:
+                _collect(child)
+    _collect(tree)
+    return tree, sensors
+
+
+def render(tree: dict, rng: random.Random) -> bytes:
+    """为树中的每个传感器随机生成数值并序列化"""
+    counter = [0]
+
+    def _render(node):
+        if isinstance(node, _Sensor):
+            counter[0] += 1
+            value = rng.uniform(node.low, node.high)
+            return {
+                "id": counter[0], "Text": node.text,
+                "Min": f"{node.low:.1f} {node.unit}", "Value": f"{value:.1f} {node.unit}",
+                "Max": f"{node.high:.1f} {node.unit}", "SensorId": node.sensor_id,
+                "Type": node.sensor_type, "ImageURL": "images/transparent.png", "Children": [],
+            }
+        counter[0] += 1
+        return {**node, "id": counter[0], "Children": [_render(child) for child in node["Children"]]}
+
+    return json.dumps(_render(tree)).encode()
+
+
+# ==================== 本地LHM服务 ====================
+class LHMServer:
+    """本地aiohttp服务，轮流返回预先生成的若干份数据"""
+    def __init__(self, payloads: List[bytes], host: str = "127.0.0.1", port: int = 0):
+        self.payloads = payloads
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/data.json", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/data.json"
+
+    async def _handle(self, request):
+        payload = self.payloads[self.requests % len(self.payloads)]
+        self.requests += 1
+        return web.Response(body=payload, content_type="application/json")
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# ==================== 本地MQTT桩 ====================
+class StubBroker:
+    """进程内的最小MQTT broker，只应答CONNECT/PUBLISH/SUBSCRIBE/PINGREQ并统计收到的消息
+
+    MQTT v5连接时在CONNACK中声明topic_alias_maximum，并按主题别名还原主题。
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, topic_alias_maximum: int = 16):
+        self.host = host
+        self.port = port
+        self.topic_alias_maximum = topic_alias_maximum
+        self.messages = 0
+        self.bytes = 0
+        self.topics: Dict[str, int] = {}
+        self.topic_bytes: Dict[str, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    async def _read_packet(reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header[0], await reader.readexactly(length)
+
+    @staticmethod
+    def _read_varint(body: bytes, pos: int):
+        value, shift = 0, 0
+        while True:
+            byte = body[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+
+    @classmethod
+    def _skip_properties(cls, body: bytes, pos: int) -> int:
+        length, pos = cls._read_varint(body, pos)
+        return pos + length
+
+    @classmethod
+    def _topic_alias(cls, body: bytes, pos: int) -> Optional[int]:
+        """从PUBLISH属性中取出主题别名（0x23）"""
+        length, pos = cls._read_varint(body, pos)
+        end = pos + length
+        while pos < end:
+            prop_id, pos = cls._read_varint(body, pos)
+            if prop_id == 0x23:
+                return struct.unpack_from("!H", body, pos)[0]
+            if prop_id in (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A):
+                pos += 1
+            elif prop_id in (0x13, 0x21, 0x22):
+                pos += 2
+            elif prop_id in (0x02, 0x11, 0x18, 0x27):
+                pos += 4
+            elif prop_id == 0x0B:
+                _, pos = cls._read_varint(body, pos)
+            elif prop_id == 0x26:
+                for _ in range(2):
+                    pos += 2 + struct.unpack_from("!H", body, pos)[0]
+            else:  # 字符串/二进制
+                pos += 2 + struct.unpack_from("!H", body, pos)[0]
+        return None
+
+    async def _handle(self, reader, writer):
+        version = 4
+        aliases: Dict[int, str] = {}
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    name_len = struct.unpack_from("!H", body)[0]
+                    version = body[2 + name_len]
+                    if version == 5:
+                        # 属性：Topic Alias Maximum
+                        writer.write(b"\x20\x06\x00\x00\x03\x22" + struct.pack("!H", self.topic_alias_maximum))
+                    else:
+                        writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_len = struct.unpack_from("!H", body)[0]
+                    topic = body[2:2 + topic_len].decode()
+                    pos = 2 + topic_len
+                    if qos:
+                        writer.write(b"\x40\x02" + body[pos:pos + 2])
+                        pos += 2
+                    if version == 5:
+                        alias = self._topic_alias(body, pos)
+                        if alias is not None:
+                            if topic:
+                                aliases[alias] = topic
+                            else:
+                                topic = aliases[alias]
+                    self.messages += 1
+                    self.bytes += len(body) + 2
+                    self.topics[topic] = self.topics.get(topic, 0) + 1
+                    self.topic_bytes[topic] = self.topic_bytes.get(topic, 0) + len(body) + 2
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id = body[:2]
+                    pos = self._skip_properties(body, 2) if version == 5 else 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        topic_len = struct.unpack_from("!H", body, pos)[0]
+                        pos += 2 + topic_len
+                        granted.append(min(body[pos] & 0x03, 1))
+                        pos += 1
+                    props = b"\x00" if version == 5 else b""
+                    payload = packet_id + props + bytes(granted)
+                    writer.write(bytes([0x90, len(payload)]) + payload)
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# ==================== 统计 ====================
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p90/p99/max（毫秒）"""
+    if not samples:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    if len(samples) == 1:
+        q = [samples[0]] * 99
+    else:
+        q = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": q[49] * 1000, "p90": q[89] * 1000, "p99": q[98] * 1000, "max": max(samples) * 1000}
+
+
+def _print_table(title: str, rows: Dict[str, List[float]]):
+    print(f"\n{title}")
+    print(f"{'阶段':<18}{'次数':>8}{'p50(ms)':>11}{'p90(ms)':>11}{'p99(ms)':>11}{'max(ms)':>11}")
+    for name, samples in rows.items():
+        p = percentiles(samples)
+        print(f"{name:<18}{len(samples):>8}{p['p50']:>11.3f}{p['p90']:>11.3f}{p['p99']:>11.3f}{p['max']:>11.3f}")
+
+
+def _timeit(fn, repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+# ==================== 测试流程 ====================
+def bench_stages(raw: bytes, connection: main.MQTTConnection, repeat: int) -> Dict[str, List[float]]:
+    """单独测量解析和发布各阶段"""
+    config = main.MQTTConfig("bench")
+    main.apply_mqtt_settings(config, NO_STATE_SETTINGS)
+    monitor = main.HardwareMonitor("bench", name="bench", mqtt=main.AsyncMQTTPublisher(config, connection))
+    data = json.loads(raw)
+    rows = {"json.loads": _timeit(lambda: json.loads(raw), repeat)}
+
+    def full_walk():
+        monitor._sensor_paths = None
+        monitor._parse_data(data)
+    rows["parse (完整遍历)"] = _timeit(full_walk, repeat)
+    rows["parse (路径缓存)"] = _timeit(lambda: monitor._parse_data(data), repeat)
+
+    def streaming():
+        parser = main.StreamingSensorParser(monitor._dispatch)
+        for i in range(0, len(raw), 16384):
+            if parser.feed(raw[i:i + 16384]):
+                break
+        monitor._apply_matches(parser.matches)
+    rows["streaming parse"] = _timeit(streaming, repeat)
+    rows["_extract_value"] = _timeit(lambda: monitor._extract_value("45.2 °C"), repeat)
+    rows["_publish_all_data"] = _timeit(monitor._publish_all_data, repeat)
+    return rows
+
+
+async def bench_fleet(url: str, connection: main.MQTTConnection, broker: StubBroker,
+                      hosts: int, interval: float, duration: float,
+                      compact: str = "", encoding: str = "msgpack",
+                      replay: Optional[list] = None, speed: float = 1.0, **options):
+    """完整轮询：多主机并发抓取、解析、发布（replay 为录制数据时各主机回放录制的响应，不发HTTP请求）"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fleet = main.FleetMonitor({f"bench{i}": url for i in range(hosts)}, interval=interval,
+                              max_concurrency=min(hosts, 32), connection=connection,
+                              mqtt_settings=NO_STATE_SETTINGS, rollup_fields=(), **options)
+    for monitor in fleet.monitors.values():
+        monitor.mqtt.config.compact = compact
+        monitor.mqtt.config.compact_encoding = encoding
+        if replay:
+            monitor.replay = main.ReplaySource(replay, speed, loop=True)
+
+    stages: Dict[str, List[float]] = {"total": [], "fetch": [], "decode": [], "parse": [], "publish": []}
+    for monitor in fleet.monitors.values():
+        def _wrap(m=monitor, update=monitor._update):
+            async def timed_update():
+                t0 = time.perf_counter()
+                await update()
+                stages["total"].append(time.perf_counter() - t0)
+                t = m.last_timings
+                stages["fetch"].append(t.connect + t.first_byte + t.body)
+                stages["decode"].append(t.decode)
+                stages["parse"].append(t.parse)
+                stages["publish"].append(t.publish)
+            return timed_update
+        monitor._update = _wrap()
+
+    messages_before = broker.messages
+    task = asyncio.create_task(fleet.start())
+    await asyncio.sleep(duration)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    for monitor in fleet.monitors.values():
+        monitor.stop()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    memory = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return stages, broker.messages - messages_before, memory
+
+
+async def run(args):
+    records = None
+    if args.replay:
+        records = list(main.CaptureLog.read(args.replay))
+        payloads = [raw for _, raw in records]
+        print(f"录制数据: {len(records)} 条, 平均 {sum(map(len, payloads)) / len(payloads) / 1024:.1f} KB")
+    else:
+        tree, sensors = generate_lhm_tree(args.cpus, args.cores, args.gpus, args.nics, args.drives,
+                                          args.fans, args.depth, args.seed)
+        rng = random.Random(args.seed)
+        payloads = [render(tree, rng) for _ in range(8)]
+        print(f"合成数据: {len(sensors)} 个传感器, {len(payloads[0]) / 1024:.1f} KB")
+
+    server = LHMServer(payloads)
+    broker = StubBroker()
+    await server.start()
+    await broker.start()
+
+    config = main.MQTTConfig()
+    main.apply_mqtt_settings(config, NO_STATE_SETTINGS)
+    config.broker = broker.host
+    config.port = broker.port
+    if args.mqtt5:
+        config.protocol = main.mqtt.MQTTv5
+    connection = main.MQTTConnection(config)
+    connection.start()
+    await asyncio.sleep(0.2)
+
+    _print_table("各阶段耗时", bench_stages(payloads[0], connection, args.repeat))
+
+    stages, messages, memory = await bench_fleet(
+        server.url, connection, broker, args.hosts, args.interval, args.duration,
+        compact=args.compact, encoding=args.encoding, replay=records, speed=args.speed,
+        streaming=args.streaming)
+    ticks = len(stages["total"])
+    _print_table(f"完整轮询（{args.hosts} 台主机，间隔 {args.interval}s，{args.duration}s）", stages)
+    print(f"\n每秒轮询次数: {ticks / args.duration:.1f}")
+    print(f"broker收到消息: {messages} 条, {broker.bytes / 1024:.1f} KB")
+    state_topics = [t for t in broker.topics if t.endswith(("/state", f"/{config.compact_topic}"))]
+    state_messages = sum(broker.topics[t] for t in state_topics)
+    if state_messages:
+        state_bytes = sum(broker.topic_bytes[t] for t in state_topics)
+        print(f"每条state消息: {state_bytes / state_messages:.0f} 字节（含MQTT报文头）")
+    print(f"每台主机内存: {memory / args.hosts / 1024:.1f} KB（tracemalloc增量）")
+    print(f"进程峰值RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"MQTT发送队列: {connection.stats()}")
+
+    await connection.stop()
+    await broker.stop()
+    await server.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="pc_monitor 性能测试")
+    parser.add_argument("--hosts", type=int, default=10, help="模拟的主机数量")
+    parser.add_argument("--interval", type=float, default=2, help="轮询间隔（秒）")
+    parser.add_argument("--duration", type=float, default=10, help="完整轮询测试时长（秒）")
+    parser.add_argument("--repeat", type=int, default=200, help="单阶段测试的重复次数")
+    parser.add_argument("--cpus", type=int, default=1)
+    parser.add_argument("--cores", type=int, default=8)
+    parser.add_argument("--gpus", type=int, default=1)
+    parser.add_argument("--nics", type=int, default=2)
+    parser.add_argument("--drives", type=int, default=2)
+    parser.add_argument("--fans", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=0, help="每个硬件额外的嵌套层数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--streaming", action="store_true", help="完整轮询使用流式解析")
+    parser.add_argument("--mqtt5", action="store_true", help="使用MQTT v5（state主题使用主题别名）")
+    parser.add_argument("--compact", choices=("", *main.COMPACT_LAYOUTS), default="", help="紧凑state格式")
+    parser.add_argument("--encoding", choices=main.COMPACT_ENCODINGS, default="msgpack", help="紧凑格式的编码")
+    parser.add_argument("--replay", default="", help="用录制文件（CAPTURE_DIR下的 .capture.gz）代替合成数据")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0表示尽快回放")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
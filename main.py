@@ -1,12 +1,53 @@
 import aiohttp
 import asyncio
+import bisect
+import contextlib
+import fnmatch
+import gzip
+import hashlib
 import json
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import signal
+import struct
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Sequence, Callable, NamedTuple, Union, Iterator, Tuple
 from datetime import datetime
+from urllib.parse import quote
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from aiohttp import web
+try:
+    import orjson  # 可选：更快的JSON编解码
+except ImportError:
+    orjson = None
+try:
+    import msgpack  # 可选：紧凑模式的MessagePack编码
+except ImportError:
+    msgpack = None
+try:
+    import cbor2  # 可选：紧凑模式的CBOR编码
+except ImportError:
+    cbor2 = None
+try:
+    import tomllib  # 配置文件（Python 3.11+）
+except ImportError:
+    tomllib = None
+try:
+    import yaml  # 可选：YAML格式的配置文件
+except ImportError:
+    yaml = None
 import socket
 import logging
+import time
 
 # 配置日志记录
 logging.basicConfig(
@@ -22,7 +63,7 @@ logger = logging.getLogger(__name__)
 
 # ==================== MQTT 配置 ====================
 class MQTTConfig:
-    def __init__(self):
+    def __init__(self, name: Optional[str] = None):
         self.broker = ""
         self.port = 1883
         self.username = ""
@@ -31,575 +72,2694 @@ class MQTTConfig:
         self.client_id = f"pc_monitor_{socket.gethostname()}"
         self.qos = 1
         self.retain = True
+        self.protocol = mqtt.MQTTv311  # 改为 mqtt.MQTTv5 后state主题使用主题别名（topic alias）
+
+        # 紧凑模式（按流量计费的链路）：为空时发布HA可直接使用的JSON到 <base_topic>state；
+        # 设为 "short"（短键）或 "positional"（按位置的数组）时改为发布到 <base_topic><compact_topic>，
+        # 字段表以retained消息发布到 <base_topic>schema。编码可选 json / msgpack / cbor
+        self.compact = ""
+        self.compact_encoding = "msgpack"
+        self.compact_topic = "c"
+        self.compact_qos = 0  # 每条都会被下一条取代；QoS 0 时主题别名可以省去整个主题
+
+        # 断线缓存：目录为空表示不启用；重连后每秒补发的消息数
+        self.spool_dir = ""
+        self.spool_segment_size = 4 * 1024 * 1024
+        self.spool_max_bytes = 256 * 1024 * 1024
+        self.replay_rate = 50
+
+        # HA上线通知主题（收到 online 时重新发布自动发现配置）及自动发现缓存文件
+        self.ha_status_topic = "homeassistant/status"
+        self.discovery_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery_cache.json")
+        self.totals_dir = os.path.dirname(os.path.abspath(__file__))  # 累计量文件所在目录，为空表示不保存
+
+        # 多主机模式下每台主机使用独立的命名空间
+        if name:
+            self.base_topic = f"homeassistant/sensor/pc_monitor_{name}/"
+            self.client_id = f"pc_monitor_{name}"
+
+        # 可用性主题（retained online/offline）：主机级由轮询结果决定，连接级作为遗嘱消息
+        self.availability_topic = f"{self.base_topic}availability"
+        self.will_topic = f"{self.base_topic}connection"
+
+    @property
+    def totals_file(self) -> str:
+        """本主机累计量的保存文件"""
+        return os.path.join(self.totals_dir, f"{self.client_id}_totals.json") if self.totals_dir else ""
 
 
 # ==================== 数据结构 ====================
 @dataclass
-class MotherboardStats:
-    temp_current: Optional[float] = None
-    temp_peak: Optional[float] = None
+class PollTimings:
+    """单次请求各阶段耗时（秒）"""
+    connect: float = 0.0      # 建立连接（复用连接时为0）
+    first_byte: float = 0.0   # 发出请求到收到响应头
+    body: float = 0.0         # 读取响应体
+    decode: float = 0.0       # JSON解析
+    parse: float = 0.0        # 提取传感器数据
+    publish: float = 0.0      # 组装并发布消息
+
+
+# ==================== 传感器定义 ====================
+@dataclass(frozen=True)
+class SensorSpec:
+    """一个HA传感器：同时决定自动发现配置、state中的字段以及离线时的处理"""
+    object_id: str                        # 自动发现主题中的名称
+    name: str
+    field: str                            # state消息中的字段名
+    source: Optional[tuple] = None        # (数据结构属性, 字段)，为None时由其它环节写入
+    unit: Optional[str] = None
+    device_class: Optional[str] = None
+    icon: Optional[str] = None
+    state_class: Optional[str] = None     # 累计量为 total_increasing，供HA长期统计使用
+
+    def discovery_config(self, config: MQTTConfig, availability_topics: Sequence[str] = (),
+                         state_topic: str = "state") -> Dict[str, Any]:
+        """生成HA的MQTT自动发现配置（所有可用性主题都为online时传感器才可用）"""
+        result: Dict[str, Any] = {"name": self.name}
+        if self.unit:
+            result["unit_of_meas"] = self.unit
+        if self.device_class:
+            result["device_class"] = self.device_class
+        if self.icon:
+            result["icon"] = self.icon
+        if self.state_class:
+            result["state_class"] = self.state_class
+        result["state_topic"] = f"{config.base_topic}{state_topic}"
+        result["value_template"] = f"{{{{ value_json.{self.field} }}}}"
+        result["unique_id"] = f"{config.client_id}_{self.field}"
+        if availability_topics:
+            result["availability"] = [{"topic": topic} for topic in availability_topics]
+            result["availability_mode"] = "all"
+        return result
+
+
+def _spec(object_id: str, name: str, source: Optional[tuple], unit: Optional[str] = None,
+          device_class: Optional[str] = None, icon: Optional[str] = None) -> SensorSpec:
+    return SensorSpec(object_id, name, object_id, source, unit, device_class, icon)
+
+
+SENSOR_SCHEMA: List[SensorSpec] = [
+    # 主板传感器
+    _spec("mb_temp", "主板温度", ("motherboard", "temp_current"), "°C", "temperature"),
+    _spec("mb_temp_peak", "主板温度峰值", ("motherboard", "temp_peak"), "°C", "temperature"),
+
+    # CPU传感器
+    _spec("cpu_temp", "CPU温度", ("cpu", "temp_current"), "°C", "temperature"),
+    _spec("cpu_temp_peak", "CPU温度峰值", ("cpu", "temp_peak"), "°C", "temperature"),
+    _spec("cpu_power", "CPU功耗", ("cpu", "power_current"), "W", "power"),
+    _spec("cpu_power_peak", "CPU功耗峰值", ("cpu", "power_peak"), "W", "power"),
+    _spec("cpu_usage", "CPU使用率", ("cpu", "usage_current"), "%", "power_factor"),
+    _spec("cpu_usage_peak", "CPU使用率峰值", ("cpu", "usage_peak"), "%", "power_factor"),
+    _spec("cpu_freq", "CPU频率", ("cpu", "frequency"), "GHz", icon="mdi:speedometer"),
+    _spec("cpu_freq_peak", "CPU频率峰值", ("cpu", "peak_frequency"), "GHz", icon="mdi:speedometer"),
+
+    # 内存传感器
+    _spec("mem_usage", "内存使用率", ("memory", "usage"), "%", icon="mdi:memory"),
+    _spec("mem_used", "已用内存", ("memory", "used"), "GB", icon="mdi:memory"),
+    _spec("mem_available", "可用内存", ("memory", "available"), "GB", icon="mdi:memory"),
+
+    # 显卡传感器
+    _spec("gpu_temp", "显卡温度", ("gpu", "temp_current"), "°C", "temperature"),
+    _spec("gpu_temp_peak", "显卡温度峰值", ("gpu", "temp_peak"), "°C", "temperature"),
+    _spec("gpu_power", "显卡功耗", ("gpu", "power_current"), "W", "power"),
+    _spec("gpu_power_peak", "显卡功耗峰值", ("gpu", "power_peak"), "W", "power"),
+    _spec("gpu_usage", "显卡使用率", ("gpu", "usage_current"), "%", icon="mdi:gpu"),
+    _spec("gpu_usage_peak", "显卡使用率峰值", ("gpu", "usage_peak"), "%", icon="mdi:gpu"),
+    _spec("gpu_vram_used", "显存使用量", ("gpu", "vram_used"), "GB", icon="mdi:memory"),
+    _spec("gpu_vram_available", "可用显存", ("gpu", "vram_available"), "GB", icon="mdi:memory"),
+    _spec("gpu_vram_usage", "显存使用率", ("gpu", "vram_usage"), "%", icon="mdi:memory"),
+
+    # 网络传感器
+    _spec("net_upload", "上传速度", ("network", "upload_speed"), "MB/s", icon="mdi:upload-network"),
+    _spec("net_download", "下载速度", ("network", "download_speed"), "MB/s", icon="mdi:download-network"),
+
+    # 累计量（由功率和网速积分得到，见 INTEGRALS）
+    SensorSpec("cpu_energy", "CPU耗电量", "cpu_energy", ("derived", "cpu_energy"), "kWh", "energy",
+               state_class="total_increasing"),
+    SensorSpec("gpu_energy", "显卡耗电量", "gpu_energy", ("derived", "gpu_energy"), "kWh", "energy",
+               state_class="total_increasing"),
+    SensorSpec("net_uploaded", "累计上传", "net_uploaded", ("derived", "net_uploaded"), "GB", "data_size",
+               state_class="total_increasing"),
+    SensorSpec("net_downloaded", "累计下载", "net_downloaded", ("derived", "net_downloaded"), "GB", "data_size",
+               state_class="total_increasing"),
+
+    # 系统状态
+    SensorSpec("monitor_status", "监控状态", "status", icon="mdi:heart-pulse"),
+]
+
+
+# ==================== 状态存储 ====================
+NAN = float("nan")
+
+
+class StateLayout:
+    """传感器数值在状态数组中的下标：按传感器定义的顺序，每个有source的字段占一格
+
+    内置传感器总是排在最前面，下标对所有主机都相同；自动发现的传感器追加在后面。
+    """
+    def __init__(self, specs: Sequence[SensorSpec]):
+        sourced = [spec for spec in specs if spec.source]
+        self.fields: List[str] = [spec.field for spec in sourced]
+        self.index: Dict[str, int] = {field_name: i for i, field_name in enumerate(self.fields)}
+        self.slots: Dict[tuple, int] = {spec.source: i for i, spec in enumerate(sourced)}
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+
+STATE_LAYOUT = StateLayout(SENSOR_SCHEMA)
+
+
+class SensorState:
+    """一台主机的全部传感器数值：预分配的float数组，缺失值为NaN
+
+    每轮轮询原地更新，不再为每个字段创建对象；sums/counts供通配规则求平均使用。
+    """
+    __slots__ = ("layout", "values", "sums", "counts")
+
+    def __init__(self, layout: StateLayout, previous: Optional["SensorState"] = None):
+        self.layout = layout
+        self.values = array("d", [NAN]) * len(layout)
+        self.sums = array("d", [0.0]) * len(layout)
+        self.counts = array("d", [0.0]) * len(layout)
+        if previous is not None:
+            # 布局变化（自动发现）时保留同名字段的数值
+            for field_name, value in zip(previous.layout.fields, previous.values):
+                i = layout.index.get(field_name)
+                if i is not None:
+                    self.values[i] = value
+
+    def get(self, field_name: str) -> Optional[float]:
+        """按字段名读取，缺失时返回None"""
+        i = self.layout.index.get(field_name)
+        if i is None:
+            return None
+        value = self.values[i]
+        return None if value != value else value
 
 
-@dataclass
-class CPUStats:
-    temp_current: Optional[float] = None
-    temp_peak: Optional[float] = None
-    power_current: Optional[float] = None
-    power_peak: Optional[float] = None
-    usage_current: Optional[float] = None
-    usage_peak: Optional[float] = None
-    frequency: Optional[float] = None
-    peak_frequency: Optional[float] = None
-    _core_freqs: List[float] = field(default_factory=list)
-    _peak_core_freqs: List[float] = field(default_factory=list)
+def _slot(target: str, attr: str) -> property:
+    """视图属性：读写状态数组中 (target, attr) 对应的一格，NaN读出为None"""
+    index = STATE_LAYOUT.slots[(target, attr)]
 
+    def getter(self) -> Optional[float]:
+        value = self._values[index]
+        return None if value != value else value
 
-@dataclass
-class MemoryStats:
-    usage: Optional[float] = None
-    used: Optional[float] = None
-    available: Optional[float] = None
+    def setter(self, value: Optional[float]):
+        self._values[index] = NAN if value is None else value
 
+    return property(getter, setter)
 
-@dataclass
-class GPUStats:
-    temp_current: Optional[float] = None
-    temp_peak: Optional[float] = None
-    power_current: Optional[float] = None
-    power_peak: Optional[float] = None
-    usage_current: Optional[float] = None
-    usage_peak: Optional[float] = None
-    vram_used: Optional[float] = None
-    vram_available: Optional[float] = None
-    vram_usage: Optional[float] = None
 
+class StateView:
+    """状态数组上按硬件分组的视图，只保存数组引用，便于按属性名阅读和调试"""
+    __slots__ = ("_values",)
 
-@dataclass
-class NetworkStats:
-    upload_speed: Optional[float] = None
-    download_speed: Optional[float] = None
+    def __init__(self, values: array):
+        self._values = values
 
+    def __repr__(self) -> str:
+        attrs = [name for name in dir(type(self)) if isinstance(getattr(type(self), name), property)]
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in attrs)})"
 
-# ==================== MQTT 发布器 ====================
-class AsyncMQTTPublisher:
-    def __init__(self, config: MQTTConfig):
+
+class MotherboardStats(StateView):
+    __slots__ = ()
+    temp_current = _slot("motherboard", "temp_current")
+    temp_peak = _slot("motherboard", "temp_peak")
+
+
+class CPUStats(StateView):
+    __slots__ = ()
+    temp_current = _slot("cpu", "temp_current")
+    temp_peak = _slot("cpu", "temp_peak")
+    power_current = _slot("cpu", "power_current")
+    power_peak = _slot("cpu", "power_peak")
+    usage_current = _slot("cpu", "usage_current")
+    usage_peak = _slot("cpu", "usage_peak")
+    frequency = _slot("cpu", "frequency")
+    peak_frequency = _slot("cpu", "peak_frequency")
+
+
+class MemoryStats(StateView):
+    __slots__ = ()
+    usage = _slot("memory", "usage")
+    used = _slot("memory", "used")
+    available = _slot("memory", "available")
+
+
+class GPUStats(StateView):
+    __slots__ = ()
+    temp_current = _slot("gpu", "temp_current")
+    temp_peak = _slot("gpu", "temp_peak")
+    power_current = _slot("gpu", "power_current")
+    power_peak = _slot("gpu", "power_peak")
+    usage_current = _slot("gpu", "usage_current")
+    usage_peak = _slot("gpu", "usage_peak")
+    vram_used = _slot("gpu", "vram_used")
+    vram_available = _slot("gpu", "vram_available")
+    vram_usage = _slot("gpu", "vram_usage")
+
+
+class NetworkStats(StateView):
+    __slots__ = ()
+    upload_speed = _slot("network", "upload_speed")
+    download_speed = _slot("network", "download_speed")
+
+
+
+# ==================== 传感器映射 ====================
+@dataclass(frozen=True)
+class SensorRule:
+    """SensorId到数据字段的映射规则"""
+    target: str                       # 数据分组，如 "cpu"
+    value_attr: Optional[str] = None  # 写入Value的字段
+    max_attr: Optional[str] = None    # 写入Max的字段
+    scale: float = 1                  # 数值换算系数（如 MB -> GB）
+    collect: bool = False             # 通配规则：所有匹配传感器取平均值
+
+
+class SlotRule(NamedTuple):
+    """编译后的规则：直接写入状态数组的下标（-1表示不写入）"""
+    value_slot: int
+    max_slot: int
+    scale: float
+    collect: bool
+
+
+# 以 "/*" 结尾的为通配规则，匹配该路径下的所有传感器
+SENSOR_RULES: Dict[str, SensorRule] = {
+    # 主板温度
+    "/lpc/nct6687d/0/temperature/1": SensorRule("motherboard", "temp_current", "temp_peak"),
+
+    # CPU数据
+    "/amdcpu/0/temperature/2": SensorRule("cpu", "temp_current", "temp_peak"),
+    "/amdcpu/0/power/0": SensorRule("cpu", "power_current", "power_peak"),
+    "/amdcpu/0/load/0": SensorRule("cpu", "usage_current", "usage_peak"),
+    "/amdcpu/0/clock/*": SensorRule("cpu", "frequency", "peak_frequency", scale=1 / 1024, collect=True),
+
+    # 内存数据
+    "/ram/load/0": SensorRule("memory", "usage"),
+    "/ram/data/0": SensorRule("memory", "used"),
+    "/ram/data/1": SensorRule("memory", "available"),
+
+    # 显卡数据
+    "/gpu-amd/0/temperature/0": SensorRule("gpu", "temp_current", "temp_peak"),
+    "/gpu-amd/0/power/3": SensorRule("gpu", "power_current", "power_peak"),
+    "/gpu-amd/0/load/0": SensorRule("gpu", "usage_current", "usage_peak"),
+    "/gpu-amd/0/smalldata/0": SensorRule("gpu", "vram_used", scale=1 / 1024),
+    "/gpu-amd/0/smalldata/1": SensorRule("gpu", "vram_available", scale=1 / 1024),
+
+    # 网络数据
+    "/nic/%7B3946F6E6-AFE8-4E7E-8839-2719C6CFA81C%7D/throughput/7": SensorRule("network", "upload_speed"),
+    "/nic/%7B3946F6E6-AFE8-4E7E-8839-2719C6CFA81C%7D/throughput/8": SensorRule("network", "download_speed"),
+}
+
+# 不参与通配规则匹配的传感器（/amdcpu/0/clock/0 是总线频率而不是核心频率）
+SENSOR_EXCLUDES = {"/amdcpu/0/clock/0"}
+
+
+class SensorDispatch:
+    """把SENSOR_RULES编译成精确匹配字典 + 按父路径索引的通配规则，字段解析为状态数组下标"""
+    def __init__(self, rules: Dict[str, SensorRule], excludes=(), layout: StateLayout = STATE_LAYOUT):
+        self.exact: Dict[str, SlotRule] = {}
+        self.prefixes: Dict[str, SlotRule] = {}
+        collect_slots = set()
+        for pattern, rule in rules.items():
+            compiled = SlotRule(
+                layout.slots[(rule.target, rule.value_attr)] if rule.value_attr else -1,
+                layout.slots[(rule.target, rule.max_attr)] if rule.max_attr else -1,
+                rule.scale,
+                rule.collect,
+            )
+            if rule.collect:
+                collect_slots.update(slot for slot in compiled[:2] if slot >= 0)
+            if pattern.endswith("/*"):
+                self.prefixes[pattern[:-1]] = compiled
+            else:
+                self.exact[pattern] = compiled
+        self.excludes = frozenset(excludes)
+        self.collect_slots = tuple(sorted(collect_slots))
+
+    def match(self, sensor_id: str) -> Optional[SlotRule]:
+        """查找传感器对应的规则，没有则返回None"""
+        rule = self.exact.get(sensor_id)
+        if rule is not None or not self.prefixes or sensor_id in self.excludes:
+            return rule
+        return self.prefixes.get(sensor_id[:sensor_id.rfind("/") + 1])
+
+
+SENSOR_DISPATCH = SensorDispatch(SENSOR_RULES, SENSOR_EXCLUDES)
+
+
+# ==================== 完整解析 ====================
+def scan_tree(root: dict, dispatch: SensorDispatch):
+    """完整遍历传感器树，返回匹配到的节点、路径缓存以及访问的节点数
+
+    路径缓存为 (各节点的子节点数量, [(路径, SensorId)])，路径是子节点下标序列。
+    记录子节点数量的节点包括：匹配到的传感器的所有祖先，以及根和硬件列表这两层
+    （新增的硬件，比如首次轮询时还没有识别出的显卡，会改变硬件列表的长度）。
+    """
+    matches = []
+    paths = []
+    counts = {}
+    stack = [(root, ())]
+    visited = 0
+    while stack:
+        n, path = stack.pop()
+        visited += 1
+        sensor_id = n.get("SensorId")
+        if sensor_id:
+            rule = dispatch.match(sensor_id)
+            if rule is not None:
+                matches.append((rule, n))
+                paths.append((path, sensor_id))
+        children = n.get("Children") or ()
+        if len(path) <= 1:
+            counts[path] = len(children)
+        # 逆序入栈以保持和递归遍历相同的顺序
+        for i in range(len(children) - 1, -1, -1):
+            stack.append((children[i], path + (i,)))
+
+    # 匹配传感器的各级祖先的子节点数量，用于发现新增的传感器
+    for path, _ in paths:
+        parent = root
+        for depth, i in enumerate(path):
+            counts[path[:depth]] = len(parent["Children"])
+            parent = parent["Children"][i]
+    return matches, (sorted(counts.items()), paths), visited
+
+
+def resolve_cached_paths(root: dict, dispatch: SensorDispatch, sensor_paths):
+    """按缓存路径取节点，返回 (匹配的节点, 访问的节点数)；任一路径失效（结构变化）时返回None"""
+    counts, paths = sensor_paths
+    matches = []
+    visited = 0
+    try:
+        for path, count in counts:
+            visited += len(path) + 1
+            n = root
+            for i in path:
+                n = n["Children"][i]
+            if len(n.get("Children") or ()) != count:
+                return None
+        for path, sensor_id in paths:
+            visited += len(path)
+            n = root
+            for i in path:
+                n = n["Children"][i]
+            if n.get("SensorId") != sensor_id:
+                return None
+            matches.append((dispatch.match(sensor_id), n))
+    except (KeyError, IndexError, TypeError):
+        return None
+    return matches, visited
+
+
+# ==================== 流式解析 ====================
+# LHM的传感器都是没有子节点的叶子对象，匹配最内层的 {...}（跳过字符串里的括号）
+_LEAF_OBJECT_RE = re.compile(rb'\{(?:[^{}"]++|"[^"\\]*+(?:\\.[^"\\]*+)*+")*+\}')
+_SENSOR_ID_RE = re.compile(rb'"SensorId"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+
+class StreamingSensorParser:
+    """增量解析data.json，只提取规则中需要的传感器节点
+
+    不构建整棵树：逐块扫描叶子对象，只对命中规则的叶子做json解析。
+    精确规则全部取到、且每组通配传感器都已读完（同组传感器在LHM中是连续的）后结束。
+    """
+    def __init__(self, dispatch: SensorDispatch):
+        self.dispatch = dispatch
+        self.matches = []
+        self._buffer = b""
+        self._pending = set(dispatch.exact)       # 尚未取到的精确规则
+        self._open_groups = set(dispatch.prefixes)  # 尚未读完的通配分组
+        self._current_group = None
+        self.leaves = 0  # 扫描过的叶子数量
+
+    @property
+    def complete(self) -> bool:
+        return not self._pending and not self._open_groups
+
+    def feed(self, chunk: bytes) -> bool:
+        """输入一块数据，所需传感器已取齐时返回True"""
+        buffer = self._buffer + chunk if self._buffer else chunk
+        end = 0
+        for m in _LEAF_OBJECT_RE.finditer(buffer):
+            end = m.end()
+            self._handle_leaf(m.group())
+            if self.complete:
+                self._buffer = b""
+                return True
+        self._buffer = buffer[end:]
+        return False
+
+    def _handle_leaf(self, leaf: bytes):
+        self.leaves += 1
+        m = _SENSOR_ID_RE.search(leaf)
+        if m is None:
+            return
+        sensor_id = m.group(1).decode()
+
+        # 离开一个通配分组即视为该组已读完
+        group = sensor_id[:sensor_id.rfind("/") + 1]
+        if group != self._current_group:
+            self._open_groups.discard(self._current_group)
+            self._current_group = group
+
+        rule = self.dispatch.match(sensor_id)
+        if rule is None:
+            return
+        try:
+            node = json_loads(leaf)
+        except ValueError:
+            return
+        self._pending.discard(sensor_id)
+        self.matches.append((rule, node))
+
+
+# ==================== 自动发现传感器 ====================
+# 自动发现模式默认选取的传感器
+DEFAULT_AUTO_INCLUDE = ("**/temperature/*", "**/load/*", "**/power/*")
+
+# LHM传感器类型对应的HA device_class
+LHM_DEVICE_CLASSES = {
+    "Temperature": "temperature",
+    "Power": "power",
+    "Voltage": "voltage",
+    "Current": "current",
+    "Clock": "frequency",
+    "Energy": "energy",
+}
+
+
+class _TrieNode:
+    __slots__ = ("children", "wildcards", "globstar", "terminal")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}  # 普通分段
+        self.wildcards: List[tuple] = []            # (分段模式, 正则, 子节点)
+        self.globstar: Optional["_TrieNode"] = None  # **，匹配任意多个分段
+        self.terminal = False
+
+
+class GlobTrie:
+    """把SensorId的glob规则编译成按 / 分段的前缀树
+
+    分段内支持 * ? [] 通配，** 匹配任意多个分段。
+    多条规则共享相同的前缀，匹配时只需沿树走一遍，不用逐条尝试。
+    """
+    def __init__(self, patterns: Sequence[str] = ()):
+        self.root = _TrieNode()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str):
+        node = self.root
+        for segment in pattern.strip("/").split("/"):
+            if segment == "**":
+                if node.globstar is None:
+                    node.globstar = _TrieNode()
+                node = node.globstar
+            elif any(c in segment for c in "*?["):
+                for existing, _, child in node.wildcards:
+                    if existing == segment:
+                        node = child
+                        break
+                else:
+                    child = _TrieNode()
+                    node.wildcards.append((segment, re.compile(fnmatch.translate(segment)), child))
+                    node = child
+            else:
+                node = node.children.setdefault(segment, _TrieNode())
+        node.terminal = True
+
+    def match(self, sensor_id: str) -> bool:
+        return self._match(self.root, sensor_id.strip("/").split("/"), 0)
+
+    def _match(self, node: _TrieNode, parts: List[str], i: int) -> bool:
+        if node.globstar is not None:
+            for j in range(i, len(parts) + 1):
+                if self._match(node.globstar, parts, j):
+                    return True
+        if i == len(parts):
+            return node.terminal
+        child = node.children.get(parts[i])
+        if child is not None and self._match(child, parts, i + 1):
+            return True
+        for _, regex, child in node.wildcards:
+            if regex.match(parts[i]) and self._match(child, parts, i + 1):
+                return True
+        return False
+
+
+def discover_sensors(root: dict) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
+    """枚举树中的全部传感器，按 硬件 -> 类型 -> 传感器 建立索引"""
+    index: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    # (节点, 所属硬件名, 父节点名, 祖父节点名)
+    stack = [(root, None, "", "")]
+    while stack:
+        n, hardware_name, parent_text, grandparent_text = stack.pop()
+        text = n.get("Text", "")
+        sensor_id = n.get("SensorId")
+        if sensor_id:
+            parts = sensor_id.strip("/").split("/")
+            hardware = "/" + "/".join(parts[:-2])
+            sensor_type = n.get("Type") or parts[-2]
+            value = str(n.get("Value") or "").split()
+            index.setdefault(hardware, {}).setdefault(sensor_type, []).append({
+                "sensor_id": sensor_id,
+                "name": f"{hardware_name or grandparent_text} {text}".strip(),
+                "unit": value[1] if len(value) > 1 else None,
+            })
+        if "HardwareId" in n:
+            hardware_name = text
+        for child in reversed(n.get("Children") or ()):
+            stack.append((child, hardware_name, text, parent_text))
+    return index
+
+
+def sensor_field_name(sensor_id: str) -> str:
+    """SensorId转换成state中的字段名，如 /intelcpu/0/load/1 -> intelcpu_0_load_1"""
+    return re.sub(r"[^0-9a-zA-Z]+", "_", sensor_id).strip("_").lower()
+
+
+# ==================== 死区发布 ====================
+@dataclass(frozen=True)
+class Deadband:
+    """字段的死区：变化超过 max(absolute, 上次发布值 * relative) 才发布"""
+    absolute: float = 0.0
+    relative: float = 0.0
+
+
+# 默认死区，未列出的字段只要数值变化就发布
+DEFAULT_DEADBANDS: Dict[str, Deadband] = {
+    "mb_temp": Deadband(absolute=0.5),
+    "cpu_temp": Deadband(absolute=0.5),
+    "gpu_temp": Deadband(absolute=0.5),
+    "cpu_power": Deadband(absolute=1, relative=0.05),
+    "gpu_power": Deadband(absolute=1, relative=0.05),
+    "cpu_usage": Deadband(absolute=2),
+    "gpu_usage": Deadband(absolute=2),
+    "cpu_freq": Deadband(absolute=0.05),
+    "mem_usage": Deadband(absolute=1),
+    "mem_used": Deadband(absolute=0.1),
+    "mem_available": Deadband(absolute=0.1),
+    "gpu_vram_used": Deadband(absolute=0.1),
+    "gpu_vram_available": Deadband(absolute=0.1),
+    "gpu_vram_usage": Deadband(absolute=1),
+    "net_upload": Deadband(absolute=0.05, relative=0.1),
+    "net_download": Deadband(absolute=0.05, relative=0.1),
+}
+
+
+class DeadbandFilter:
+    """按字段死区过滤state消息，与上次实际发布的值比较，避免缓慢漂移被忽略"""
+    def __init__(self, deadbands: Dict[str, Deadband], refresh_interval: float = 60):
+        self.deadbands = deadbands
+        self.default = Deadband()
+        self.refresh_interval = refresh_interval
+        self._last: Optional[Dict[str, Any]] = None
+        self._last_time = 0.0
+
+    def should_publish(self, payload: Dict[str, Any]) -> bool:
+        """判断是否需要发布，需要时记录为最近一次发布的值"""
+        if self._last is None or time.monotonic() - self._last_time >= self.refresh_interval:
+            self.accept(payload)
+            return True
+        if payload.keys() != self._last.keys():
+            self.accept(payload)
+            return True
+
+        for key, value in payload.items():
+            if key == "timestamp":
+                continue
+            last = self._last[key]
+            if isinstance(value, (int, float)) and isinstance(last, (int, float)):
+                band = self.deadbands.get(key, self.default)
+                if abs(value - last) > max(band.absolute, abs(last) * band.relative):
+                    self.accept(payload)
+                    return True
+            elif value != last:
+                self.accept(payload)
+                return True
+        return False
+
+    def accept(self, payload: Dict[str, Any]):
+        """记录已发布的数据（外部直接发布时也需要调用）"""
+        self._last = payload
+        self._last_time = time.monotonic()
+
+    def reset(self):
+        """清除上次发布的记录，下一条数据必定发布（主机恢复在线时使用）"""
+        self._last = None
+
+
+# ==================== 滚动统计 ====================
+# 统计窗口（标签: 秒）及其在HA中的显示名
+ROLLUP_WINDOWS: Dict[str, float] = {"1m": 60, "5m": 300, "1h": 3600}
+ROLLUP_WINDOW_NAMES = {"1m": "1分钟", "5m": "5分钟", "1h": "1小时"}
+ROLLUP_STAT_NAMES = {"min": "最低", "max": "最高", "avg": "平均"}
+
+# 默认做滚动统计的字段
+DEFAULT_ROLLUP_FIELDS = ("cpu_temp", "cpu_power", "gpu_temp", "gpu_power")
+
+
+def rollup_keys(field_name: str) -> List[str]:
+    """字段对应的全部统计项名称，如 cpu_temp_max_1h"""
+    return [f"{field_name}_{stat}_{label}" for label in ROLLUP_WINDOWS for stat in ROLLUP_STAT_NAMES]
+
+
+def rollup_specs(spec: SensorSpec) -> List[SensorSpec]:
+    """统计项对应的传感器，沿用原字段的单位和图标"""
+    specs = []
+    for label, window_name in ROLLUP_WINDOW_NAMES.items():
+        for stat, stat_name in ROLLUP_STAT_NAMES.items():
+            key = f"{spec.field}_{stat}_{label}"
+            specs.append(SensorSpec(key, f"{spec.name}{window_name}{stat_name}", key,
+                                    unit=spec.unit, device_class=spec.device_class, icon=spec.icon))
+    return specs
+
+
+class _RollupWindow:
+    __slots__ = ("label", "seconds", "start", "total", "count", "min_queue", "max_queue")
+
+    def __init__(self, label: str, seconds: float):
+        self.label = label
+        self.seconds = seconds
+        self.start = 0        # 窗口内最旧样本的序号
+        self.total = 0.0
+        self.count = 0
+        self.min_queue = deque()  # 单调递增的样本序号，队首为窗口最小值
+        self.max_queue = deque()  # 单调递减的样本序号，队首为窗口最大值
+
+
+class RollingStats:
+    """单个传感器的环形缓冲区，增量维护多个时间窗口的最小/最大/平均值
+
+    样本按序号写入定长数组，每个窗口只记录起始序号、累加和以及单调队列，
+    新样本进入和旧样本过期都是均摊O(1)，不需要重新扫描窗口。
+    """
+    def __init__(self, windows: Dict[str, float], capacity: int):
+        self._capacity = capacity
+        self._times = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._seq = 0  # 下一个样本的序号
+        self._windows = [_RollupWindow(label, seconds) for label, seconds in windows.items()]
+
+    def push(self, timestamp: float, value: float):
+        """加入一个样本（timestamp 为单调时间）"""
+        seq = self._seq
+        capacity = self._capacity
+        values = self._values
+        times = self._times
+
+        # 缓冲区写满时，被覆盖的样本先从仍包含它的窗口中移出
+        for window in self._windows:
+            while window.count and window.start <= seq - capacity:
+                self._expire(window)
+
+        times[seq % capacity] = timestamp
+        values[seq % capacity] = value
+        self._seq = seq + 1
+
+        for window in self._windows:
+            window.total += value
+            window.count += 1
+            max_queue = window.max_queue
+            while max_queue and values[max_queue[-1] % capacity] <= value:
+                max_queue.pop()
+            max_queue.append(seq)
+            min_queue = window.min_queue
+            while min_queue and values[min_queue[-1] % capacity] >= value:
+                min_queue.pop()
+            min_queue.append(seq)
+
+            cutoff = timestamp - window.seconds
+            while window.start < seq and times[window.start % capacity] <= cutoff:
+                self._expire(window)
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def resized(self, capacity: int) -> "RollingStats":
+        """容量不同的副本，按顺序保留缓冲区中的样本"""
+        stats = RollingStats({window.label: window.seconds for window in self._windows}, capacity)
+        for seq in range(max(0, self._seq - self._capacity), self._seq):
+            stats.push(self._times[seq % self._capacity], self._values[seq % self._capacity])
+        return stats
+
+    def _expire(self, window: _RollupWindow):
+        start = window.start
+        window.total -= self._values[start % self._capacity]
+        window.count -= 1
+        if window.max_queue and window.max_queue[0] == start:
+            window.max_queue.popleft()
+        if window.min_queue and window.min_queue[0] == start:
+            window.min_queue.popleft()
+        window.start = start + 1
+
+    def summary(self, field_name: str) -> Dict[str, float]:
+        """各窗口的统计结果，键名与 rollup_keys 一致"""
+        result = {}
+        capacity = self._capacity
+        for window in self._windows:
+            if not window.count:
+                continue
+            label = window.label
+            result[f"{field_name}_min_{label}"] = self._values[window.min_queue[0] % capacity]
+            result[f"{field_name}_max_{label}"] = self._values[window.max_queue[0] % capacity]
+            result[f"{field_name}_avg_{label}"] = round(window.total / window.count, 2)
+        return result
+
+
+# ==================== 轮询调度 ====================
+# 自适应模式下各字段每秒变化量的参考值，变化速度超过参考值视为“活跃”
+ADAPTIVE_RATES: Dict[str, float] = {
+    "cpu_usage": 5,
+    "gpu_usage": 5,
+    "cpu_power": 5,
+    "gpu_power": 5,
+    "cpu_temp": 0.5,
+    "gpu_temp": 0.5,
+    "net_upload": 0.5,
+    "net_download": 0.5,
+}
+
+
+class PollScheduler:
+    """轮询调度：按单调时钟的截止时间计时，避免周期随请求耗时漂移
+
+    - 首次轮询随机错开一段时间，多台主机不会同时请求
+    - adaptive 模式下数值变化快时缩短间隔，空闲时逐步放宽到 max_interval
+    - 失败后的退避由熔断器（CircuitBreaker）负责，这里只按间隔计时
+    """
+    def __init__(self, interval: float, adaptive: bool = False, min_interval: Optional[float] = None,
+                 max_interval: Optional[float] = None):
+        self.adaptive = adaptive
+        self._interval_limits = (min_interval, max_interval)
+        self.set_interval(interval)
+        self._deadline: Optional[float] = None
+        self._last_values: Optional[Dict[str, float]] = None
+        self._last_time = 0.0
+
+    def set_interval(self, interval: float):
+        """设置基准间隔（热重载时也会调用），未指定的最短/最长间隔按基准间隔重新计算"""
+        min_interval, max_interval = self._interval_limits
+        self.base_interval = interval
+        self.interval = interval
+        self.min_interval = min_interval or interval / 4
+        self.max_interval = max_interval or interval * 5
+
+    def initial_delay(self) -> float:
+        """首次轮询前的错峰等待时间"""
+        delay = random.uniform(0, self.interval)
+        self._deadline = time.monotonic() + delay
+        return delay
+
+    def next_delay(self) -> float:
+        """本轮结束后到下一轮开始需要等待的时间"""
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline += self.interval
+        if self._deadline < now:
+            # 本轮耗时超过了间隔，跳过错过的周期，保持原有相位
+            missed = int((now - self._deadline) / self.interval) + 1
+            self._deadline += missed * self.interval
+        return self._deadline - now
+
+    def observe(self, values: Any):
+        """自适应模式：根据数值变化速度调整轮询间隔（values 可以是字典或 SensorState）"""
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        current = {}
+        for k in ADAPTIVE_RATES:
+            value = values.get(k)
+            if isinstance(value, (int, float)):
+                current[k] = value
+        last, dt = self._last_values, now - self._last_time
+        self._last_values, self._last_time = current, now
+        if last is None or dt <= 0:
+            return
+
+        activity = max(
+            (abs(v - last[k]) / dt / ADAPTIVE_RATES[k] for k, v in current.items() if k in last),
+            default=0.0,
+        )
+        if activity >= 1:
+            self.interval = max(self.min_interval, self.interval / 2)
+        elif activity < 0.25:
+            self.interval = min(self.max_interval, self.interval * 1.25)
+
+
+# ==================== 传感器分组 ====================
+GROUP_AGGREGATES = ("mean", "max", "last")
+
+
+@dataclass(frozen=True)
+class SensorGroup:
+    """按各自的频率采样和发布的一组state字段
+
+    fields 为字段名，可使用通配符（如 "nic_*"），未被任何分组选中的字段留在默认分组；
+    两次发布之间的多次采样按 aggregate 汇总：mean（平均）、max（最大）或 last（最后一次）。
+    分组的数据发布到 <base_topic>state_<name>，HA自动发现配置随之指向该主题。
+    """
+    name: str
+    fields: Sequence[str]
+    sample_interval: float
+    publish_interval: Optional[float] = None  # 为None时与采样间隔相同
+    aggregate: str = "mean"
+
+    def __post_init__(self):
+        if self.aggregate not in GROUP_AGGREGATES:
+            raise ValueError(f"未知的汇总方式: {self.aggregate}")
+
+    @property
+    def topic(self) -> str:
+        return f"state_{self.name}" if self.name else "state"
+
+    @property
+    def publish_every(self) -> float:
+        return self.sample_interval if self.publish_interval is None else self.publish_interval
+
+    def matches(self, field_name: str) -> bool:
+        return any(fnmatch.fnmatchcase(field_name, pattern) for pattern in self.fields)
+
+
+def next_deadline(deadline: float, interval: float, now: float) -> float:
+    """截止时间推进一个周期，错过的周期直接跳过"""
+    deadline += interval
+    return deadline if deadline > now else now + interval
+
+
+class GroupBuffer:
+    """分组在两次发布之间的采样汇总：按字段在状态数组中的下标预分配，缺失值（NaN）不计入"""
+    __slots__ = ("group", "fields", "slots", "next_sample", "next_publish",
+                 "_sums", "_counts", "_maxes", "_last")
+
+    def __init__(self, group: SensorGroup, fields: Sequence[str], layout: StateLayout,
+                 previous: Optional["GroupBuffer"] = None):
+        self.group = group
+        self.fields = list(fields)
+        self.slots = [layout.index[field_name] for field_name in self.fields]
+        # 字段变化（自动发现）时沿用原有的采样/发布时间，正在汇总的采样丢弃
+        self.next_sample = previous.next_sample if previous is not None else 0.0
+        self.next_publish = previous.next_publish if previous is not None else 0.0
+        size = len(self.slots)
+        self._sums = array("d", [0.0]) * size
+        self._counts = array("d", [0.0]) * size
+        self._maxes = array("d", [NAN]) * size
+        self._last = array("d", [NAN]) * size
+
+    def sample(self, values: array):
+        """记录一次采样"""
+        sums, counts, maxes, last = self._sums, self._counts, self._maxes, self._last
+        for j, slot in enumerate(self.slots):
+            value = values[slot]
+            if value == value:
+                sums[j] += value
+                counts[j] += 1
+                if not maxes[j] >= value:
+                    maxes[j] = value
+                last[j] = value
+
+    def flush(self, values: array) -> Dict[str, float]:
+        """返回自上次发布以来的汇总值并清零；期间没有采样的字段使用当前值"""
+        aggregate = self.group.aggregate
+        sums, counts, maxes, last = self._sums, self._counts, self._maxes, self._last
+        result = {}
+        for j, (field_name, slot) in enumerate(zip(self.fields, self.slots)):
+            if not counts[j]:
+                value = values[slot]
+            elif aggregate == "mean":
+                value = sums[j] / counts[j]
+            elif aggregate == "max":
+                value = maxes[j]
+            else:
+                value = last[j]
+            if value == value:
+                result[field_name] = value
+            sums[j] = counts[j] = 0.0
+            maxes[j] = NAN
+        return result
+
+
+# ==================== 告警规则 ====================
+@dataclass(frozen=True)
+class AlertRule:
+    """告警规则：字段高于 above、低于 below，或每秒变化量（绝对值）超过 rate 时触发，三者只能设置一项
+
+    hysteresis 为恢复时需要让出的余量（如 above=90, hysteresis=5 要回落到85以下才恢复），避免在阈值附近反复触发；
+    duration 为超限需要持续的秒数，短暂的尖峰不会触发。
+    """
+    name: str
+    field: str
+    above: Optional[float] = None
+    below: Optional[float] = None
+    rate: Optional[float] = None
+    hysteresis: float = 0.0
+    duration: float = 0.0
+    severity: str = "warning"
+
+    def __post_init__(self):
+        if sum(limit is not None for limit in (self.above, self.below, self.rate)) != 1:
+            raise ValueError(f"告警规则 {self.name} 需要且只能设置 above/below/rate 中的一项")
+
+
+class _AlertState:
+    """编译后的规则：状态数组下标、比较方向和触发状态"""
+    __slots__ = ("rule", "slot", "threshold", "direction", "active", "since", "last_value", "last_time")
+
+    def __init__(self, rule: AlertRule, slot: int):
+        self.rule = rule
+        self.slot = slot
+        if rule.below is not None:
+            self.threshold, self.direction = rule.below, -1
+        else:
+            self.threshold, self.direction = (rule.above if rule.rate is None else rule.rate), 1
+        self.active = False
+        self.since: Optional[float] = None  # 开始超限的时间
+        self.last_value: Optional[float] = None  # 变化率规则的上一次采样
+        self.last_time = 0.0
+
+
+class AlertEngine:
+    """在每次解析后按规则检查状态数组，只在触发/恢复时产生事件"""
+    def __init__(self, rules: Sequence[AlertRule], layout: StateLayout,
+                 previous: Optional["AlertEngine"] = None):
+        self.rules = tuple(rules)
+        carried = {state.rule.name: state for state in previous._states} if previous is not None else {}
+        self._states: List[_AlertState] = []
+        for rule in self.rules:
+            slot = layout.index.get(rule.field)
+            if slot is None:
+                continue  # 字段尚未出现（如等待自动发现）
+            state = _AlertState(rule, slot)
+            old = carried.get(rule.name)
+            if old is not None and old.rule == rule:
+                state.active, state.since = old.active, old.since
+                state.last_value, state.last_time = old.last_value, old.last_time
+            self._states.append(state)
+
+    @property
+    def active(self) -> List[str]:
+        """正在触发的规则名"""
+        return [state.rule.name for state in self._states if state.active]
+
+    def evaluate(self, values: array, now: float) -> List[Dict[str, Any]]:
+        """检查一次采样，返回状态发生变化的规则事件"""
+        events = []
+        for state in self._states:
+            value = values[state.slot]
+            if value != value:
+                state.since = None
+                continue
+            if state.rule.rate is not None:
+                last_value, last_time = state.last_value, state.last_time
+                state.last_value, state.last_time = value, now
+                if last_value is None or now <= last_time:
+                    continue
+                value = abs(value - last_value) / (now - last_time)
+
+            excess = (value - state.threshold) * state.direction
+            if not state.active:
+                if excess <= 0:
+                    state.since = None
+                    continue
+                if state.since is None:
+                    state.since = now
+                if now - state.since < state.rule.duration:
+                    continue
+                state.active = True
+                events.append(self._event(state, "firing", value))
+            elif excess <= -state.rule.hysteresis:
+                state.active = False
+                state.since = None
+                events.append(self._event(state, "resolved", value))
+        return events
+
+    @staticmethod
+    def _event(state: _AlertState, status: str, value: float) -> Dict[str, Any]:
+        rule = state.rule
+        return {
+            "rule": rule.name,
+            "field": rule.field,
+            "state": status,
+            "severity": rule.severity,
+            "value": value,
+            "threshold": state.threshold,
+        }
+
+
+# ==================== 累计量 ====================
+@dataclass(frozen=True)
+class Integral:
+    """对瞬时值按时间积分得到的累计量（梯形法），结果写入状态数组中的 field"""
+    field: str
+    source: str   # 被积分的字段
+    scale: float  # 数值·秒 -> 累计量单位
+
+
+INTEGRALS: List[Integral] = [
+    Integral("cpu_energy", "cpu_power", 1 / 3_600_000),    # W·s -> kWh
+    Integral("gpu_energy", "gpu_power", 1 / 3_600_000),
+    Integral("net_uploaded", "net_upload", 1 / 1024),      # MB/s·s -> GB
+    Integral("net_downloaded", "net_download", 1 / 1024),
+]
+
+
+class Integrator:
+    """在每次解析后累计功率和网速，累计值持久化到文件，重启后继续累加
+
+    两次采样间隔超过 max_gap（如主机离线期间）时不积分，避免用一个值外推整段空白。
+    每 save_interval 秒保存一次，异常退出最多丢失这段时间的增量；
+    HA对 total_increasing 小于10%的回落不视为计数器清零，不会重复累计。
+    """
+    def __init__(self, integrals: Sequence[Integral], layout: StateLayout, path: str = "",
+                 max_gap: float = 60, save_interval: float = 60):
+        self.integrals = tuple(integrals)
+        self.path = path
+        self.max_gap = max_gap
+        self.save_interval = save_interval
+        self.totals: Dict[str, float] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.totals = {k: float(v) for k, v in json.load(f).items()}
+            except (OSError, ValueError, AttributeError) as e:
+                logger.warning(f"读取累计量失败: {e}")
+        self._last: Dict[str, tuple] = {}  # field -> (上次的值, 上次的时间)
+        self._last_save = time.monotonic()
+        self._dirty = False
+        self.bind(layout)
+
+    def bind(self, layout: StateLayout):
+        """按状态布局编译为 (累计量, 来源下标, 目标下标)，布局变化（自动发现）后重新调用"""
+        self._slots = [
+            (integral, layout.index[integral.source], layout.index[integral.field])
+            for integral in self.integrals
+            if integral.source in layout.index and integral.field in layout.index
+        ]
+
+    def update(self, values: array, now: float):
+        """累计一次采样并把累计值写入状态数组"""
+        for integral, source, target in self._slots:
+            value = values[source]
+            field_name = integral.field
+            if value != value:
+                self._last.pop(field_name, None)
+            else:
+                last = self._last.get(field_name)
+                total = self.totals.get(field_name, 0.0)
+                if last is not None and 0 < now - last[1] <= self.max_gap:
+                    total += (last[0] + value) / 2 * (now - last[1]) * integral.scale
+                    self._dirty = True
+                self.totals[field_name] = total
+                self._last[field_name] = (value, now)
+            if field_name in self.totals:
+                values[target] = self.totals[field_name]
+        if now - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        self._last_save = time.monotonic()
+        if not self.path or not self._dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.totals, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"保存累计量失败: {e}")
+
+
+# ==================== 熔断器 ====================
+class CircuitBreaker:
+    """单台主机的熔断器
+
+    连续失败达到阈值后进入OPEN状态，期间不再请求；reset_timeout后进入HALF_OPEN，
+    只放行一次探测请求：成功则恢复CLOSED，失败则重新OPEN且等待时间翻倍（不超过max_reset_timeout）。
+    等待时间带随机抖动，多台主机同时掉线时不会同时探测。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 1, reset_timeout: float = 5,
+                 max_reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self._timeout = reset_timeout
+        self._retry_at = 0.0
+
+    def allow(self) -> bool:
+        """是否允许发起请求，OPEN超时后转为HALF_OPEN并放行一次探测"""
+        if self.state == self.OPEN and time.monotonic() >= self._retry_at:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def retry_in(self) -> float:
+        """距离下一次探测的秒数"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._retry_at - time.monotonic())
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._timeout = self.reset_timeout
+
+    def record_failure(self) -> bool:
+        """记录一次失败，刚刚进入OPEN状态时返回True"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+        elif self.state == self.OPEN or self.failures < self.failure_threshold:
+            return False
+        was_closed = self.state == self.CLOSED
+        self.state = self.OPEN
+        self._retry_at = time.monotonic() + self._timeout * random.uniform(0.5, 1)
+        self.opens += 1
+        return was_closed
+
+
+# ==================== 运行指标 ====================
+POLL_STAGES = ("fetch", "decode", "parse", "publish", "total")
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """累积直方图，按OpenMetrics的le桶输出"""
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+class MetricsWriter:
+    """拼装OpenMetrics文本"""
+    def __init__(self):
+        self._lines: List[str] = []
+
+    def _header(self, name: str, metric_type: str, help_text: str):
+        self._lines.append(f"# TYPE {name} {metric_type}")
+        self._lines.append(f"# HELP {name} {help_text}")
+
+    def gauge(self, name: str, help_text: str, samples: List[tuple]):
+        """samples: [(labels, value), ...]"""
+        self._header(name, "gauge", help_text)
+        for labels, value in samples:
+            self._lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    def counter(self, name: str, help_text: str, samples: List[tuple]):
+        self._header(name, "counter", help_text)
+        for labels, value in samples:
+            self._lines.append(f"{name}_total{_format_labels(labels)} {value}")
+
+    def histogram(self, name: str, help_text: str, samples: List[tuple]):
+        """samples: [(labels, Histogram), ...]"""
+        self._header(name, "histogram", help_text)
+        for labels, hist in samples:
+            cumulative = 0
+            for bound, count in zip(hist.buckets + (float("inf"),), hist.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                self._lines.append(f"{name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+            self._lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+            self._lines.append(f"{name}_sum{_format_labels(labels)} {hist.total}")
+
+    def render(self) -> str:
+        return "\n".join(self._lines + ["# EOF", ""])
+
+
+class MetricsServer:
+    """在本地HTTP端口以OpenMetrics格式暴露监控程序自身的运行指标"""
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, monitors: Dict[str, "HardwareMonitor"], connection: "MQTTConnection",
+                 host: str = "127.0.0.1", port: int = 9108, lag_interval: float = 0.5):
+        self.monitors = monitors  # 直接引用，主机增删后自动生效
+        self.connection = connection
+        self.host = host
+        self.port = port
+        self.lag_interval = lag_interval
+        self.loop_lag = Histogram()
+        self._runner = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.get_running_loop().create_task(self._probe_loop_lag())
+        logger.info(f"运行指标地址: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _probe_loop_lag(self):
+        """定时休眠，实际唤醒时间与预期之差即为事件循环延迟"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            self.loop_lag.observe(max(0.0, loop.time() - expected))
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), headers={"Content-Type": self.CONTENT_TYPE})
+
+    def render(self) -> str:
+        writer = MetricsWriter()
+        monitors = list(self.monitors.values())
+
+        writer.histogram("pc_monitor_poll_seconds", "Poll latency by host and stage", [
+            ({"host": m.name, "stage": stage}, hist)
+            for m in monitors for stage, hist in m.stage_histograms.items()
+        ])
+        writer.gauge("pc_monitor_parse_nodes", "Nodes visited by the last parse",
+                     [({"host": m.name}, m.last_parse_nodes) for m in monitors])
+        writer.counter("pc_monitor_parse_full_scans", "Full sensor tree walks",
+                       [({"host": m.name}, m.full_scans) for m in monitors])
+        writer.gauge("pc_monitor_connection_failures", "Consecutive poll failures",
+                     [({"host": m.name}, m._connection_failures) for m in monitors])
+        writer.gauge("pc_monitor_breaker_open", "Circuit breaker open (1) or closed/half-open (0)",
+                     [({"host": m.name}, int(m.breaker.state == CircuitBreaker.OPEN)) for m in monitors])
+        writer.counter("pc_monitor_breaker_opens", "Times the circuit breaker opened",
+                       [({"host": m.name}, m.breaker.opens) for m in monitors])
+        writer.gauge("pc_monitor_alerts_active", "Alert rules currently firing",
+                     [({"host": m.name}, len(m.alerts.active)) for m in monitors])
+
+        conn = self.connection
+        stats = conn.stats()
+        writer.counter("pc_monitor_mqtt_connects", "MQTT connections established", [({}, conn.connects)])
+        writer.counter("pc_monitor_mqtt_disconnects", "MQTT disconnections", [({}, conn.disconnects)])
+        writer.gauge("pc_monitor_publish_queue_depth", "Messages waiting in the publish queue",
+                     [({}, stats["queue_depth"])])
+        writer.gauge("pc_monitor_publish_inflight", "Published messages awaiting acknowledgement",
+                     [({}, stats["inflight"])])
+        writer.counter("pc_monitor_publish_dropped", "Messages dropped by the publish queue",
+                       [({}, stats["dropped"])])
+        writer.histogram("pc_monitor_publish_ack_seconds", "Enqueue to broker acknowledgement latency",
+                         [({}, conn.ack_histogram)])
+        writer.histogram("pc_monitor_event_loop_lag_seconds", "Event loop scheduling lag",
+                         [({}, self.loop_lag)])
+        return writer.render()
+
+
+# ==================== JSON 编解码 ====================
+def json_loads(raw: bytes) -> Any:
+    """解析JSON，安装了orjson时使用orjson"""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def json_dumps(obj: Any) -> str:
+    """序列化为JSON，安装了orjson时使用orjson（输出不带多余空格、不转义非ASCII字符）"""
+    return orjson.dumps(obj).decode() if orjson is not None else json.dumps(obj)
+
+
+class ExtractResult(NamedTuple):
+    matches: list                      # [(SlotRule, {"Value", "Max"})]
+    sensor_paths: Optional[tuple]      # 完整遍历时的新路径缓存，命中缓存时为None
+    visited: int                       # 访问的节点数
+    sensor_index: Optional[dict]       # 需要自动发现时的传感器索引
+
+
+def extract_sensors(raw: bytes, dispatch: SensorDispatch, sensor_paths, discover: bool) -> ExtractResult:
+    """解析响应并提取匹配的传感器（可在子进程中运行），只返回取值需要的少量数据"""
+    root = json_loads(raw)
+    result = resolve_cached_paths(root, dispatch, sensor_paths) if sensor_paths else None
+    sensor_index = None
+    if result is None:
+        if discover:
+            sensor_index = discover_sensors(root)
+        matches, sensor_paths, visited = scan_tree(root, dispatch)
+    else:
+        (matches, visited), sensor_paths = result, None
+    matches = [(rule, {"Value": n.get("Value"), "Max": n.get("Max")}) for rule, n in matches]
+    return ExtractResult(matches, sensor_paths, visited, sensor_index)
+
+
+class ParseOffloader:
+    """超过threshold字节的响应交给进程池解析，避免一台主机的大响应阻塞其它主机的轮询
+
+    json解析在C代码中一直持有GIL，放到线程池并不能让出事件循环，所以默认使用进程池；
+    子进程里完成解析和传感器提取，只把匹配到的少量节点传回主进程。
+    """
+    def __init__(self, threshold: Optional[int] = 256 * 1024, executor: Optional[Executor] = None,
+                 workers: int = 2):
+        self.threshold = threshold
+        self.workers = workers
+        self._executor = executor
+        self.offloaded = 0
+
+    def should_offload(self, size: int) -> bool:
+        return self.threshold is not None and size >= self.threshold
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            # spawn：不继承paho等后台线程的状态，各平台行为一致
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def extract(self, raw: bytes, dispatch: SensorDispatch, sensor_paths, discover: bool) -> ExtractResult:
+        self.offloaded += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, extract_sensors, raw, dispatch, sensor_paths, discover)
+
+
+DEFAULT_OFFLOADER = ParseOffloader()
+
+
+# ==================== HTTP 会话 ====================
+def _build_trace_config() -> aiohttp.TraceConfig:
+    """通过aiohttp的trace钩子记录连接和首字节耗时，结果写入请求的PollTimings"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.request_start = time.perf_counter()
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        if isinstance(ctx.trace_request_ctx, PollTimings):
+            ctx.trace_request_ctx.connect = time.perf_counter() - ctx.connect_start
+
+    async def on_request_end(session, ctx, params):
+        if isinstance(ctx.trace_request_ctx, PollTimings):
+            ctx.trace_request_ctx.first_byte = time.perf_counter() - ctx.request_start
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def create_http_session(limit: int = 8, timeout: float = 3) -> aiohttp.ClientSession:
+    """创建长连接HTTP会话（连接池 + keep-alive + DNS缓存），需在事件循环中调用"""
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=2,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        trace_configs=[_build_trace_config()],
+    )
+
+
+# ==================== 断线缓存 ====================
+class SpoolLog:
+    """broker断线期间的消息落盘缓存：追加写入、内存映射的分段日志
+
+    每个分段文件预分配固定大小并用mmap写入，记录格式为
+    [u32 长度][u8 qos][u8 标志（bit0 retain，bit1 二进制负载）][u16 主题长度][主题][负载]，长度为0表示分段结束。
+    分段按序号命名，超过总大小上限时淘汰最旧的分段；进程重启后未补发的分段仍会保留。
+    """
+    _HEADER = struct.Struct("<IBBH")
+
+    def __init__(self, directory: str, segment_size: int = 4 * 1024 * 1024,
+                 max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = deque(sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".seg")))
+        self._next_id = int(os.path.basename(self._segments[-1])[:-4]) + 1 if self._segments else 0
+        self._active: Optional[mmap.mmap] = None
+        self._active_path: Optional[str] = None
+        self._active_pos = 0
+        self.evicted = 0  # 被淘汰的分段数
+
+    @property
+    def has_backlog(self) -> bool:
+        """是否有尚未补发的数据"""
+        return bool(self._segments) and (self._active is None or self._active_pos > 0 or len(self._segments) > 1)
+
+    def append(self, topic: str, payload: Union[str, bytes], qos: int, retain: bool):
+        """追加一条消息"""
+        topic_bytes = topic.encode()
+        binary = isinstance(payload, bytes)
+        body = payload if binary else payload.encode()
+        size = self._HEADER.size + len(topic_bytes) + len(body)
+        if size > self.segment_size:
+            logger.warning(f"消息过大无法缓存: {topic} ({size} 字节)")
+            return
+        if self._active is None or self._active_pos + size > self.segment_size:
+            self._rotate()
+        record = self._HEADER.pack(size - 4, qos, int(retain) | binary << 1, len(topic_bytes)) + topic_bytes + body
+        self._active[self._active_pos:self._active_pos + size] = record
+        self._active_pos += size
+
+    def _rotate(self):
+        self.seal()
+        path = os.path.join(self.directory, f"{self._next_id:08d}.seg")
+        self._next_id += 1
+        with open(path, "wb") as f:
+            f.truncate(self.segment_size)
+        with open(path, "r+b") as f:
+            self._active = mmap.mmap(f.fileno(), self.segment_size)
+        self._active_path = path
+        self._active_pos = 0
+        self._segments.append(path)
+
+        while len(self._segments) > self.max_segments:
+            os.remove(self._segments.popleft())
+            self.evicted += 1
+            logger.warning("断线缓存已满，丢弃最旧的分段")
+
+    def seal(self):
+        """结束当前写入的分段，之后的消息写入新分段"""
+        if self._active is not None:
+            self._active.flush()
+            self._active.close()
+            self._active = None
+            self._active_path = None
+
+    def oldest(self) -> Optional[str]:
+        """最旧的分段；如果它正在写入，先将其封存"""
+        if not self._segments:
+            return None
+        if self._segments[0] == self._active_path:
+            self.seal()
+        return self._segments[0]
+
+    def read(self, path: str, offset: int = 0):
+        """逐条读取分段中的消息，产出 (下一条的偏移, topic, payload, qos, retain)"""
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header = self._HEADER
+                while offset + header.size <= len(mm):
+                    length, qos, flags, topic_len = header.unpack_from(mm, offset)
+                    if length == 0:
+                        break
+                    start = offset + header.size
+                    end = offset + 4 + length
+                    topic = mm[start:start + topic_len].decode()
+                    payload = mm[start + topic_len:end]
+                    offset = end
+                    yield offset, topic, payload if flags & 2 else payload.decode(), qos, bool(flags & 1)
+
+    def remove(self, path: str):
+        """删除已补发完的分段"""
+        if path in self._segments:
+            self._segments.remove(path)
+            os.remove(path)
+
+
+# ==================== 自动发现缓存 ====================
+class DiscoveryCache:
+    """记录每个自动发现主题最近一次发布内容的哈希，持久化到文件"""
+    def __init__(self, path: str):
+        self.path = path
+        self._hashes: Dict[str, str] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._hashes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"读取自动发现缓存失败: {e}")
+        self._dirty = False
+
+    def update(self, topic: str, config: Dict[str, Any]) -> bool:
+        """记录配置内容，内容有变化时返回True"""
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        if self._hashes.get(topic) == digest:
+            return False
+        self._hashes[topic] = digest
+        self._dirty = True
+        return True
+
+    def stale(self, prefix: str, current: set) -> List[str]:
+        """该前缀下已不再使用的主题"""
+        return [topic for topic in self._hashes if topic.startswith(prefix) and topic not in current]
+
+    def remove(self, topic: str):
+        self._hashes.pop(topic, None)
+        self._dirty = True
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._hashes, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"保存自动发现缓存失败: {e}")
+
+
+# ==================== 录制与回放 ====================
+class CaptureLog:
+    """LHM原始响应的录制文件：gzip压缩
+
+    记录格式为 [f64 单调时钟时间][u32 长度][响应体]。每条写入后同步刷新压缩流，
+    进程异常退出时只会丢失最后一条；读取时遇到不完整的记录即停止。
+    每次启动写入新文件 <前缀>-<启动时间>.capture.gz：被kill时gzip成员没有正常结束，
+    追加在它后面的数据读取时无法解析。
+    """
+    _HEADER = struct.Struct("<dI")
+    SUFFIX = ".capture.gz"
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.path = ""  # 首次写入时确定
+        self._file: Optional[gzip.GzipFile] = None
+        self.records = 0
+
+    def _open(self):
+        directory = os.path.dirname(self.prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        stem = f"{self.prefix}-{datetime.now():%Y%m%d-%H%M%S}"
+        path, n = stem + self.SUFFIX, 1
+        while os.path.exists(path):
+            path, n = f"{stem}-{n}{self.SUFFIX}", n + 1
+        self.path = path
+        self._file = gzip.open(path, "wb")
+
+    def append(self, raw: bytes, timestamp: float):
+        if self._file is None:
+            self._open()
+        self._file.write(self._HEADER.pack(timestamp, len(raw)))
+        self._file.write(raw)
+        self._file.flush()
+        self.records += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def read(cls, path: str) -> Iterator[Tuple[float, bytes]]:
+        """按顺序产出 (时间, 响应体)"""
+        size = cls._HEADER.size
+        with gzip.open(path, "rb") as f:
+            while True:
+                try:
+                    header = f.read(size)
+                    if len(header) < size:
+                        return
+                    timestamp, length = cls._HEADER.unpack(header)
+                    raw = f.read(length)
+                except (EOFError, OSError, zlib.error):
+                    return  # 录制中断留下的不完整数据
+                if len(raw) < length:
+                    return
+                yield timestamp, raw
+
+
+class ReplaySource:
+    """按录制时的间隔回放响应，代替HTTP请求送入解析和发布流程
+
+    speed 为倍速，0表示不等待（尽快回放）；loop=True 时循环回放。
+    records 可以在多台模拟主机间共享（只读），一份录制即可模拟大量主机。
+    """
+    def __init__(self, records: Sequence[Tuple[float, bytes]], speed: float = 1.0, loop: bool = False):
+        if not records:
+            raise ValueError("回放数据为空")
+        self.records = records
+        self.speed = speed
+        self.loop = loop
+        self.position = 0
+        self.replayed = 0
+        self._last_gap = 0.0
+
+    @classmethod
+    def from_file(cls, path: str, **options) -> "ReplaySource":
+        return cls(list(CaptureLog.read(path)), **options)
+
+    @property
+    def done(self) -> bool:
+        return not self.loop and self.position >= len(self.records)
+
+    def read(self) -> bytes:
+        """取出下一条响应"""
+        if self.done:
+            raise EOFError("回放结束")
+        raw = self.records[self.position % len(self.records)][1]
+        self.position += 1
+        self.replayed += 1
+        return raw
+
+    def next_delay(self) -> float:
+        """到下一条响应需要等待的时间，按录制时的间隔和倍速计算"""
+        if self.speed <= 0 or self.done:
+            return 0.0
+        count = len(self.records)
+        i = self.position % count
+        if i:
+            gap = self.records[i][0] - self.records[i - 1][0]
+            if gap >= 0:  # 跨越两次录制时时钟不连续，沿用上一个间隔
+                self._last_gap = gap
+        return self._last_gap / self.speed
+
+
+# ==================== MQTT 连接 ====================
+class MQTTConnection:
+    """MQTT连接，多台主机共用一个客户端（一个paho线程、一条连接）
+
+    消息先进入有界的发送队列，由事件循环中的发送任务在连接可用时交给paho，
+    同时限制未确认（in-flight）消息数量，避免broker变慢或断开时paho内部队列无限增长。
+    队列满时丢弃最旧的消息；coalesce策略下同一主题只保留最新一条。
+
+    配置了spool_dir时，断线期间标记为spool的消息写入SpoolLog，重连后按replay_rate补发。
+    补发完成前新消息也继续写入缓存，保证发布顺序不乱。
+    """
+    def __init__(self, config: MQTTConfig, max_queue: int = 5000, max_inflight: int = 20,
+                 policy: str = "coalesce"):
+        if policy not in ("coalesce", "drop_oldest"):
+            raise ValueError(f"未知的队列策略: {policy}")
         self.config = config
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.policy = policy
+
+        self._queue: OrderedDict = OrderedDict()  # key -> (topic, payload, qos, retain, 使用别名, 入队时间)
+        self._inflight: Dict[int, float] = {}  # mid -> 入队时间
+        self._seq = 0
+        self._connected = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+
+        # MQTT v5 主题别名：每条连接独立分配，数量上限由broker在CONNACK中给出
+        self._alias_max = 0
+        self._aliases: Dict[str, int] = {}
+
+        # 统计信息
+        self.published = 0
+        self.acked = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.connects = 0
+        self.disconnects = 0
+        self._ack_latencies = deque(maxlen=256)
+        self.ack_histogram = Histogram()
+
+        self.spool: Optional[SpoolLog] = None
+        if config.spool_dir:
+            self.spool = SpoolLog(config.spool_dir, config.spool_segment_size, config.spool_max_bytes)
+        self._replay_task: Optional[asyncio.Task] = None
+        self._replay_offset = (None, 0)  # 中断补发时的 (分段, 偏移)
+        self.replayed = 0
+
+        self.discovery_cache = DiscoveryCache(config.discovery_cache_file)
+        self._birth_listeners: List[Callable[[], None]] = []
+        self._connect_listeners: List[Callable[[], None]] = []
+
         self.client = self._setup_client()
 
     def _setup_client(self) -> mqtt.Client:
         client = mqtt.Client(
             client_id=self.config.client_id,
+            protocol=self.config.protocol,
             callback_api_version=mqtt.CallbackAPIVersion.VERSION1
         )
         client.username_pw_set(self.config.username, self.config.password)
         client.on_connect = self._on_connect
         client.on_disconnect = self._on_disconnect
-        client.connect(self.config.broker, self.config.port)
+        client.on_publish = self._on_publish
+        client.on_message = self._on_message
+        client.on_connect_fail = self._on_connect_fail
+        # 进程崩溃或网络中断时由broker代为发布offline
+        client.will_set(self.config.will_topic, "offline", qos=1, retain=True)
+        # 在paho线程中连接并自动重连：启动时broker不可用与运行中断线的处理相同，消息先进入队列或断线缓存
+        client.connect_async(self.config.broker, self.config.port)
         client.loop_start()
         return client
 
-    def _on_connect(self, client, userdata, flags, rc):
+    # 以下回调都在paho线程中执行，需要转交给事件循环处理
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             logger.info("MQTT连接成功")
+            self.connects += 1
+            self._aliases = {}
+            self._alias_max = getattr(properties, "TopicAliasMaximum", 0) if properties else 0
+            self._connected = True
+            client.subscribe(self.config.ha_status_topic, qos=1)
+            self._call_in_loop(self._on_connected)
         else:
             logger.error(f"MQTT连接失败，错误码: {rc}")
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_connect_fail(self, client, userdata):
+        logger.warning(f"无法连接MQTT broker {self.config.broker}:{self.config.port}，稍后重试")
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         logger.warning(f"MQTT断开连接，错误码: {rc}")
+        self.disconnects += 1
+        self._connected = False
+        self._call_in_loop(self._inflight.clear)  # 未确认的消息由paho在重连后重发
+
+    def _on_publish(self, client, userdata, mid):
+        self._call_in_loop(self._on_ack, mid)
+
+    def _on_message(self, client, userdata, message):
+        if message.topic == self.config.ha_status_topic and message.payload == b"online":
+            logger.info("Home Assistant 已上线，重新发布自动发现配置")
+            for listener in list(self._birth_listeners):  # 事件循环中可能同时增删
+                self._call_in_loop(listener)
+
+    def add_birth_listener(self, listener: Callable[[], None]):
+        """注册HA上线（birth消息）时的回调，在事件循环中执行"""
+        self._birth_listeners.append(listener)
+
+    def remove_birth_listener(self, listener: Callable[[], None]):
+        with contextlib.suppress(ValueError):
+            self._birth_listeners.remove(listener)
+
+    def add_connect_listener(self, listener: Callable[[], None]):
+        """注册每次（重新）连接成功后的回调，在事件循环中执行"""
+        self._connect_listeners.append(listener)
+
+    def remove_connect_listener(self, listener: Callable[[], None]):
+        with contextlib.suppress(ValueError):
+            self._connect_listeners.remove(listener)
+
+    def _call_in_loop(self, callback, *args):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_ack(self, mid: int):
+        queued_at = self._inflight.pop(mid, None)
+        if queued_at is not None:
+            self.acked += 1
+            latency = time.monotonic() - queued_at
+            self._ack_latencies.append(latency)
+            self.ack_histogram.observe(latency)
+            self._wakeup.set()
+
+    def start(self):
+        """在事件循环中启动发送任务（可重复调用）"""
+        if self._worker is None or self._worker.done():
+            self._loop = asyncio.get_running_loop()
+            self._worker = self._loop.create_task(self._run())
+            self._worker.add_done_callback(self._on_worker_done)
+            if self._connected:
+                self._on_connected()
 
-    def publish(self, topic_suffix: str, payload: Any):
-        """发布MQTT消息"""
-        full_topic = f"{self.config.base_topic}{topic_suffix}"
-        self.client.publish(
-            full_topic,
-            payload=json.dumps(payload) if isinstance(payload, (dict, list)) else str(payload),
-            qos=self.config.qos,
-            retain=self.config.retain
-            )
-        logger.debug(f"发布到 {full_topic}: {payload}")
+    @staticmethod
+    def _on_worker_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"MQTT发送任务异常退出: {task.exception()!r}")
+
+    async def stop(self):
+        """停止发送任务并断开连接"""
+        for task in (self._replay_task, self._worker):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self._replay_task = None
+        self._worker = None
+        if self.spool is not None:
+            self.spool.seal()
+        # 正常退出不会触发遗嘱，主动发布offline
+        if self._connected:
+            info = self.client.publish(self.config.will_topic, "offline", qos=1, retain=True)
+            await asyncio.get_running_loop().run_in_executor(None, info.wait_for_publish, 2)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connected(self):
+        """（事件循环中）连接建立后：覆盖遗嘱为online并唤醒发送任务，开始补发缓存"""
+        self.enqueue(self.config.will_topic, "online", 1, True)
+        for listener in list(self._connect_listeners):
+            listener()
+        self._start_replay()
+
+    def enqueue(self, topic: str, payload: Union[str, bytes], qos: int, retain: bool,
+                spool: bool = False, coalesce: bool = True, alias: bool = False):
+        """把消息放入发送队列（不阻塞），alias=True 的高频主题在MQTT v5下使用主题别名"""
+        if spool and self.spool is not None and (not self._connected or self.spool.has_backlog):
+            self.spool.append(topic, payload, qos, retain)
+            return
+
+        if self.policy == "coalesce" and coalesce:
+            key = topic
+            if key in self._queue:
+                self.coalesced += 1
+        else:
+            self._seq += 1
+            key = self._seq
+        self._queue[key] = (topic, payload, qos, retain, alias, time.monotonic())
+
+        while len(self._queue) > self.max_queue:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue and self._connected and len(self._inflight) < self.max_inflight:
+                key, item = self._queue.popitem(last=False)
+                topic, payload, qos, retain, alias, queued_at = item
+                properties = None
+                send_topic = topic
+                if alias and self._alias_max:
+                    send_topic, properties = self._apply_alias(topic, qos)
+                try:
+                    info = self.client.publish(send_topic, payload=payload, qos=qos, retain=retain,
+                                               properties=properties)
+                except Exception as e:
+                    # 非法主题/QoS或负载过大：丢弃这一条，不能让发送任务退出
+                    logger.error(f"发布消息失败，已丢弃: {topic} ({e})")
+                    self.dropped += 1
+                    if send_topic and properties is not None and self._aliases.get(topic) == len(self._aliases):
+                        del self._aliases[topic]  # 刚分配的别名没有发出去，不能在之后只发送别名
+                    continue
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # 连接已断开，放回队首等待重连
+                    self._queue[key] = item
+                    self._queue.move_to_end(key, last=False)
+                    break
+                self.published += 1
+                self._inflight[info.mid] = queued_at
+
+    def _apply_alias(self, topic: str, qos: int):
+        """为主题分配/使用别名，返回 (实际发送的主题, PUBLISH属性)
+
+        首次发送带上主题和别名以建立映射，之后QoS 0的消息只发送别名；
+        QoS 1/2仍带上主题，因为paho在重连后会原样重发未确认的消息，而新连接里还没有这个别名。
+        """
+        aliases = self._aliases
+        alias = aliases.get(topic)
+        send_topic = topic
+        if alias is None:
+            if len(aliases) >= self._alias_max:
+                return topic, None
+            alias = aliases[topic] = len(aliases) + 1
+        elif qos == 0:
+            send_topic = ""
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.TopicAlias = alias
+        return send_topic, properties
+
+    def _start_replay(self):
+        if self.spool is not None and self.spool.has_backlog and self._replay_task is None:
+            self._replay_task = asyncio.get_running_loop().create_task(self._replay())
+
+    async def _replay(self):
+        """重连后按固定速率补发断线缓存中的消息"""
+        logger.info("开始补发断线期间缓存的消息")
+        try:
+            while self._connected:
+                path = self.spool.oldest()
+                if path is None:
+                    logger.info(f"断线缓存补发完成，累计 {self.replayed} 条")
+                    return
+                resume_path, offset = self._replay_offset
+                if resume_path != path:
+                    offset = 0
+                batch = 0
+                for offset, topic, payload, qos, retain in self.spool.read(path, offset):
+                    # 补发的历史消息不能被合并
+                    self.enqueue(topic, payload, qos, retain, coalesce=False)
+                    self._replay_offset = (path, offset)
+                    self.replayed += 1
+                    batch += 1
+                    if batch >= self.config.replay_rate:
+                        batch = 0
+                        await asyncio.sleep(1)
+                        # 等待发送队列消化，避免补发挤占队列
+                        while self._connected and len(self._queue) > self.max_queue // 2:
+                            await asyncio.sleep(1)
+                        if not self._connected:
+                            return
+                self.spool.remove(path)
+                self._replay_offset = (None, 0)
+        finally:
+            self._replay_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """发送队列的运行统计"""
+        latencies = self._ack_latencies
+        return {
+            "queue_depth": len(self._queue),
+            "inflight": len(self._inflight),
+            "published": self.published,
+            "acked": self.acked,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
+            "ack_latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "ack_latency_max": max(latencies) if latencies else 0.0,
+        }
 
-    def publish_all_sensor_configs(self):
-        """发布所有传感器的自动发现配置"""
-        configs = {
-        # 主板传感器
-        "mb_temp": {
-            "name": "主板温度",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.mb_temp }}",
-            "unique_id": f"{self.config.client_id}_mb_temp",
-
-        },
-        "mb_temp_peak": {
-            "name": "主板温度峰值",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.mb_temp_peak }}",
-            "unique_id": f"{self.config.client_id}_mb_temp_peak",
-
-        },
-
-        # CPU传感器
-        "cpu_temp": {
-            "name": "CPU温度",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_temp }}",
-            "unique_id": f"{self.config.client_id}_cpu_temp",
-
-        },
-        "cpu_temp_peak": {
-            "name": "CPU温度峰值",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_temp_peak }}",
-            "unique_id": f"{self.config.client_id}_cpu_temp_peak",
-
-        },
-        "cpu_power": {
-            "name": "CPU功耗",
-            "unit_of_meas": "W",
-            "device_class": "power",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_power }}",
-            "unique_id": f"{self.config.client_id}_cpu_power",
-
-        },
-        "cpu_power_peak": {
-            "name": "CPU功耗峰值",
-            "unit_of_meas": "W",
-            "device_class": "power",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_power_peak }}",
-            "unique_id": f"{self.config.client_id}_cpu_power_peak",
-
-        },
-        "cpu_usage": {
-            "name": "CPU使用率",
-            "unit_of_meas": "%",
-            "device_class": "power_factor",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_usage }}",
-            "unique_id": f"{self.config.client_id}_cpu_usage",
-
-        },
-        "cpu_usage_peak": {
-            "name": "CPU使用率峰值",
-            "unit_of_meas": "%",
-            "device_class": "power_factor",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_usage_peak }}",
-            "unique_id": f"{self.config.client_id}_cpu_usage_peak",
-
-        },
-        "cpu_freq": {
-            "name": "CPU频率",
-            "unit_of_meas": "GHz",
-            "icon": "mdi:speedometer",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_freq }}",
-            "unique_id": f"{self.config.client_id}_cpu_freq",
-
-        },
-        "cpu_freq_peak": {
-            "name": "CPU频率峰值",
-            "unit_of_meas": "GHz",
-            "icon": "mdi:speedometer",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.cpu_freq_peak }}",
-            "unique_id": f"{self.config.client_id}_cpu_freq_peak",
-
-        },
-
-        # 内存传感器
-        "mem_usage": {
-            "name": "内存使用率",
-            "unit_of_meas": "%",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.mem_usage }}",
-            "unique_id": f"{self.config.client_id}_mem_usage",
-
-        },
-        "mem_used": {
-            "name": "已用内存",
-            "unit_of_meas": "GB",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.mem_used }}",
-            "unique_id": f"{self.config.client_id}_mem_used",
-
-        },
-        "mem_available": {
-            "name": "可用内存",
-            "unit_of_meas": "GB",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.mem_available }}",
-            "unique_id": f"{self.config.client_id}_mem_available",
-
-        },
-
-        # 显卡传感器
-        "gpu_temp": {
-            "name": "显卡温度",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_temp }}",
-            "unique_id": f"{self.config.client_id}_gpu_temp",
-
-        },
-        "gpu_temp_peak": {
-            "name": "显卡温度峰值",
-            "unit_of_meas": "°C",
-            "device_class": "temperature",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_temp_peak }}",
-            "unique_id": f"{self.config.client_id}_gpu_temp_peak",
-
-        },
-        "gpu_power": {
-            "name": "显卡功耗",
-            "unit_of_meas": "W",
-            "device_class": "power",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_power }}",
-            "unique_id": f"{self.config.client_id}_gpu_power",
-
-        },
-        "gpu_power_peak": {
-            "name": "显卡功耗峰值",
-            "unit_of_meas": "W",
-            "device_class": "power",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_power_peak }}",
-            "unique_id": f"{self.config.client_id}_gpu_power_peak",
-
-        },
-        "gpu_usage": {
-            "name": "显卡使用率",
-            "unit_of_meas": "%",
-            "icon": "mdi:gpu",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_usage }}",
-            "unique_id": f"{self.config.client_id}_gpu_usage",
-
-        },
-        "gpu_usage_peak": {
-            "name": "显卡使用率峰值",
-            "unit_of_meas": "%",
-            "icon": "mdi:gpu",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_usage_peak }}",
-            "unique_id": f"{self.config.client_id}_gpu_usage_peak",
-
-        },
-        "gpu_vram_used": {
-            "name": "显存使用量",
-            "unit_of_meas": "GB",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_vram_used }}",
-            "unique_id": f"{self.config.client_id}_gpu_vram_used",
-
-        },
-        "gpu_vram_available": {
-            "name": "可用显存",
-            "unit_of_meas": "GB",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_vram_available }}",
-            "unique_id": f"{self.config.client_id}_gpu_vram_available",
-
-        },
-        "gpu_vram_usage": {
-            "name": "显存使用率",
-            "unit_of_meas": "%",
-            "icon": "mdi:memory",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.gpu_vram_usage }}",
-            "unique_id": f"{self.config.client_id}_gpu_vram_usage",
-
-        },
-
-        # 网络传感器
-        "net_upload": {
-            "name": "上传速度",
-            "unit_of_meas": "MB/s",
-            "icon": "mdi:upload-network",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.net_upload }}",
-            "unique_id": f"{self.config.client_id}_net_upload",
-
-        },
-        "net_download": {
-            "name": "下载速度",
-            "unit_of_meas": "MB/s",
-            "icon": "mdi:download-network",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.net_download }}",
-            "unique_id": f"{self.config.client_id}_net_download",
-
-        },
-
-        # 系统状态
-        "monitor_status": {
-            "name": "监控状态",
-            "icon": "mdi:heart-pulse",
-            "state_topic": f"{self.config.base_topic}state",
-            "value_template": "{{ value_json.status }}",
-            "unique_id": f"{self.config.client_id}_status",
 
+# ==================== 紧凑格式 ====================
+COMPACT_LAYOUTS = ("short", "positional")
+COMPACT_ENCODINGS = ("json", "msgpack", "cbor")
+_FLOAT32 = struct.Struct("<f")
+
+
+def _short_key(index: int) -> str:
+    """字段序号 -> 短键：a..z, ba, bb, ..."""
+    key = ""
+    while True:
+        index, rest = divmod(index, 26)
+        key = chr(97 + rest) + key
+        if index == 0:
+            return key
+
+
+def _single(value: Any) -> Any:
+    """浮点数截为单精度，CBOR按最短无损形式编码时只占5字节"""
+    return _FLOAT32.unpack(_FLOAT32.pack(value))[0] if isinstance(value, float) else value
+
+
+class CompactEncoder:
+    """紧凑的state负载：短键（short）或按位置（positional），可选MessagePack/CBOR编码
+
+    positional: [字段表编号, Unix时间戳, 值1, 值2, ...]，缺失的值为null；
+    short: {"_s": 字段表编号, "_t": Unix时间戳, "a": 值1, ...}，缺失的值不输出。
+    字段表（schema()）以retained消息单独发布，负载只带编号，消费者据此发现字段表变化。
+    二进制编码中浮点数使用单精度。
+    """
+    def __init__(self, fields: Sequence[str], layout: str = "positional", encoding: str = "msgpack"):
+        if layout not in COMPACT_LAYOUTS:
+            raise ValueError(f"未知的紧凑格式: {layout}")
+        if encoding not in COMPACT_ENCODINGS:
+            raise ValueError(f"未知的编码: {encoding}")
+        if (encoding == "msgpack" and msgpack is None) or (encoding == "cbor" and cbor2 is None):
+            logger.warning(f"未安装{encoding}依赖，紧凑模式改用JSON编码")
+            encoding = "json"
+        self.fields = list(fields)
+        self.layout = layout
+        self.encoding = encoding
+        self.keys = [_short_key(i) for i in range(len(self.fields))]
+        digest = hashlib.sha1("\n".join([layout, encoding, *self.fields]).encode()).hexdigest()
+        self.schema_id = int(digest[:4], 16)
+
+    def schema(self) -> Dict[str, Any]:
+        """字段表，消费者按它解码负载"""
+        result: Dict[str, Any] = {
+            "id": self.schema_id,
+            "layout": self.layout,
+            "encoding": self.encoding,
+            "fields": self.fields,
         }
+        if self.layout == "short":
+            result["keys"] = dict(zip(self.fields, self.keys))
+        return result
 
-            }
+    def encode(self, payload: Dict[str, Any], timestamp: int) -> Union[str, bytes]:
+        if self.layout == "positional":
+            obj: Any = [self.schema_id, timestamp, *[payload.get(f) for f in self.fields]]
+        else:
+            obj = {"_s": self.schema_id, "_t": timestamp}
+            for key, field_name in zip(self.keys, self.fields):
+                value = payload.get(field_name)
+                if value is not None:
+                    obj[key] = value
+        if self.encoding == "msgpack":
+            return msgpack.packb(obj, use_single_float=True)
+        if self.encoding == "cbor":
+            obj = [_single(v) for v in obj] if isinstance(obj, list) else {k: _single(v) for k, v in obj.items()}
+            return cbor2.dumps(obj, canonical=True)
+        return json_dumps(obj)
 
-        for sensor_id, config in configs.items():
-            self.publish(f"{sensor_id}/config", config)
+
+# ==================== MQTT 发布器 ====================
+class AsyncMQTTPublisher:
+    def __init__(self, config: MQTTConfig, connection: Optional[MQTTConnection] = None):
+        self.config = config
+        self.connection = connection or MQTTConnection(config)
+        self.client = self.connection.client
+        self._state_topics: Dict[str, List[str]] = {}
+        self._topic_of: Dict[str, str] = {}
+        self._compact: Dict[str, tuple] = {}
+
+    def publish(self, topic_suffix: str, payload: Any, spool: bool = False, alias: bool = False,
+                qos: Optional[int] = None, retain: Optional[bool] = None, coalesce: bool = True):
+        """发布MQTT消息（spool=True 的消息在断线期间写入磁盘缓存，alias=True 的使用v5主题别名，
+        coalesce=False 的消息即使队列中有同主题的旧消息也不会被合并）"""
+        full_topic = f"{self.config.base_topic}{topic_suffix}"
+        if isinstance(payload, (dict, list)):
+            encoded = json_dumps(payload)
+        else:
+            encoded = payload if isinstance(payload, bytes) else str(payload)
+        self.connection.enqueue(
+            full_topic,
+            encoded,
+            self.config.qos if qos is None else qos,
+            self.config.retain if retain is None else retain,
+            spool=spool,
+            coalesce=coalesce,
+            alias=alias,
+            )
+        logger.debug(f"发布到 {full_topic}: {payload}")
+
+    def set_state_topics(self, topics: Dict[str, Sequence[str]]):
+        """各state主题（如 state、state_fast）中可能出现的字段，变化时重新发布紧凑模式的字段表"""
+        self._state_topics = {topic: list(fields) for topic, fields in topics.items()}
+        self._topic_of = {field_name: topic for topic, fields in topics.items() for field_name in fields}
+        self._compact = {}
+
+    def publish_state(self, payload: Dict[str, Any], topic: str = "state"):
+        """发布一条state：默认为HA使用的JSON，紧凑模式下按字段表编码
+
+        分组主题 state_<name> 在紧凑模式下对应 <compact_topic>_<name> 和 schema_<name>。
+        """
+        config = self.config
+        if not config.compact:
+            self.publish(topic, payload, spool=True, alias=True)
+            return
+        suffix = topic[len("state"):]
+        key = (config.compact, config.compact_encoding)
+        cached = self._compact.get(topic)
+        if cached is None or cached[0] != key:
+            encoder = CompactEncoder(self._state_topics.get(topic, ()), config.compact, config.compact_encoding)
+            self._compact[topic] = (key, encoder)
+            self.publish(f"schema{suffix}", encoder.schema())
+        else:
+            encoder = cached[1]
+        self.publish(f"{config.compact_topic}{suffix}", encoder.encode(payload, int(time.time())),
+                     spool=True, alias=True, qos=config.compact_qos)
+
+    def publish_event(self, event: Dict[str, Any]):
+        """发布告警事件到 <base_topic>event：不保留、不合并，断线期间写入磁盘缓存"""
+        self.publish("event", event, spool=True, retain=False, coalesce=False)
+
+    def publish_all_sensor_configs(self, specs: Sequence[SensorSpec], force: bool = False):
+        """发布传感器的自动发现配置
+
+        与上次发布内容相同的配置会跳过（按内容哈希判断，重启后依然有效）；
+        force=True 时全部重新发布，用于HA重启后（homeassistant/status 收到 online）。
+        不再存在的传感器会发布空配置，从HA中移除。
+        """
+        cache = self.connection.discovery_cache
+        prefix = self.config.base_topic
+        availability = [self.connection.config.will_topic, self.config.availability_topic]
+        current = set()
+        published = 0
+        for spec in specs:
+            topic_suffix = f"{spec.object_id}/config"
+            current.add(f"{prefix}{topic_suffix}")
+            config = spec.discovery_config(self.config, availability, self._topic_of.get(spec.field, "state"))
+            if cache.update(f"{prefix}{topic_suffix}", config) or force:
+                self.publish(topic_suffix, config)
+                published += 1
+
+        for topic in cache.stale(prefix, current):
+            self.publish(topic[len(prefix):], "")
+            cache.remove(topic)
+        cache.save()
+        logger.info(f"发布自动发现配置 {published}/{len(specs)} 条（{prefix}）")
+
+    def forget_sensor_configs(self):
+        """只清除本机在自动发现缓存中的记录，不发布：主机转移到其它进程后由那边发布，
+        转回来时需要重新发布（保留的配置中可用性主题是另一个进程的）"""
+        cache = self.connection.discovery_cache
+        for topic in cache.stale(self.config.base_topic, set()):
+            cache.remove(topic)
+        cache.save()
 
 
 # ==================== 硬件监控器 ====================
 class HardwareMonitor:
-    def __init__(self, url: str, interval: int = 2):
+    def __init__(self, url: str, interval: int = 2, name: Optional[str] = None,
+                 mqtt: Optional[AsyncMQTTPublisher] = None,
+                 semaphore: Optional[asyncio.Semaphore] = None,
+                 streaming: bool = False,
+                 deadbands: Optional[Dict[str, Deadband]] = None,
+                 refresh_interval: float = 60,
+                 rollup_fields: Sequence[str] = DEFAULT_ROLLUP_FIELDS,
+                 adaptive: bool = False,
+                 min_interval: Optional[float] = None,
+                 max_interval: Optional[float] = None,
+                 auto_discover: bool = False,
+                 include: Sequence[str] = DEFAULT_AUTO_INCLUDE,
+                 exclude: Sequence[str] = (),
+                 failure_threshold: int = 1,
+                 reset_timeout: float = 5,
+                 offloader: Optional[ParseOffloader] = None,
+                 groups: Sequence[SensorGroup] = (),
+                 alert_rules: Sequence[AlertRule] = (),
+                 capture_dir: str = "",
+                 replay: Optional[ReplaySource] = None,
+                 sensor_rules: Optional[Dict[str, SensorRule]] = None,
+                 rescan_interval: float = 300):
         self.url = url
         self.interval = interval
-        self.mqtt = AsyncMQTTPublisher(MQTTConfig())
+        self._groups: List[GroupBuffer] = []
+        self.scheduler = PollScheduler(
+            self._set_group_defs(groups), adaptive=adaptive, min_interval=min_interval, max_interval=max_interval)
+        self.name = name or url
+        self.mqtt = mqtt or AsyncMQTTPublisher(MQTTConfig(name))
+        self._semaphore = semaphore  # 多主机模式下限制同时进行的请求数
+        self.session: Optional[aiohttp.ClientSession] = None  # 多主机模式下由FleetMonitor注入共享会话
+        self.last_timings: Optional[PollTimings] = None
+        self.stage_histograms = {stage: Histogram() for stage in POLL_STAGES}
+        self.last_parse_nodes = 0  # 最近一次解析访问的节点数
+        self.full_scans = 0  # 完整遍历传感器树的次数
+        # 传感器映射：默认使用内置的 SENSOR_RULES，配置文件可以整体替换
+        self._rules = SENSOR_RULES if sensor_rules is None else dict(sensor_rules)
+        self._dispatch = SENSOR_DISPATCH if sensor_rules is None else SensorDispatch(self._rules, SENSOR_EXCLUDES)
+        self._sensor_paths = None  # 缓存的传感器节点路径
+        self.rescan_interval = rescan_interval  # 定时完整遍历一次，发现路径缓存校验不到的新传感器
+        self._rescan_at = 0.0
+        self.streaming = streaming  # 流式解析：只提取需要的传感器，取齐后停止读取
+        self.offloader = offloader or DEFAULT_OFFLOADER  # 大响应在进程池中解析
+
+        # 录制：每次请求的原始响应写入 <capture_dir>/<client_id>-<启动时间>.capture.gz；回放：用录制的响应代替HTTP请求
+        self.capture: Optional[CaptureLog] = None
+        if capture_dir:
+            self.capture = CaptureLog(os.path.join(capture_dir, self.mqtt.config.client_id))
+            if streaming:
+                logger.warning(f"[{self.name}] 录制需要完整的响应，已关闭流式解析")
+                self.streaming = False
+        self.replay = replay
+
+        # 自动发现：首次取到数据时枚举全部传感器，按include/exclude规则选出需要发布的
+        self.auto_discover = auto_discover
+        self._include = GlobTrie(include)
+        self._exclude = GlobTrie(exclude)
+        self.sensor_index: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+        self._discovered_specs: List[SensorSpec] = []
+        self._discovered_ids: Optional[frozenset] = None
+
+        # 死区发布：传入各字段的死区后只在数值变化超过死区时发布，每refresh_interval秒强制刷新一次
+        self._deadbands: Dict[str, DeadbandFilter] = {}  # 每个分组的state主题一个，由_build_groups创建
+        self._deadband_settings = None
+        if deadbands is not None:
+            # 统计项沿用原字段的死区
+            deadbands = {
+                **{key: deadbands[f] for f in rollup_fields if f in deadbands for key in rollup_keys(f)},
+                **deadbands,
+            }
+            self._deadband_settings = (deadbands, refresh_interval)
+
+        # 本主机发布的全部传感器及其数值（预分配的状态数组）
+        self._rollup_fields = tuple(rollup_fields)
+        self._alert_rules = tuple(alert_rules)
+        self.state: Optional[SensorState] = None
+        self.alerts: Optional[AlertEngine] = None
+        self.integrator: Optional[Integrator] = None
+        self._build_sensor_specs()
 
-        # 初始化数据结构
-        self.motherboard = MotherboardStats()
-        self.cpu = CPUStats()
-        self.memory = MemoryStats()
-        self.gpu = GPUStats()
-        self.network = NetworkStats()
+        # 滚动统计：为这些字段计算1分钟/5分钟/1小时的最低、最高、平均值
+        capacity = self._rollup_capacity()
+        self._rollups = {field_name: RollingStats(ROLLUP_WINDOWS, capacity) for field_name in rollup_fields}
 
         self._running = False
         self._last_update = None
         self._connection_failures = 0  # 跟踪连续失败次数
-        self.MAX_FAILURES = 1  # 失败1次后立即标记为离线
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)  # 失败1次后立即标记为离线
+        self._available: Optional[bool] = None  # 最近一次发布的可用性
+
+        # 数据更新或离线时递增revision并通知监听者（快照服务），没有监听者时不产生额外开销
+        self.revision = 0
+        self.update_listeners: List[Callable[["HardwareMonitor"], None]] = []
 
     async def start(self):
         """启动监控服务"""
         self._running = True
-        self.mqtt.publish_all_sensor_configs()
+        owns_session = self.session is None
+        if owns_session:
+            self.session = create_http_session()
+        self.mqtt.connection.start()
+        self.mqtt.connection.add_birth_listener(self._on_ha_birth)
+        self.mqtt.connection.add_connect_listener(self._republish_availability)
+        self.mqtt.publish_all_sensor_configs(self.sensor_specs)
 
-        while self._running:
-            try:
-                await self._update()
-                self._connection_failures = 0  # 成功则重置失败计数
-                await asyncio.sleep(self.interval)
-            except Exception as e:
-                logger.error(f"监控循环错误: {str(e)}")
-                self._connection_failures += 1
-                if self._connection_failures >= self.MAX_FAILURES:
-                    self._set_offline_state()
-                await asyncio.sleep(5)  # 错误后等待5秒重试
+        try:
+            if self.replay is None:
+                await asyncio.sleep(self.scheduler.initial_delay())
+            while self._running and not (self.replay is not None and self.replay.done):
+                if not self.breaker.allow():
+                    # 熔断期间不请求也不发布，等到可以探测时再试
+                    await asyncio.sleep(self.breaker.retry_in())
+                    continue
+                try:
+                    await self._update()
+                    self._connection_failures = 0  # 成功则重置失败计数
+                    self.breaker.record_success()
+                    self._set_available(True)
+                    self._notify()
+                except Exception as e:
+                    # 只在进入熔断时记录ERROR，熔断期间的探测失败和未达阈值的失败只记DEBUG
+                    self._connection_failures += 1
+                    if self.breaker.record_failure():
+                        logger.error(f"[{self.name}] 监控循环错误: {str(e)}，"
+                                     f"{self.breaker.retry_in():.1f}s后探测")
+                        self._set_offline_state()
+                    else:
+                        logger.debug(f"[{self.name}] 轮询失败: {str(e)}")
+                    if self.breaker.state == CircuitBreaker.OPEN:
+                        continue  # 由熔断器负责退避
+                    # 未达到熔断阈值的失败按正常间隔重试
+                if self.replay is not None:
+                    await asyncio.sleep(self.replay.next_delay())  # 回放按录制时的节奏
+                else:
+                    await asyncio.sleep(self.scheduler.next_delay())
+        finally:
+            self._remove_listeners()
+            self.integrator.save()
+            if self.capture is not None:
+                self.capture.close()
+            if owns_session:
+                await self.session.close()
+                self.session = None
+
+    def stop(self):
+        """停止监控循环（当前这一轮结束后退出）"""
+        self._running = False
+
+    def _on_ha_birth(self):
+        """HA重启后重新发布自动发现配置和可用性"""
+        self.mqtt.publish_all_sensor_configs(self.sensor_specs, force=True)
+        self._republish_availability()
+
+    def _republish_availability(self):
+        """重新发布当前的可用性：broker重启丢失了retained消息时，不必等到下次变化"""
+        if self._available is not None:
+            self.mqtt.publish("availability", "online" if self._available else "offline")
+
+    def _remove_listeners(self):
+        connection = self.mqtt.connection
+        connection.remove_birth_listener(self._on_ha_birth)
+        connection.remove_connect_listener(self._republish_availability)
 
     def _set_offline_state(self):
-        """将所有数据设置为离线状态（0）并发布到MQTT"""
-        offline_value = 0  # 改为0而不是"--"
-
-        # 重置所有数据为0
-        self.motherboard.temp_current = offline_value
-        self.motherboard.temp_peak = offline_value
-
-        self.cpu.temp_current = offline_value
-        self.cpu.temp_peak = offline_value
-        self.cpu.power_current = offline_value
-        self.cpu.power_peak = offline_value
-        self.cpu.usage_current = offline_value
-        self.cpu.usage_peak = offline_value
-        self.cpu.frequency = offline_value
-        self.cpu.peak_frequency = offline_value
-
-        self.memory.usage = offline_value
-        self.memory.used = offline_value
-        self.memory.available = offline_value
-
-        self.gpu.temp_current = offline_value
-        self.gpu.temp_peak = offline_value
-        self.gpu.power_current = offline_value
-        self.gpu.power_peak = offline_value
-        self.gpu.usage_current = offline_value
-        self.gpu.usage_peak = offline_value
-        self.gpu.vram_used = offline_value
-        self.gpu.vram_available = offline_value
-        self.gpu.vram_usage = offline_value
-
-        self.network.upload_speed = offline_value
-        self.network.download_speed = offline_value
-
-        # 发布离线状态（确保MQTT消息包含所有字段）
-        payload = {
-            "timestamp": datetime.now().isoformat(),
-            "mb_temp": self.motherboard.temp_current,
-            "mb_temp_peak": self.motherboard.temp_peak,
-
-            "cpu_temp": self.cpu.temp_current,
-            "cpu_temp_peak": self.cpu.temp_peak,
-            "cpu_power": self.cpu.power_current,
-            "cpu_power_peak": self.cpu.power_peak,
-            "cpu_usage": self.cpu.usage_current,
-            "cpu_usage_peak": self.cpu.usage_peak,
-            "cpu_freq": self.cpu.frequency,
-            "cpu_freq_peak": self.cpu.peak_frequency,
-
-            "mem_usage": self.memory.usage,
-            "mem_used": self.memory.used,
-            "mem_available": self.memory.available,
-
-            "gpu_temp": self.gpu.temp_current,
-            "gpu_temp_peak": self.gpu.temp_peak,
-            "gpu_power": self.gpu.power_current,
-            "gpu_power_peak": self.gpu.power_peak,
-            "gpu_usage": self.gpu.usage_current,
-            "gpu_usage_peak": self.gpu.usage_peak,
-            "gpu_vram_used": self.gpu.vram_used,
-            "gpu_vram_available": self.gpu.vram_available,
-            "gpu_vram_usage": self.gpu.vram_usage,
-
-            "net_upload": self.network.upload_speed,
-            "net_download": self.network.download_speed,
-            "status": "OFFLINE"  # 明确标记为离线
+        """标记主机离线：只发布一条retained的offline，保留最后一次的传感器数据"""
+        self._set_available(False)
+        for deadband in self._deadbands.values():
+            deadband.reset()  # 恢复后立即发布完整数据
+        self._notify()
+
+    def _notify(self):
+        self.revision += 1
+        for listener in self.update_listeners:
+            listener(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """最近一次解析的全部数据（与state负载的字段一致，缺失的字段不输出）"""
+        result: Dict[str, Any] = {
+            "timestamp": self._last_update.isoformat() if self._last_update is not None else None,
+            "status": "ONLINE" if self._available else "OFFLINE",
         }
-        self.mqtt.publish("state", payload)  # 确保MQTT消息发送成功
+        for field_name, value in zip(self.state.layout.fields, self.state.values):
+            if value == value:
+                result[field_name] = value
+        for field_name, stats in self._rollups.items():
+            result.update(stats.summary(field_name))
+        return result
+
+    def _set_available(self, available: bool):
+        """可用性变化时发布到 <base_topic>availability"""
+        if self._available != available:
+            self._available = available
+            self.mqtt.publish("availability", "online" if available else "offline")
 
     async def _update(self):
-        """更新所有传感器数据"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.url, timeout=3) as response:
+        """更新所有传感器数据（失败时抛出异常，由监控循环按熔断器状态记录日志）"""
+        started = time.perf_counter()
+        timings = PollTimings()
+        # 自动发现需要完整的树，首次请求不使用流式解析
+        streaming = (self.streaming and self.replay is None
+                     and (not self.auto_discover or self._discovered_ids is not None))
+        if self.replay is not None:
+            raw = self.replay.read()
+        else:
+            async with self._semaphore or contextlib.nullcontext():
+                async with self.session.get(self.url, trace_request_ctx=timings) as response:
                     if response.status != 200:
                         raise ConnectionError(f"HTTP状态码异常: {response.status}")
-                    data = await response.json()
-                    self._parse_data(data)
-                    self._publish_all_data()
-                    self._last_update = datetime.now()
-        except Exception as e:
-            logger.error(f"数据更新失败: {str(e)}")
-            raise
+                    if streaming:
+                        matches = await self._read_streaming(response, timings)
+                    else:
+                        t0 = time.perf_counter()
+                        raw = await response.read()
+                        timings.body = time.perf_counter() - t0
+            if self.capture is not None:
+                self.capture.append(raw, time.monotonic())
+        if not streaming:
+            if self._sensor_paths is not None and time.monotonic() >= self._rescan_at:
+                self._sensor_paths = None
+            t0 = time.perf_counter()
+            if self.offloader.should_offload(len(raw)):
+                matches = (await self._extract_offloaded(raw)).matches
+            else:
+                data = json_loads(raw)
+                matches = None
+            timings.decode = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        if matches is not None:
+            self._apply_matches(matches)
+        else:
+            self._parse_data(data)
+        self.integrator.update(self.state.values, time.monotonic())
+        t1 = time.perf_counter()
+        self._publish_all_data()
+        timings.parse = t1 - t0
+        timings.publish = time.perf_counter() - t1
+        self.last_timings = timings
+        self._last_update = datetime.now()
+        self._observe_timings(timings, time.perf_counter() - started)
+        logger.debug(
+            f"[{self.name}] 请求耗时: 连接 {timings.connect * 1000:.1f}ms, "
+            f"首字节 {timings.first_byte * 1000:.1f}ms, 读取 {timings.body * 1000:.1f}ms, "
+            f"解析 {timings.decode * 1000:.1f}ms, 提取 {timings.parse * 1000:.1f}ms, "
+            f"发布 {timings.publish * 1000:.1f}ms"
+        )
+
+    async def _read_streaming(self, response: aiohttp.ClientResponse, timings: PollTimings):
+        """边读边解析响应体，所需传感器全部取到后不再读取剩余部分"""
+        parser = StreamingSensorParser(self._dispatch)
+        t0 = time.perf_counter()
+        async for chunk in response.content.iter_any():
+            t1 = time.perf_counter()
+            done = parser.feed(chunk)
+            timings.decode += time.perf_counter() - t1
+            if done:
+                # 提前结束会关闭这条连接，下次请求需要重新建立
+                break
+        timings.body = time.perf_counter() - t0 - timings.decode
+        self.last_parse_nodes = parser.leaves
+        return parser.matches
+
+    def _build_sensor_specs(self):
+        """汇总本主机发布的传感器：内置定义 + 滚动统计 + 自动发现"""
+        self.sensor_specs = list(SENSOR_SCHEMA)
+        for spec in SENSOR_SCHEMA:
+            if spec.field in self._rollup_fields:
+                self.sensor_specs.extend(rollup_specs(spec))
+        self.sensor_specs.extend(self._discovered_specs)
+
+        # 内置传感器的下标不变，视图可以直接绑定到新数组上
+        self.state = SensorState(StateLayout(self.sensor_specs), self.state)
+        values = self.state.values
+        self.motherboard = MotherboardStats(values)
+        self.cpu = CPUStats(values)
+        self.memory = MemoryStats(values)
+        self.gpu = GPUStats(values)
+        self.network = NetworkStats(values)
+        self.alerts = AlertEngine(self._alert_rules, self.state.layout, self.alerts)
+        if self.integrator is None:
+            self.integrator = Integrator(INTEGRALS, self.state.layout, self.mqtt.config.totals_file,
+                                         max_gap=self._integration_gap())
+        else:
+            self.integrator.bind(self.state.layout)
+        self._build_groups()
+
+    def _rollup_capacity(self) -> int:
+        """滚动统计缓冲区的容量：最长窗口内按最短轮询间隔能采到的样本数"""
+        scheduler = self.scheduler
+        shortest_interval = scheduler.min_interval if scheduler.adaptive else scheduler.base_interval
+        return int(max(ROLLUP_WINDOWS.values()) / shortest_interval) + 1
+
+    def _integration_gap(self) -> float:
+        """累计量允许的最大采样间隔：比最长轮询间隔宽裕，超过时视为中断（如主机离线）"""
+        scheduler = self.scheduler
+        longest_interval = scheduler.max_interval if scheduler.adaptive else scheduler.base_interval
+        return max(60, 3 * longest_interval)
+
+    def _set_group_defs(self, groups: Sequence[SensorGroup]) -> float:
+        """设置传感器分组，返回轮询间隔：按最快的分组轮询，一次请求的数据供当时到期的所有分组使用"""
+        self._group_defs = tuple(groups)
+        if not self._group_defs:
+            # 未配置分组时每次轮询都采样并发布
+            self._default_group = SensorGroup("", ("*",), 0, aggregate="last")
+            return self.interval
+        self._default_group = SensorGroup("", ("*",), self.interval, aggregate="last")
+        return min(self.interval, *(g.sample_interval for g in groups), *(g.publish_every for g in groups))
+
+    def reconfigure(self, interval: Optional[float] = None,
+                    sensor_rules: Optional[Dict[str, SensorRule]] = None,
+                    groups: Optional[Sequence[SensorGroup]] = None,
+                    alert_rules: Optional[Sequence[AlertRule]] = None):
+        """热重载：在两轮轮询之间替换映射、调度、分组和告警规则（None表示不变），连接不受影响"""
+        if interval is not None or groups is not None:
+            if interval is not None:
+                self.interval = interval
+            self.scheduler.set_interval(self._set_group_defs(self._group_defs if groups is None else groups))
+            # 间隔缩短后原来的缓冲区装不下最长窗口的样本，扩容并保留已有样本
+            capacity = self._rollup_capacity()
+            for field_name, stats in self._rollups.items():
+                if stats.capacity < capacity:
+                    self._rollups[field_name] = stats.resized(capacity)
+            self.integrator.max_gap = self._integration_gap()
+            self._build_groups()
+        if sensor_rules is not None and sensor_rules != self._rules:
+            self._rules = dict(sensor_rules)
+            # 映射变化后旧映射写入的数值不再更新，全部清空等下一轮重新取值（累计量由积分器重新写入）
+            for i in range(len(self.state.values)):
+                self.state.values[i] = NAN
+            self._discovered_ids = None
+            if self.sensor_index:
+                self._discover(self.sensor_index)
+            else:
+                self._dispatch = SensorDispatch(self._rules, SENSOR_EXCLUDES, self.state.layout)
+                self._sensor_paths = None
+        if alert_rules is not None:
+            self._alert_rules = tuple(alert_rules)
+            self.alerts = AlertEngine(self._alert_rules, self.state.layout, self.alerts)
+        # 分组变化时state主题随之变化，内容未变的自动发现配置会被跳过
+        self.mqtt.publish_all_sensor_configs(self.sensor_specs)
+
+    def _build_groups(self):
+        """按分组规则划分state字段（先匹配的分组优先，其余归入默认分组），统计项跟随原字段"""
+        groups = (*self._group_defs, self._default_group)
+        assigned: Dict[str, List[str]] = {group.name: [] for group in groups}
+        topic_of: Dict[str, str] = {}
+        for field_name in self.state.layout.fields:
+            group = next(group for group in groups if group.matches(field_name))
+            assigned[group.name].append(field_name)
+            topic_of[field_name] = group.topic
+            if field_name in self._rollup_fields:
+                topic_of.update(dict.fromkeys(rollup_keys(field_name), group.topic))
+
+        if self._deadband_settings is not None:
+            for group in groups:
+                if group.topic not in self._deadbands:
+                    self._deadbands[group.topic] = DeadbandFilter(*self._deadband_settings)
+        previous = {buffer.group.name: buffer for buffer in self._groups}
+        self._groups = [
+            GroupBuffer(group, assigned[group.name], self.state.layout, previous.get(group.name))
+            for group in (self._default_group, *self._group_defs)
+        ]
+        topics: Dict[str, List[str]] = {group.topic: [] for group in groups}
+        for spec in self.sensor_specs:
+            topics[topic_of.get(spec.field, "state")].append(spec.field)
+        self.mqtt.set_state_topics(topics)
+
+    def _discover(self, sensor_index: Dict[str, Dict[str, List[Dict[str, Any]]]]):
+        """按规则从传感器索引中选择传感器，选中的集合变化时更新映射和自动发现配置"""
+        self.sensor_index = sensor_index
+        selected = []
+        for by_type in self.sensor_index.values():
+            for sensor_type, sensors in by_type.items():
+                for sensor in sensors:
+                    sensor_id = sensor["sensor_id"]
+                    if sensor_id in self._rules or sensor_id in SENSOR_EXCLUDES:
+                        continue  # 已由内置规则处理
+                    if self._include.match(sensor_id) and not self._exclude.match(sensor_id):
+                        selected.append((sensor_type, sensor))
+
+        selected_ids = frozenset(sensor["sensor_id"] for _, sensor in selected)
+        if selected_ids == self._discovered_ids:
+            return
+        self._discovered_ids = selected_ids
+
+        rules = dict(self._rules)
+        specs = []
+        for sensor_type, sensor in selected:
+            field_name = sensor_field_name(sensor["sensor_id"])
+            rules[sensor["sensor_id"]] = SensorRule("discovered", field_name)
+            specs.append(SensorSpec(field_name, sensor["name"], field_name, ("discovered", field_name),
+                                    unit=sensor["unit"], device_class=LHM_DEVICE_CLASSES.get(sensor_type)))
+        self._discovered_specs = specs
+        self._build_sensor_specs()
+        self._dispatch = SensorDispatch(rules, SENSOR_EXCLUDES, self.state.layout)
+        self._sensor_paths = None
+        logger.info(f"[{self.name}] 自动发现 {len(specs)} 个传感器")
+        if self._running:
+            self.mqtt.publish_all_sensor_configs(self.sensor_specs)
+
+    async def _extract_offloaded(self, raw: bytes) -> ExtractResult:
+        """在进程池中解析并提取传感器，自动发现改变了规则时用新规则再提取一次"""
+        while True:
+            dispatch = self._dispatch
+            result = await self.offloader.extract(raw, dispatch, self._sensor_paths, self.auto_discover)
+            if result.sensor_index is not None:
+                self._discover(result.sensor_index)
+                if self._dispatch is not dispatch:
+                    continue
+            if result.sensor_paths is not None:
+                self._sensor_paths = result.sensor_paths
+                self.full_scans += 1
+                self._rescan_at = time.monotonic() + self.rescan_interval
+            self.last_parse_nodes = result.visited
+            return result
+
+    def _observe_timings(self, timings: PollTimings, total: float):
+        histograms = self.stage_histograms
+        histograms["fetch"].observe(timings.connect + timings.first_byte + timings.body)
+        histograms["decode"].observe(timings.decode)
+        histograms["parse"].observe(timings.parse)
+        histograms["publish"].observe(timings.publish)
+        histograms["total"].observe(total)
 
     def _parse_data(self, node: dict):
         """解析原始JSON数据"""
-        # 重置临时数据
-        self.cpu._core_freqs = []
-        self.cpu._peak_core_freqs = []
-
-        def _scan(n: dict):
-            sensor_id = n.get("SensorId", "")
-            value = self._extract_value(n.get("Value"))
-            max_val = self._extract_value(n.get("Max"))
-
-            # 主板温度
-            if sensor_id == "/lpc/nct6687d/0/temperature/1":
-                self.motherboard.temp_current = value
-                self.motherboard.temp_peak = max_val
-
-            # CPU数据
-            elif sensor_id == "/amdcpu/0/temperature/2":
-                self.cpu.temp_current = value
-                self.cpu.temp_peak = max_val
-            elif sensor_id == "/amdcpu/0/power/0":
-                self.cpu.power_current = value
-                self.cpu.power_peak = max_val
-            elif sensor_id == "/amdcpu/0/load/0":
-                self.cpu.usage_current = value
-                self.cpu.usage_peak = max_val
-            elif sensor_id.startswith("/amdcpu/0/clock/") and sensor_id != "/amdcpu/0/clock/0":
-                if value is not None:
-                    self.cpu._core_freqs.append(value)
-                if max_val is not None:
-                    self.cpu._peak_core_freqs.append(max_val)
-
-            # 内存数据
-            elif sensor_id == "/ram/load/0":
-                self.memory.usage = value
-            elif sensor_id == "/ram/data/0":
-                self.memory.used = value
-            elif sensor_id == "/ram/data/1":
-                self.memory.available = value
-
-            # 显卡数据
-            elif sensor_id == "/gpu-amd/0/temperature/0":
-                self.gpu.temp_current = value
-                self.gpu.temp_peak = max_val
-            elif sensor_id == "/gpu-amd/0/power/3":
-                self.gpu.power_current = value
-                self.gpu.power_peak = max_val
-            elif sensor_id == "/gpu-amd/0/load/0":
-                self.gpu.usage_current = value
-                self.gpu.usage_peak = max_val
-            elif sensor_id == "/gpu-amd/0/smalldata/0":
-                self.gpu.vram_used = value /1024
-            elif sensor_id == "/gpu-amd/0/smalldata/1":
-                self.gpu.vram_available = value /1024
-                if self.gpu.vram_used is not None and self.gpu.vram_available is not None:
-                    total = self.gpu.vram_used + self.gpu.vram_available
-                    if total > 0:
-                        self.gpu.vram_usage = (self.gpu.vram_used / total) * 100
-
-            # 网络数据
-            elif sensor_id == "/nic/%7B3946F6E6-AFE8-4E7E-8839-2719C6CFA81C%7D/throughput/7":
-                self.network.upload_speed = value
-            elif sensor_id == "/nic/%7B3946F6E6-AFE8-4E7E-8839-2719C6CFA81C%7D/throughput/8":
-                self.network.download_speed = value
-
-            # 递归扫描子节点
-            if "Children" in n:
-                for child in n["Children"]:
-                    _scan(child)
-
-        _scan(node)
-
-        # 计算CPU频率
-        if self.cpu._core_freqs:
-            self.cpu.frequency = sum(self.cpu._core_freqs) / len(self.cpu._core_freqs) /1024
-        if self.cpu._peak_core_freqs:
-            self.cpu.peak_frequency = sum(self.cpu._peak_core_freqs) / len(self.cpu._peak_core_freqs) /1024
+        # 优先按缓存的路径直接取值，树结构变化时回退到完整遍历
+        matches = self._resolve_cached_paths(node) if self._sensor_paths else None
+        if matches is None:
+            if self.auto_discover:
+                self._discover(discover_sensors(node))
+            matches, self._sensor_paths = self._scan_tree(node)
+            self.full_scans += 1
+            self._rescan_at = time.monotonic() + self.rescan_interval
+        self._apply_matches(matches)
+
+    def _apply_matches(self, matches):
+        """把匹配到的传感器节点原地写入状态数组并计算汇总值"""
+        state = self.state
+        sums, counts = state.sums, state.counts
+        collect_slots = self._dispatch.collect_slots
+        for slot in collect_slots:
+            sums[slot] = 0.0
+            counts[slot] = 0.0
+
+        for rule, n in matches:
+            self._apply_rule(rule, self._extract_value(n.get("Value")), self._extract_value(n.get("Max")))
+
+        # 通配规则取平均（如各核心频率 -> CPU频率），本轮没有取到时保留上次的值
+        values = state.values
+        for slot in collect_slots:
+            if counts[slot]:
+                values[slot] = sums[slot] / counts[slot]
+
+        # 计算显存使用率
+        if self.gpu.vram_used is not None and self.gpu.vram_available is not None:
+            total = self.gpu.vram_used + self.gpu.vram_available
+            if total > 0:
+                self.gpu.vram_usage = (self.gpu.vram_used / total) * 100
+
+    def _scan_tree(self, root: dict):
+        """完整遍历传感器树，返回匹配到的节点以及它们的路径"""
+        matches, sensor_paths, self.last_parse_nodes = scan_tree(root, self._dispatch)
+        return matches, sensor_paths
+
+    def _resolve_cached_paths(self, root: dict):
+        """按缓存路径取节点，任一路径失效（结构变化）时返回None"""
+        result = resolve_cached_paths(root, self._dispatch, self._sensor_paths)
+        if result is None:
+            return None
+        matches, self.last_parse_nodes = result
+        return matches
+
+    def _apply_rule(self, rule: SlotRule, value: Optional[float], max_val: Optional[float]):
+        """把一个传感器的数值写入状态数组"""
+        value_slot, max_slot, scale, collect = rule
+        if scale != 1:
+            value = value * scale if value is not None else None
+            max_val = max_val * scale if max_val is not None else None
+        if collect:
+            state = self.state
+            if value is not None and value_slot >= 0:
+                state.sums[value_slot] += value
+                state.counts[value_slot] += 1
+            if max_val is not None and max_slot >= 0:
+                state.sums[max_slot] += max_val
+                state.counts[max_slot] += 1
+            return
+        values = self.state.values
+        if value_slot >= 0:
+            values[value_slot] = NAN if value is None else value
+        if max_slot >= 0:
+            values[max_slot] = NAN if max_val is None else max_val
 
     def _publish_all_data(self):
-        """发布所有传感器数据到MQTT"""
-        payload = {
-            "timestamp": datetime.now().isoformat(),
-            "mb_temp": self.motherboard.temp_current,
-            "mb_temp_peak": self.motherboard.temp_peak,
-
-            "cpu_temp": self.cpu.temp_current,
-            "cpu_temp_peak": self.cpu.temp_peak,
-            "cpu_power": self.cpu.power_current,
-            "cpu_power_peak": self.cpu.power_peak,
-            "cpu_usage": self.cpu.usage_current,
-            "cpu_usage_peak": self.cpu.usage_peak,
-            "cpu_freq": self.cpu.frequency,
-            "cpu_freq_peak": self.cpu.peak_frequency,
-
-            "mem_usage": self.memory.usage,
-            "mem_used": self.memory.used,
-            "mem_available": self.memory.available,
-
-            "gpu_temp": self.gpu.temp_current,
-            "gpu_temp_peak": self.gpu.temp_peak,
-            "gpu_power": self.gpu.power_current,
-            "gpu_power_peak": self.gpu.power_peak,
-            "gpu_usage": self.gpu.usage_current,
-            "gpu_usage_peak": self.gpu.usage_peak,
-            "gpu_vram_used": self.gpu.vram_used,
-            "gpu_vram_available": self.gpu.vram_available,
-            "gpu_vram_usage": self.gpu.vram_usage,
-
-            "net_upload": self.network.upload_speed,
-            "net_download": self.network.download_speed,
-
-            "status": "ONLINE"
-            }
-
-        # 清理None值
-        payload = {k: v for k, v in payload.items() if v is not None}
-        self.mqtt.publish("state", payload)
+        """检查告警规则，本轮数据交给到期采样的分组，再发布到期的分组"""
+        self.scheduler.observe(self.state)
+        now = time.monotonic()
+        for event in self.alerts.evaluate(self.state.values, now):
+            logger.warning(f"[{self.name}] 告警 {event['rule']} {event['state']}: "
+                           f"{event['field']} = {event['value']:.2f}（阈值 {event['threshold']}）")
+            self.mqtt.publish_event({"timestamp": datetime.now().isoformat(), **event})
+        tolerance = self.scheduler.interval / 2  # 轮询时刻的抖动
+        values = self.state.values
+        for buffer in self._groups:
+            if now + tolerance >= buffer.next_sample:
+                buffer.sample(values)
+                buffer.next_sample = next_deadline(buffer.next_sample, buffer.group.sample_interval, now)
+                # 滚动统计
+                for field_name, slot in zip(buffer.fields, buffer.slots):
+                    stats = self._rollups.get(field_name)
+                    if stats is not None and values[slot] == values[slot]:
+                        stats.push(now, values[slot])
+
+        for buffer in self._groups:
+            if now + tolerance >= buffer.next_publish:
+                buffer.next_publish = next_deadline(buffer.next_publish, buffer.group.publish_every, now)
+                self._publish_group(buffer, "ONLINE")
+
+    def _publish_group(self, buffer: GroupBuffer, status: str):
+        """组装并发布一个分组的state（默认分组带status字段），缺失（NaN）的字段不输出"""
+        payload = {"timestamp": datetime.now().isoformat()}
+        payload.update(buffer.flush(self.state.values))
+        if buffer.group is self._default_group:
+            payload["status"] = status
+        for field_name in buffer.fields:
+            stats = self._rollups.get(field_name)
+            if stats is not None:
+                payload.update(stats.summary(field_name))
+
+        # 死区模式下变化不足时跳过本次发布
+        topic = buffer.group.topic
+        deadband = self._deadbands.get(topic)
+        if deadband is not None and not deadband.should_publish(payload):
+            return
+        self.mqtt.publish_state(payload, topic)
 
     @staticmethod
     def _extract_value(value: Optional[str]) -> Optional[float]:
@@ -612,13 +2772,1067 @@ class HardwareMonitor:
             return None
 
 
+# ==================== 快照服务 ====================
+class SnapshotServer:
+    """在本地HTTP端口提供各主机最近一次解析的数据，仪表盘和脚本共享同一次轮询，不再直接请求LHM
+
+    - GET /snapshot、/snapshot/{host}：JSON快照，带ETag，数据未更新时返回304
+    - GET /ws：WebSocket，连接时推送全部快照（可用 ?host=a&host=b 只订阅部分主机），之后只推送变化的字段
+
+    每台主机的快照按revision缓存，无论多少个客户端，每次更新只序列化一次。
+    """
+    def __init__(self, monitors: Dict[str, HardwareMonitor], host: str = "127.0.0.1", port: int = 8098,
+                 queue_size: int = 256):
+        self.monitors = monitors  # 直接引用，主机增删后自动生效
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size  # 每个WebSocket客户端最多积压的消息数，超出后改为重发全部快照
+        self._documents: Dict[str, tuple] = {}  # 主机名 -> (revision, 快照, JSON, ETag)
+        self._combined: Optional[tuple] = None  # 全部主机：(各主机revision, JSON, ETag)
+        self._names: Dict[int, str] = {}  # id(monitor) -> 主机名
+        self._clients: Dict[web.WebSocketResponse, tuple] = {}  # ws -> (消息队列, 订阅的主机或None)
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/snapshot", self._handle_all)
+        app.router.add_get("/snapshot/{host}", self._handle_host)
+        app.router.add_get("/ws", self._handle_ws)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"快照服务地址: http://{self.host}:{self.port}/snapshot（WebSocket: /ws）")
+
+    async def stop(self):
+        for ws in list(self._clients):
+            await ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _document(self, name: str, monitor: HardwareMonitor) -> tuple:
+        """主机的快照及其JSON和ETag，revision未变时直接使用缓存"""
+        document = self._documents.get(name)
+        if document is None or document[0] != monitor.revision:
+            snapshot = monitor.snapshot()
+            body = json_dumps(snapshot).encode()
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            document = self._documents[name] = (monitor.revision, snapshot, body, etag)
+        return document
+
+    def _combined_document(self, names: Optional[set] = None) -> bytes:
+        """多台主机的快照，直接拼接各主机已经序列化好的JSON"""
+        return b"{" + b",".join(
+            json_dumps(name).encode() + b":" + self._document(name, monitor)[2]
+            for name, monitor in list(self.monitors.items()) if names is None or name in names
+        ) + b"}"
+
+    @staticmethod
+    def _respond(request, body: bytes, etag: str):
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = {tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip()
+                    for tag in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+
+    async def _handle_host(self, request):
+        name = request.match_info["host"]
+        monitor = self.monitors.get(name)
+        if monitor is None:
+            raise web.HTTPNotFound(text=f"未知主机: {name}")
+        _, _, body, etag = self._document(name, monitor)
+        return self._respond(request, body, etag)
+
+    async def _handle_all(self, request):
+        revisions = tuple((name, monitor.revision) for name, monitor in self.monitors.items())
+        if self._combined is None or self._combined[0] != revisions:
+            body = self._combined_document()
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            self._combined = (revisions, body, etag)
+        _, body, etag = self._combined
+        return self._respond(request, body, etag)
+
+    async def _handle_ws(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        names = set(request.query.getall("host", [])) or None
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        queue.put_nowait(None)  # None 表示发送全部快照
+        self._clients[ws] = (queue, names)
+        writer = asyncio.get_running_loop().create_task(self._write(ws, queue, names))
+        try:
+            async for _ in ws:
+                pass  # 不处理客户端发来的消息，只等待断开
+        finally:
+            del self._clients[ws]
+            writer.cancel()
+        return ws
+
+    async def _write(self, ws: web.WebSocketResponse, queue: asyncio.Queue, names: Optional[set]):
+        with contextlib.suppress(ConnectionError):
+            while True:
+                message = await queue.get()
+                if message is None:
+                    message = f'{{"type":"snapshot","hosts":{self._combined_document(names).decode()}}}'
+                await ws.send_str(message)
+
+    def _name_of(self, monitor: HardwareMonitor) -> Optional[str]:
+        name = self._names.get(id(monitor))
+        if name is None or self.monitors.get(name) is not monitor:
+            self._names = {id(m): n for n, m in self.monitors.items()}
+            self._documents = {n: d for n, d in self._documents.items() if n in self.monitors}
+            name = self._names.get(id(monitor))
+        return name
+
+    def notify(self, monitor: HardwareMonitor):
+        """主机数据更新时调用：计算与上次推送相比变化的字段，序列化一次后放入各客户端的队列"""
+        if not self._clients:
+            return  # 没有WebSocket客户端时HTTP请求按需生成快照
+        name = self._name_of(monitor)
+        if name is None:
+            return  # 已移除的主机
+        previous = self._documents.get(name)
+        snapshot = self._document(name, monitor)[1]
+        if previous is None:
+            changed, removed = snapshot, []
+        else:
+            old = previous[1]
+            changed = {key: value for key, value in snapshot.items() if old.get(key) != value}
+            removed = [key for key in old if key not in snapshot]
+        message = json_dumps({"type": "delta", "host": name, "revision": monitor.revision,
+                              "changed": changed, "removed": removed})
+        for queue, names in self._clients.values():
+            if names is not None and name not in names:
+                continue
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 客户端跟不上：丢弃积压的增量，改为重发一次全部快照
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+# ==================== 配置文件 ====================
+# 只在建立连接时使用的MQTT设置，修改后需要重启
+CONNECTION_SETTINGS = ("broker", "port", "username", "password", "protocol", "spool_dir",
+                       "spool_segment_size", "spool_max_bytes")
+# 按主机名生成的设置，不能在配置文件中修改
+_DERIVED_SETTINGS = ("base_topic", "client_id", "availability_topic", "will_topic")
+# 传给每台主机HardwareMonitor的顶层设置；热重载时只对新添加的主机生效
+MONITOR_OPTIONS = ("streaming", "adaptive", "min_interval", "max_interval", "auto_discover", "include", "exclude",
+                   "deadbands", "refresh_interval")
+
+
+@dataclass
+class AppConfig:
+    """配置文件解析、校验后的内容，重载时整体替换"""
+    hosts: Dict[str, str]
+    interval: float = 2
+    mqtt: Dict[str, Any] = field(default_factory=dict)
+    sensor_rules: Optional[Dict[str, SensorRule]] = None  # None表示使用内置的SENSOR_RULES
+    groups: tuple = ()
+    alert_rules: tuple = ()
+    options: Dict[str, Any] = field(default_factory=dict)  # MONITOR_OPTIONS 中设置了的项
+
+
+def apply_mqtt_settings(config: MQTTConfig, settings: Dict[str, Any]):
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+
+def _parse_config_file(path: str) -> Dict[str, Any]:
+    """按扩展名读取 TOML / YAML / JSON"""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        raw = f.read()
+    if ext == ".toml":
+        if tomllib is None:
+            raise ValueError("读取TOML配置需要Python 3.11+")
+        return tomllib.loads(raw.decode("utf-8"))
+    if ext in (".yaml", ".yml"):
+        if yaml is None:
+            raise ValueError("读取YAML配置需要安装PyYAML")
+        return yaml.safe_load(raw) or {}
+    return json.loads(raw)
+
+
+def load_config(path: str) -> AppConfig:
+    """读取并校验配置文件，任何错误都抛出ValueError（重载时保留原配置）"""
+    try:
+        data = _parse_config_file(path)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"配置文件格式错误: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("配置文件顶层必须是表")
+
+    # url 为单主机（使用 pc_monitor/ 主题），hosts 为多主机（名称: 地址）
+    hosts = data.get("hosts") or {}
+    if not isinstance(hosts, dict):
+        raise ValueError("hosts 必须是表（名称 = 地址）")
+    hosts = dict(hosts)
+    if data.get("url"):
+        hosts[""] = data["url"]
+    if not hosts:
+        raise ValueError("配置文件需要 url 或 hosts")
+    for name, url in hosts.items():
+        # TOML中写在 [hosts] 之后的顶层设置（如 interval）会被当成主机
+        if not isinstance(name, str) or not isinstance(url, str) or not url.startswith(("http://", "https://")):
+            raise ValueError(f"主机 {name!r} 的地址无效: {url!r}")
+        # 名称是MQTT主题的一部分，不能包含通配符、层级分隔符或NUL
+        if any(char in name for char in "+#/\0"):
+            raise ValueError(f"主机名称不能包含 + # / 或 NUL: {name!r}")
+
+    interval = data.get("interval", 2)
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+        raise ValueError(f"interval 必须是正数: {interval!r}")
+
+    options = {key: data[key] for key in MONITOR_OPTIONS if key in data}
+    for key in ("streaming", "adaptive", "auto_discover"):
+        if key in options and not isinstance(options[key], bool):
+            raise ValueError(f"{key} 必须是 true 或 false: {options[key]!r}")
+    for key in ("min_interval", "max_interval", "refresh_interval"):
+        value = options.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f"{key} 必须是正数: {value!r}")
+    if options.get("min_interval", 0) > options.get("max_interval", float("inf")):
+        raise ValueError("min_interval 不能大于 max_interval")
+    for key in ("include", "exclude"):
+        if key in options:
+            patterns = options[key]
+            if not isinstance(patterns, list) or not all(isinstance(p, str) and p for p in patterns):
+                raise ValueError(f"{key} 必须是传感器路径通配符的列表: {patterns!r}")
+            options[key] = tuple(patterns)
+    # 死区发布：true 使用内置的 DEFAULT_DEADBANDS，表（字段 = {absolute, relative}）整体替换，false 不启用
+    deadbands = options.pop("deadbands", False)
+    if deadbands is True:
+        options["deadbands"] = dict(DEFAULT_DEADBANDS)
+    elif isinstance(deadbands, dict):
+        options["deadbands"] = {}
+        for field_name, band in deadbands.items():
+            if (not isinstance(band, dict) or not set(band) <= {"absolute", "relative"}
+                    or not all(isinstance(v, (int, float)) and not isinstance(v, bool) and v >= 0
+                               for v in band.values())):
+                raise ValueError(f"字段 {field_name} 的死区无效（需要非负的 absolute/relative）: {band!r}")
+            options["deadbands"][field_name] = Deadband(**band)
+    elif deadbands is not False:
+        raise ValueError(f"deadbands 必须是 true/false 或 字段 = {{absolute, relative}} 的表: {deadbands!r}")
+
+    mqtt_settings = data.get("mqtt") or {}
+    if not isinstance(mqtt_settings, dict):
+        raise ValueError("mqtt 必须是表")
+    mqtt_settings = dict(mqtt_settings)
+    known = vars(MQTTConfig())
+    for key, value in mqtt_settings.items():
+        if key not in known or key in _DERIVED_SETTINGS:
+            raise ValueError(f"未知或不可设置的MQTT设置: {key}")
+        # 类型与默认值一致（protocol 等枚举写成整数）
+        default = known[key]
+        if isinstance(default, bool):
+            valid = isinstance(value, bool)
+        elif isinstance(default, int):
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, type(default))
+        if not valid:
+            raise ValueError(f"MQTT设置 {key} 的类型错误: {value!r}")
+    # 取值范围：这些错误在发布时才会暴露，需要在加载时拦截
+    allowed = {
+        "qos": (0, 1, 2),
+        "compact_qos": (0, 1, 2),
+        "protocol": (mqtt.MQTTv31, mqtt.MQTTv311, mqtt.MQTTv5),
+        "compact": ("",) + COMPACT_LAYOUTS,
+        "compact_encoding": COMPACT_ENCODINGS,
+    }
+    for key, choices in allowed.items():
+        if key in mqtt_settings and mqtt_settings[key] not in choices:
+            raise ValueError(f"MQTT设置 {key} 的取值无效: {mqtt_settings[key]!r}（可选 {choices}）")
+    if any(char in mqtt_settings.get("compact_topic", "") for char in "+#\0"):
+        raise ValueError(f"MQTT设置 compact_topic 不能包含 + # 或 NUL: {mqtt_settings['compact_topic']!r}")
+
+    try:
+        sensor_rules = None
+        if "sensors" in data:
+            sensor_rules = {}
+            for sensor_id, rule in data["sensors"].items():
+                sensor_rules[sensor_id] = SensorRule(
+                    rule["target"], rule["value"], rule.get("max"), rule.get("scale", 1.0), rule.get("collect", False))
+                for attr in (rule["value"], rule.get("max")):
+                    if attr is not None and (rule["target"], attr) not in STATE_LAYOUT.slots:
+                        raise ValueError(f"传感器 {sensor_id} 的目标不存在: {rule['target']}.{attr}")
+        groups = tuple(
+            SensorGroup(**{**group, "fields": tuple(group.get("fields", ()))}) for group in data.get("groups", ()))
+        alert_rules = tuple(AlertRule(**rule) for rule in data.get("alerts", ()))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"配置项错误: {e!r}") from e
+    return AppConfig(hosts, interval, mqtt_settings, sensor_rules, groups, alert_rules, options)
+
+
+class ConfigReloader:
+    """收到SIGHUP或配置文件被修改时重新加载，解析或校验失败时保留当前配置"""
+    def __init__(self, path: str, fleet: Union["FleetMonitor", "FleetSupervisor"], check_interval: float = 2):
+        self.path = path
+        self.fleet = fleet
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._stamp = self._file_stamp()
+        self._task: Optional[asyncio.Task] = None
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self._task = loop.create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            stamp = self._file_stamp()
+            if stamp is not None and stamp != self._stamp:
+                self.reload()
+
+    def reload(self):
+        """重新加载并应用（在事件循环中同步执行，两轮轮询之间整体生效）"""
+        self._stamp = self._file_stamp()
+        try:
+            config = load_config(self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f"重新加载配置失败，继续使用当前配置: {e}")
+            return
+        self.fleet.apply_config(config)
+        self.reloads += 1
+        logger.info(f"已重新加载配置: {self.path}")
+
+
+# ==================== 多主机监控 ====================
+class FleetMonitor:
+    """在一个事件循环中并发轮询多台主机，所有主机共享一条MQTT连接
+
+    主机名为空字符串时使用单主机模式的主题（pc_monitor/）。
+    """
+    def __init__(self, hosts: Dict[str, str], interval: int = 2, max_concurrency: int = 8,
+                 connection: Optional[MQTTConnection] = None,
+                 mqtt_settings: Optional[Dict[str, Any]] = None, **monitor_options):
+        self.connection = connection or MQTTConnection(MQTTConfig())
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        self.mqtt_settings = dict(mqtt_settings or {})  # 配置文件中的MQTT设置，应用到每台主机
+        self.monitor_options = monitor_options
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.monitors: Dict[str, HardwareMonitor] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.persistent = False  # 为True时没有主机也继续运行（分片工作进程等待分配主机）
+        self._hosts_changed: Optional[asyncio.Event] = None
+        self.update_listeners: List[Callable[[HardwareMonitor], None]] = []  # 所有主机共用
+        for name, url in hosts.items():
+            self.add_host(name, url)
+
+    def add_host(self, name: str, url: str):
+        """添加一台主机，运行中添加时立即开始轮询"""
+        config = MQTTConfig(name)
+        apply_mqtt_settings(config, self.mqtt_settings)
+        publisher = AsyncMQTTPublisher(config, self.connection)
+        monitor = HardwareMonitor(
+            url, self.interval, name=name or None, mqtt=publisher, semaphore=self._semaphore,
+            **self.monitor_options)
+        monitor.update_listeners = self.update_listeners
+        self.monitors[name] = monitor
+        if self.session is not None:
+            monitor.session = self.session
+            self._tasks[name] = asyncio.get_running_loop().create_task(monitor.start())
+            self._hosts_changed.set()
+
+    def remove_host(self, name: str, forget: bool = True):
+        """移除一台主机：停止轮询并保存累计量；forget=True 时标记离线并从HA中移除它的传感器
+        （转移到其它分片的主机使用 forget=False）"""
+        monitor = self.monitors.pop(name)
+        monitor.stop()
+        # 之后HA重启或重新连接时不再发布它的自动发现配置和可用性
+        monitor._remove_listeners()
+        task = self._tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+        monitor.integrator.save()
+        if forget:
+            monitor._set_available(False)
+            monitor.mqtt.publish_all_sensor_configs([])
+        else:
+            monitor.mqtt.forget_sensor_configs()
+
+    def apply_config(self, config: "AppConfig", keep: Sequence[str] = ()):
+        """原地应用新配置：增删主机、更新地址和各主机的映射/调度/告警，MQTT连接和HTTP连接池保持不变
+
+        keep 中的主机被移除时不从HA中删除（分片之间转移）。
+        """
+        for key in CONNECTION_SETTINGS:
+            if config.mqtt.get(key) != self.mqtt_settings.get(key):
+                logger.warning(f"MQTT设置 {key} 的修改需要重启后生效")
+        self.mqtt_settings = dict(config.mqtt)
+        self.interval = config.interval
+        self.monitor_options.update(
+            sensor_rules=config.sensor_rules, groups=config.groups, alert_rules=config.alert_rules)
+        for key in MONITOR_OPTIONS:
+            if config.options.get(key) != self.monitor_options.get(key):
+                if self.monitors:
+                    logger.warning(f"主机选项 {key} 的修改只对新添加的主机生效，其余主机需要重启")
+                if key in config.options:
+                    self.monitor_options[key] = config.options[key]
+                else:
+                    del self.monitor_options[key]  # 恢复默认值
+
+        for name in [name for name in self.monitors if name not in config.hosts]:
+            self.remove_host(name, forget=name not in keep)
+            logger.info(f"移除主机 {name}")
+        for name, url in config.hosts.items():
+            monitor = self.monitors.get(name)
+            if monitor is None:
+                self.add_host(name, url)
+                logger.info(f"添加主机 {name}: {url}")
+                continue
+            monitor.url = url
+            apply_mqtt_settings(monitor.mqtt.config, self.mqtt_settings)
+            monitor.reconfigure(config.interval, config.sensor_rules or SENSOR_RULES,
+                                config.groups, config.alert_rules)
+
+    async def start(self):
+        """启动所有主机的监控任务，运行中增删的主机也在这里等待"""
+        logger.info(f"多主机模式启动，共 {len(self.monitors)} 台主机")
+        # 所有主机共用一个连接池
+        self.session = create_http_session(limit=self.max_concurrency)
+        self._hosts_changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for name, monitor in self.monitors.items():
+            monitor.session = self.session
+            self._tasks[name] = loop.create_task(monitor.start())
+        try:
+            while self._tasks or self.persistent:
+                if not self._tasks:
+                    self._hosts_changed.clear()
+                    await self._hosts_changed.wait()
+                    continue
+                done, _ = await asyncio.wait(list(self._tasks.values()), return_when=asyncio.FIRST_COMPLETED)
+                for name, task in list(self._tasks.items()):
+                    if task in done:
+                        del self._tasks[name]
+                for task in done:
+                    if not task.cancelled():
+                        task.result()  # 与之前的gather一样，把监控任务的异常抛出
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+            await self.session.close()
+            self.session = None
+
+
+# ==================== 多进程分片 ====================
+def assign_shards(costs: Dict[str, float], shards: int) -> List[List[str]]:
+    """按每台主机的开销把主机分成若干片，使各片总开销尽量接近（最大开销优先放入当前最轻的一片）"""
+    result: List[List[str]] = [[] for _ in range(shards)]
+    loads = [0.0] * shards
+    for name in sorted(costs, key=lambda n: (-costs[n], n)):
+        i = min(range(shards), key=lambda k: (loads[k], len(result[k])))
+        result[i].append(name)
+        loads[i] += costs[name]
+    return result
+
+
+def _shard_mqtt_config(settings: Dict[str, Any], index: int) -> MQTTConfig:
+    """工作进程各自的MQTT连接：client_id、遗嘱主题、自动发现缓存和断线缓存目录互不冲突"""
+    config = MQTTConfig()
+    apply_mqtt_settings(config, settings)
+    config.client_id = f"{config.client_id}_w{index}"
+    config.will_topic = f"{config.base_topic}connection_{index}"
+    root, ext = os.path.splitext(config.discovery_cache_file)
+    config.discovery_cache_file = f"{root}_{index}{ext}"
+    if config.spool_dir:
+        config.spool_dir = os.path.join(config.spool_dir, f"w{index}")
+    return config
+
+
+def run_shard(index: int, config: AppConfig, conn, monitor_options: Dict[str, Any],
+              report_interval: float = 10, metrics_port: int = 0, snapshot_port: int = 0,
+              snapshot_host: str = "127.0.0.1"):
+    """工作进程入口：运行一个FleetMonitor，通过conn接收主机分配并汇报各主机的开销"""
+    try:
+        asyncio.run(_run_shard(index, config, conn, monitor_options, report_interval, metrics_port,
+                               snapshot_port, snapshot_host))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+async def _run_shard(index: int, config: AppConfig, conn, monitor_options: Dict[str, Any],
+                     report_interval: float, metrics_port: int, snapshot_port: int, snapshot_host: str):
+    cancel_on_sigterm()
+    connection = MQTTConnection(_shard_mqtt_config(config.mqtt, index))
+    fleet = FleetMonitor(
+        config.hosts, config.interval, connection=connection, mqtt_settings=config.mqtt,
+        sensor_rules=config.sensor_rules, groups=config.groups, alert_rules=config.alert_rules,
+        **config.options, **monitor_options)
+    fleet.persistent = True
+    if metrics_port:
+        await MetricsServer(fleet.monitors, connection, port=metrics_port + index).start()
+    if snapshot_port:
+        snapshot_server = SnapshotServer(fleet.monitors, snapshot_host, snapshot_port + index)
+        fleet.update_listeners.append(snapshot_server.notify)
+        await snapshot_server.start()
+    loop = asyncio.get_running_loop()
+    fleet_task = loop.create_task(fleet.start())
+
+    busy: Dict[str, float] = {}
+    last_report = time.monotonic()
+    last_cpu = time.process_time()
+    try:
+        while not fleet_task.done():
+            # 非阻塞地检查管道，避免在线程中阻塞读取导致退出时无法结束
+            while conn.poll():
+                command, *args = conn.recv()
+                if command == "config":
+                    fleet.apply_config(*args)
+                    conn.send(("ack",))
+                elif command == "stop":
+                    return
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                elapsed, cpu = now - last_report, time.process_time()
+                hosts = {}
+                for name, monitor in fleet.monitors.items():
+                    total = sum(monitor.stage_histograms[stage].total for stage in ("decode", "parse", "publish"))
+                    hosts[name] = {
+                        "load": (total - busy.get(name, 0.0)) / elapsed,  # 每秒占用的CPU时间
+                        "available": monitor._available,
+                        "failures": monitor._connection_failures,
+                    }
+                    busy[name] = total
+                conn.send(("report", {
+                    "hosts": hosts,
+                    "cpu": (cpu - last_cpu) / elapsed,
+                    "queue_depth": connection.stats()["queue_depth"],
+                }))
+                last_report, last_cpu = now, cpu
+            await asyncio.sleep(0.2)
+        fleet_task.result()
+    except (EOFError, BrokenPipeError):
+        pass  # 主进程已退出
+    finally:
+        for monitor in fleet.monitors.values():
+            monitor.stop()
+        fleet_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await fleet_task
+        await connection.stop()
+
+
+class FleetSupervisor:
+    """多进程分片：把主机分到若干个工作进程，每个进程运行自己的事件循环和MQTT连接
+
+    - 各进程定时汇报每台主机占用的CPU时间，负载不均衡时按实测开销重新分片（尽量少移动主机）
+    - 工作进程异常退出后按指数退避重启
+    - apply_config 与 FleetMonitor 相同，可以配合 ConfigReloader 热重载
+    """
+    def __init__(self, config: AppConfig, workers: int = 0, report_interval: float = 10,
+                 rebalance_interval: float = 300, imbalance: float = 1.25, metrics_port: int = 0,
+                 snapshot_port: int = 0, snapshot_host: str = "127.0.0.1", **monitor_options):
+        self.config = config
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(config.hosts)))
+        self.report_interval = report_interval
+        self.rebalance_interval = rebalance_interval
+        self.imbalance = imbalance
+        self.metrics_port = metrics_port
+        self.snapshot_port = snapshot_port
+        self.snapshot_host = snapshot_host
+        self.monitor_options = monitor_options
+        self._context = multiprocessing.get_context("spawn")
+        self.costs: Dict[str, float] = {}  # 每台主机实测的CPU开销（秒/秒，指数平滑）
+        self.shards = assign_shards(dict.fromkeys(config.hosts, 1.0), self.workers)
+        self.reports: List[Optional[Dict[str, Any]]] = [None] * self.workers
+        self.restarts = 0
+        self.rebalances = 0
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * self.workers
+        self._pipes: List[Any] = [None] * self.workers
+        self._started_at = [0.0] * self.workers
+        self._restart_delay = [1.0] * self.workers
+        self._restart_at = [0.0] * self.workers
+        self._acks: List[Optional[asyncio.Event]] = [None] * self.workers
+        self._lock: Optional[asyncio.Lock] = None  # 重新分片和热重载不能同时进行
+        self._running = False
+
+    def _shard_config(self, index: int, hosts: Optional[Sequence[str]] = None) -> AppConfig:
+        config = self.config
+        names = self.shards[index] if hosts is None else hosts
+        return AppConfig({name: config.hosts[name] for name in names}, config.interval, config.mqtt,
+                         config.sensor_rules, config.groups, config.alert_rules, config.options)
+
+    def _spawn(self, index: int):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+            target=run_shard, name=f"pc_monitor_w{index}",
+            args=(index, self._shard_config(index), child, self.monitor_options,
+                  self.report_interval, self.metrics_port,
+                  # 工作进程的快照服务只供主进程的 SnapshotProxy 转发
+                  self.snapshot_port + 1 if self.snapshot_port else 0, "127.0.0.1"))
+        process.start()
+        child.close()
+        self._processes[index] = process
+        self._pipes[index] = parent
+        self._started_at[index] = time.monotonic()
+        logger.info(f"工作进程 {index} 启动（pid {process.pid}），{len(self.shards[index])} 台主机")
+
+    async def _terminate(self, timeout: float = 5):
+        """通知所有工作进程退出，超时未退出的强制结束；等待期间不阻塞事件循环"""
+        processes = [process for process in self._processes if process is not None and process.is_alive()]
+        for index, process in enumerate(self._processes):
+            if process in processes:
+                with contextlib.suppress(OSError, AttributeError):
+                    self._pipes[index].send(("stop",))
+        deadline = time.monotonic() + timeout
+        while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self._processes = [None] * self.workers
+
+    async def start(self):
+        """启动工作进程并持续监督，直到 stop()"""
+        self._running = True
+        self._lock = asyncio.Lock()
+        for index in range(self.workers):
+            self._acks[index] = asyncio.Event()
+            if self.shards[index]:
+                self._spawn(index)
+        proxy = None
+        if self.snapshot_port:
+            proxy = SnapshotProxy(self, self.snapshot_host, self.snapshot_port)
+            await proxy.start()
+        last_rebalance = last_log = time.monotonic()
+        try:
+            while self._running:
+                self._poll_reports()
+                self._check_workers()
+                now = time.monotonic()
+                if now - last_rebalance >= self.rebalance_interval:
+                    last_rebalance = now
+                    await self.rebalance()
+                if now - last_log >= 60:
+                    last_log = now
+                    logger.info(f"分片状态: {self.health()}")
+                await asyncio.sleep(0.5)
+        finally:
+            if proxy is not None:
+                await proxy.stop()
+            await self._terminate()
+
+    def stop(self):
+        self._running = False
+
+    def _poll_reports(self):
+        for index, pipe in enumerate(self._pipes):
+            if pipe is None:
+                continue
+            try:
+                while pipe.poll():
+                    message, *args = pipe.recv()
+                    if message == "report":
+                        self._record(index, args[0])
+                    elif message == "ack":
+                        self._acks[index].set()
+            except (EOFError, OSError):
+                self._pipes[index] = None  # 进程已退出，由_check_workers重启
+
+    def _record(self, index: int, report: Dict[str, Any]):
+        self.reports[index] = report
+        for name, host in report["hosts"].items():
+            previous = self.costs.get(name)
+            self.costs[name] = host["load"] if previous is None else previous * 0.5 + host["load"] * 0.5
+
+    def _check_workers(self):
+        """重启异常退出的工作进程：1秒起指数退避，稳定运行1分钟后退避时间复位"""
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if process is None:
+                if self.shards[index] and now >= self._restart_at[index]:
+                    self._spawn(index)
+                continue
+            if process.is_alive():
+                if now - self._started_at[index] > 60:
+                    self._restart_delay[index] = 1.0
+                continue
+            logger.error(f"工作进程 {index} 退出（退出码 {process.exitcode}），"
+                         f"{self._restart_delay[index]:.0f}s后重启")
+            self._processes[index] = None
+            self._pipes[index] = None
+            self.reports[index] = None
+            self._restart_at[index] = now + self._restart_delay[index]
+            self._restart_delay[index] = min(self._restart_delay[index] * 2, 60)
+            self.restarts += 1
+
+    def _loads(self, shards: List[List[str]]) -> List[float]:
+        default = sum(self.costs.values()) / len(self.costs) if self.costs else 1.0
+        return [sum(self.costs.get(name, default) for name in shard) for shard in shards]
+
+    async def rebalance(self):
+        """负载最重的分片超过平均值的 imbalance 倍时按实测开销重新分片"""
+        async with self._lock:
+            await self._rebalance()
+
+    async def _rebalance(self):
+        loads = self._loads(self.shards)
+        mean = sum(loads) / len(loads)
+        if mean <= 0 or max(loads) <= mean * self.imbalance:
+            return
+        default = sum(self.costs.values()) / len(self.costs) if self.costs else 1.0
+        shards = self._match_workers(assign_shards(
+            {name: self.costs.get(name, default) for name in self.config.hosts}, self.workers))
+        if max(self._loads(shards)) >= max(loads):
+            return
+        logger.info(f"重新分片：各进程负载 {[round(x, 4) for x in loads]} -> "
+                    f"{[round(x, 4) for x in self._loads(shards)]}")
+        self.rebalances += 1
+        await self._reassign(shards)
+
+    def _match_workers(self, shards: List[List[str]]) -> List[List[str]]:
+        """把新分片对应到与其主机重合最多的现有进程，减少需要转移的主机"""
+        result: List[Optional[List[str]]] = [None] * self.workers
+        pairs = sorted(
+            ((len(set(shard) & set(self.shards[index])), i, index)
+             for i, shard in enumerate(shards) for index in range(self.workers)),
+            reverse=True)
+        used = set()
+        for _, i, index in pairs:
+            if i not in used and result[index] is None:
+                result[index] = shards[i]
+                used.add(i)
+        return result
+
+    async def _reassign(self, shards: List[List[str]], changed: Sequence[int] = (),
+                        config: Optional[AppConfig] = None):
+        """两步切换主机：先让失去主机的进程停止并保存累计量，再让接手的进程开始轮询"""
+        if config is not None:
+            self.config = config
+        old = self.shards
+        hosts = set(self.config.hosts)
+        moved = [name for shard in old for name in shard if name in hosts]
+        # 第一步：只移除
+        for index in range(self.workers):
+            kept = [name for name in old[index] if name in shards[index]]
+            if len(kept) != len(old[index]):
+                await self._send(index, self._shard_config(index, kept), keep=moved)
+        self.shards = shards
+        # 第二步：完整的新分配
+        for index in range(self.workers):
+            if set(shards[index]) != set(old[index]) or index in changed:
+                await self._send(index, self._shard_config(index))
+
+    async def _send(self, index: int, config: AppConfig, keep: Sequence[str] = ()):
+        pipe = self._pipes[index]
+        if pipe is None:
+            return  # 进程未运行，重启时会使用新的分配
+        self._acks[index].clear()
+        try:
+            pipe.send(("config", config, list(keep)))
+        except OSError:
+            return
+        try:
+            await asyncio.wait_for(self._wait_ack(index), 10)
+        except asyncio.TimeoutError:
+            logger.warning(f"工作进程 {index} 未确认新的主机分配")
+
+    async def _wait_ack(self, index: int):
+        while not self._acks[index].is_set():
+            self._poll_reports()
+            await asyncio.sleep(0.05)
+
+    def apply_config(self, config: AppConfig):
+        """热重载：新主机放入负载最轻的分片，移除的主机从所在分片删除，其余设置下发到各进程"""
+        asyncio.get_running_loop().create_task(self._apply_config(config))
+
+    async def _apply_config(self, config: AppConfig):
+        async with self._lock:
+            shards = [[name for name in shard if name in config.hosts] for shard in self.shards]
+            await self._reassign(self._place_new_hosts(shards, config), changed=range(self.workers), config=config)
+
+    def _place_new_hosts(self, shards: List[List[str]], config: AppConfig) -> List[List[str]]:
+        loads = self._loads(shards)
+        assigned = {name for shard in shards for name in shard}
+        default = sum(self.costs.values()) / len(self.costs) if self.costs else 1.0
+        for name in config.hosts:
+            if name not in assigned:
+                index = min(range(self.workers), key=lambda k: loads[k])
+                shards[index].append(name)
+                loads[index] += self.costs.get(name, default)
+        return shards
+
+    def health(self) -> Dict[str, Any]:
+        """汇总各工作进程的状态"""
+        hosts = [host for report in self.reports if report for host in report["hosts"].values()]
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for p in self._processes if p is not None and p.is_alive()),
+            "restarts": self.restarts,
+            "rebalances": self.rebalances,
+            "hosts": len(self.config.hosts),
+            "available": sum(1 for host in hosts if host["available"]),
+            "failing": sum(1 for host in hosts if host["failures"]),
+            "load": [round(x, 4) for x in self._loads(self.shards)],
+            "cpu": [round(report["cpu"], 3) if report else None for report in self.reports],
+            "queue_depth": sum(report["queue_depth"] for report in self.reports if report),
+        }
+
+
+class SnapshotProxy:
+    """多进程分片时在主进程的一个端口上提供快照服务，主机在进程间转移后地址不变
+
+    工作进程的快照服务只监听本机的 port + 1 + 进程序号，由这里按主机所在的进程转发：
+    - /snapshot/{host} 转发到该主机所在的进程（带上 If-None-Match）
+    - /snapshot 合并各进程的快照，按各进程的ETag做条件请求
+    - /ws 为每个客户端订阅所有进程并转发消息：每个进程各推送一条只含自己主机的 snapshot，
+      主机转移后新进程的第一条 delta 包含它的全部字段，客户端按主机合并即可
+    """
+    TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+    def __init__(self, supervisor: "FleetSupervisor", host: str = "127.0.0.1", port: int = 8098):
+        self.supervisor = supervisor
+        self.host = host
+        self.port = port
+        self._cache: Dict[int, Tuple[str, bytes]] = {}  # 进程序号 -> (ETag, 快照)
+        self._combined: Optional[tuple] = None  # (各进程ETag, JSON, ETag)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._runner = None
+
+    def worker_url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{self.port + 1 + index}{path}"
+
+    async def start(self):
+        self._session = aiohttp.ClientSession()
+        app = web.Application()
+        app.router.add_get("/snapshot", self._handle_all)
+        app.router.add_get("/snapshot/{host}", self._handle_host)
+        app.router.add_get("/ws", self._handle_ws)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"快照服务地址: http://{self.host}:{self.port}/snapshot（WebSocket: /ws，转发到各工作进程）")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._session is not None:
+            await self._session.close()
+
+    async def _handle_host(self, request):
+        name = request.match_info["host"]
+        if name not in self.supervisor.config.hosts:
+            raise web.HTTPNotFound(text=f"未知主机: {name}")
+        headers = {"If-None-Match": request.headers["If-None-Match"]} if "If-None-Match" in request.headers else {}
+        # 先问分配到的进程，转移过程中再问其它进程
+        shards = self.supervisor.shards
+        for index in sorted(range(len(shards)), key=lambda i: name not in shards[i]):
+            try:
+                async with self._session.get(self.worker_url(index, f"/snapshot/{quote(name, safe='')}"),
+                                             headers=headers, timeout=self.TIMEOUT) as response:
+                    if response.status == 404:
+                        continue
+                    return web.Response(status=response.status, body=await response.read(), headers={
+                        key: response.headers[key] for key in ("Content-Type", "ETag", "Cache-Control")
+                        if key in response.headers})
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+        raise web.HTTPServiceUnavailable(text=f"主机 {name} 暂时不可用")
+
+    async def _fetch(self, index: int) -> Tuple[str, bytes]:
+        """一个进程的全部快照，未变化时使用缓存；进程不可用时返回空"""
+        cached = self._cache.get(index)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        try:
+            async with self._session.get(self.worker_url(index, "/snapshot"), headers=headers,
+                                         timeout=self.TIMEOUT) as response:
+                if response.status == 304 and cached:
+                    return cached
+                if response.status == 200:
+                    cached = self._cache[index] = (response.headers.get("ETag", ""), await response.read())
+                    return cached
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        self._cache.pop(index, None)
+        return "", b"{}"
+
+    async def _handle_all(self, request):
+        results = await asyncio.gather(*(self._fetch(index) for index in range(self.supervisor.workers)))
+        etags = tuple(etag for etag, _ in results)
+        if self._combined is None or self._combined[0] != etags:
+            # 各进程的主机互不重叠（转移时先移除再添加），直接拼接
+            body = b"{" + b",".join(part[1:-1] for _, part in results if len(part) > 2) + b"}"
+            self._combined = (etags, body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"')
+        _, body, etag = self._combined
+        return SnapshotServer._respond(request, body, etag)
+
+    async def _handle_ws(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        loop = asyncio.get_running_loop()
+        relays = [loop.create_task(self._relay(index, request.query_string, ws))
+                  for index in range(self.supervisor.workers)]
+        try:
+            async for _ in ws:
+                pass  # 不处理客户端发来的消息，只等待断开
+        finally:
+            for relay in relays:
+                relay.cancel()
+        return ws
+
+    async def _relay(self, index: int, query: str, ws: web.WebSocketResponse):
+        """把一个工作进程推送的消息转发给客户端，进程重启后重新连接"""
+        url = self.worker_url(index, f"/ws?{query}" if query else "/ws")
+        while not ws.closed:
+            try:
+                async with self._session.ws_connect(url) as upstream:
+                    async for message in upstream:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            await ws.send_str(message.data)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError):
+                pass
+            await asyncio.sleep(1)
+
+
 # ==================== 主程序 ====================
+# 配置文件（TOML/YAML/JSON，参考 config.example.toml）：存在时使用其中的主机、MQTT、映射、分组和告警设置，
+# 运行中收到SIGHUP或文件被修改时重新加载；不存在时使用下面的设置
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.toml")
+
+# LibreHardware的ip和端口（名称: 地址），配置多台主机时自动启用多主机模式
+HOSTS = {
+    "pc": "http://192.168.100.245:8097/data.json",
+}
+
+# 运行指标端口（OpenMetrics），0表示不启用
+METRICS_PORT = 9108
+
+# 快照服务端口（HTTP /snapshot 与 WebSocket /ws），仪表盘从这里读取数据而不是直接请求LHM，0表示不启用；
+# 其它机器上的仪表盘需要访问时把 SNAPSHOT_HOST 改为 "0.0.0.0"
+SNAPSHOT_PORT = 0
+SNAPSHOT_HOST = "127.0.0.1"
+
+# 传感器分组：各自的采样/发布间隔（秒）和汇总方式，未列出的字段按默认间隔发布到 state，例如
+# SensorGroup("fast", ("cpu_usage", "net_upload", "net_download"), 0.5, 1, "mean"),
+# SensorGroup("slow", ("mb_temp", "gpu_vram_*"), 10, 30, "max"),
+SENSOR_GROUPS: List[SensorGroup] = []
+
+# 流式解析：只提取需要的传感器，取齐后停止读取响应（响应很大、网络较慢时减少延迟）
+STREAMING = False
+
+# 自适应轮询：数值变化快时缩短间隔（不低于 MIN_INTERVAL），空闲时逐步放宽（不超过 MAX_INTERVAL），
+# None 表示取基准间隔的 1/4 和 5 倍
+ADAPTIVE = False
+MIN_INTERVAL: Optional[float] = None
+MAX_INTERVAL: Optional[float] = None
+
+# 自动发现：除内置映射外，再发布 SensorId 匹配 AUTO_INCLUDE 且不匹配 AUTO_EXCLUDE 的传感器
+AUTO_DISCOVER = False
+AUTO_INCLUDE: Sequence[str] = DEFAULT_AUTO_INCLUDE
+AUTO_EXCLUDE: Sequence[str] = ()
+
+# 死区发布：设为 DEFAULT_DEADBANDS（或自定义的 字段: Deadband）后只在数值变化超过死区时发布state，
+# 每 REFRESH_INTERVAL 秒强制发布一次；None表示每轮都发布
+DEADBANDS: Optional[Dict[str, Deadband]] = None
+REFRESH_INTERVAL = 60
+
+# 录制LHM原始响应的目录（每台主机每次启动一个 <client_id>-<启动时间>.capture.gz），为空表示不录制
+CAPTURE_DIR = ""
+
+# 回放录制文件代替HTTP请求（离线复现解析问题），为空表示正常轮询；REPLAY_SPEED 为倍速，0表示尽快回放
+REPLAY_FILE = ""
+REPLAY_SPEED = 1.0
+
+# 多进程分片：大于1时把主机分到这么多个工作进程（每个进程一条MQTT连接），按实测开销均衡负载，
+# 适合一台采集机轮询数百台主机；0表示使用全部CPU核心，1表示单进程
+WORKERS = 1
+
+# 告警规则：触发和恢复时发布事件到 <base_topic>event（不保留），HA可用MQTT触发器接收
+ALERT_RULES: List[AlertRule] = [
+    AlertRule("cpu_overheat", "cpu_temp", above=90, hysteresis=5, duration=4, severity="critical"),
+    AlertRule("vram_full", "gpu_vram_usage", above=95, hysteresis=3),
+]
+
+
+def cancel_on_sigterm():
+    """收到SIGTERM（如systemd停止服务）时取消当前任务，让各层的finally保存累计量、关闭录制文件"""
+    with contextlib.suppress(NotImplementedError):  # Windows的事件循环不支持信号处理
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+
 async def main():
-    monitor = HardwareMonitor("http://192.168.100.245:8097/data.json") #LibreHardware的ip和端口
+    cancel_on_sigterm()
+    reloader = None
+    # 没有配置文件时使用上面的常量，有配置文件时以配置文件为准
+    monitor_options = dict(streaming=STREAMING, adaptive=ADAPTIVE, min_interval=MIN_INTERVAL,
+                           max_interval=MAX_INTERVAL, auto_discover=AUTO_DISCOVER, include=tuple(AUTO_INCLUDE),
+                           exclude=tuple(AUTO_EXCLUDE), deadbands=DEADBANDS, refresh_interval=REFRESH_INTERVAL)
+    options = dict(groups=SENSOR_GROUPS, alert_rules=ALERT_RULES, capture_dir=CAPTURE_DIR, **monitor_options)
+    if WORKERS != 1:
+        if os.path.exists(CONFIG_FILE):
+            app_config = load_config(CONFIG_FILE)
+        else:
+            hosts = HOSTS if len(HOSTS) > 1 else {"": next(iter(HOSTS.values()))}
+            app_config = AppConfig(hosts, groups=tuple(SENSOR_GROUPS), alert_rules=tuple(ALERT_RULES),
+                                   options=monitor_options)
+        # 各工作进程的运行指标端口为 METRICS_PORT + 进程序号；快照服务由主进程在 SNAPSHOT_PORT 统一提供
+        monitor = FleetSupervisor(app_config, WORKERS, metrics_port=METRICS_PORT, snapshot_port=SNAPSHOT_PORT,
+                                  snapshot_host=SNAPSHOT_HOST, capture_dir=CAPTURE_DIR)
+        if os.path.exists(CONFIG_FILE):
+            reloader = ConfigReloader(CONFIG_FILE, monitor)
+            reloader.start()
+    elif os.path.exists(CONFIG_FILE):
+        app_config = load_config(CONFIG_FILE)
+        mqtt_config = MQTTConfig()
+        apply_mqtt_settings(mqtt_config, app_config.mqtt)
+        monitor = FleetMonitor(
+            app_config.hosts, app_config.interval, connection=MQTTConnection(mqtt_config),
+            mqtt_settings=app_config.mqtt, sensor_rules=app_config.sensor_rules, groups=app_config.groups,
+            alert_rules=app_config.alert_rules, capture_dir=CAPTURE_DIR, **app_config.options)
+        monitors, connection = monitor.monitors, monitor.connection
+        reloader = ConfigReloader(CONFIG_FILE, monitor)
+        reloader.start()
+    elif len(HOSTS) > 1:
+        monitor = FleetMonitor(HOSTS, **options)
+        monitors, connection = monitor.monitors, monitor.connection
+    else:
+        monitor = HardwareMonitor(next(iter(HOSTS.values())), **options)
+        monitors, connection = {next(iter(HOSTS)): monitor}, monitor.mqtt.connection
+    if WORKERS == 1:
+        if REPLAY_FILE:
+            records = list(CaptureLog.read(REPLAY_FILE))
+            for m in monitors.values():
+                m.replay = ReplaySource(records, REPLAY_SPEED)
+        if METRICS_PORT:
+            await MetricsServer(monitors, connection, port=METRICS_PORT).start()
+        if SNAPSHOT_PORT:
+            snapshot_server = SnapshotServer(monitors, SNAPSHOT_HOST, SNAPSHOT_PORT)
+            monitor.update_listeners.append(snapshot_server.notify)
+            await snapshot_server.start()
     try:
         await monitor.start()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("监控服务正常停止")
+    finally:
+        if reloader is not None:
+            reloader.stop()
 
 
 if __name__ == "__main__":
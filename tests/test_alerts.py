@@ -0,0 +1,91 @@
+from array import array
+
+import pytest
+
+from main import NAN, STATE_LAYOUT, AlertEngine, AlertRule
+
+SLOT = STATE_LAYOUT.index["cpu_temp"]
+
+
+def sample(value):
+    values = array("d", [NAN]) * len(STATE_LAYOUT)
+    values[SLOT] = value
+    return values
+
+
+def run(engine, readings):
+    """依次检查 (时间, 数值) 序列，返回每次产生的事件状态"""
+    return [[event["state"] for event in engine.evaluate(sample(value), now)] for now, value in readings]
+
+
+def test_rule_needs_exactly_one_limit():
+    with pytest.raises(ValueError):
+        AlertRule("none", "cpu_temp")
+    with pytest.raises(ValueError):
+        AlertRule("both", "cpu_temp", above=90, below=10)
+
+
+def test_hysteresis_prevents_flapping():
+    engine = AlertEngine([AlertRule("hot", "cpu_temp", above=90, hysteresis=5)], STATE_LAYOUT)
+    states = run(engine, [(0, 91), (1, 89), (2, 91), (3, 86), (4, 85), (5, 89)])
+    assert states == [["firing"], [], [], [], ["resolved"], []]
+    assert engine.active == []
+
+
+def test_event_fields():
+    engine = AlertEngine([AlertRule("hot", "cpu_temp", above=90, severity="critical")], STATE_LAYOUT)
+    event, = engine.evaluate(sample(95), 0)
+    assert event == {"rule": "hot", "field": "cpu_temp", "state": "firing",
+                     "severity": "critical", "value": 95, "threshold": 90}
+    assert engine.active == ["hot"]
+
+
+def test_below_rule():
+    engine = AlertEngine([AlertRule("cold", "cpu_temp", below=10, hysteresis=2)], STATE_LAYOUT)
+    states = run(engine, [(0, 11), (1, 9), (2, 11), (3, 12)])
+    assert states == [[], ["firing"], [], ["resolved"]]
+
+
+def test_duration_ignores_short_spikes():
+    engine = AlertEngine([AlertRule("hot", "cpu_temp", above=90, duration=10)], STATE_LAYOUT)
+    # 尖峰在10秒内回落，计时重新开始
+    states = run(engine, [(0, 95), (5, 95), (6, 80), (7, 95), (16, 95), (17, 95)])
+    assert states == [[], [], [], [], [], ["firing"]]
+
+
+def test_missing_value_restarts_duration():
+    engine = AlertEngine([AlertRule("hot", "cpu_temp", above=90, duration=10)], STATE_LAYOUT)
+    states = run(engine, [(0, 95), (5, NAN), (6, 95), (12, 95), (16, 95)])
+    assert states == [[], [], [], [], ["firing"]]
+
+
+def test_missing_value_does_not_resolve():
+    engine = AlertEngine([AlertRule("hot", "cpu_temp", above=90)], STATE_LAYOUT)
+    assert run(engine, [(0, 95), (1, NAN), (2, NAN)]) == [["firing"], [], []]
+    assert engine.active == ["hot"]
+
+
+def test_rate_rule():
+    engine = AlertEngine([AlertRule("jump", "cpu_temp", rate=5)], STATE_LAYOUT)
+    # 变化率：(60-40)/2 = 10/秒 触发，之后 2/秒 恢复
+    states = run(engine, [(0, 40), (2, 60), (4, 64)])
+    assert states == [[], ["firing"], ["resolved"]]
+
+
+def test_state_carried_over_on_rebuild():
+    rule = AlertRule("hot", "cpu_temp", above=90, hysteresis=5)
+    engine = AlertEngine([rule], STATE_LAYOUT)
+    engine.evaluate(sample(95), 0)
+    rebuilt = AlertEngine([rule], STATE_LAYOUT, previous=engine)
+    assert rebuilt.active == ["hot"]
+    assert rebuilt.evaluate(sample(95), 1) == []
+
+    # 规则内容变化后状态重新开始
+    changed = AlertEngine([AlertRule("hot", "cpu_temp", above=80)], STATE_LAYOUT, previous=rebuilt)
+    assert changed.active == []
+    assert [event["state"] for event in changed.evaluate(sample(95), 2)] == ["firing"]
+
+
+def test_unknown_field_is_skipped():
+    engine = AlertEngine([AlertRule("x", "no_such_field", above=1)], STATE_LAYOUT)
+    assert engine.evaluate(sample(100), 0) == []
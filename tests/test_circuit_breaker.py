@@ -0,0 +1,95 @@
+import pytest
+
+import main
+from main import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    # 去掉随机抖动，等待时间固定为上限
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: b)
+    return clock
+
+
+def test_stays_closed_below_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=5)
+    assert not breaker.record_failure()
+    assert not breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opens == 1
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    assert not breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_blocks_until_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    assert breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.retry_in() == pytest.approx(5)
+    clock.now += 4.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.retry_in() == 0.0
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    clock.now += 5
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    # 恢复后再次失败，等待时间回到初始值
+    breaker.record_failure()
+    assert breaker.retry_in() == pytest.approx(5)
+
+
+def test_half_open_probe_failure_doubles_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, max_reset_timeout=15)
+    breaker.record_failure()
+    expected = [10, 15, 15]
+    for timeout in expected:
+        clock.now += breaker.retry_in()
+        assert breaker.allow()
+        # 探测失败不是从CLOSED进入OPEN，不应再次报告
+        assert not breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.retry_in() == pytest.approx(timeout)
+    assert breaker.opens == 1 + len(expected)
+
+
+def test_failures_while_open_do_not_extend_wait(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    clock.now += 2
+    assert not breaker.record_failure()
+    assert breaker.retry_in() == pytest.approx(3)
+
+
+def test_jitter_shortens_wait(clock, monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: a)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=8)
+    breaker.record_failure()
+    assert breaker.retry_in() == pytest.approx(4)
@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+from main import DEFAULT_DEADBANDS, Deadband, load_config
+
+
+def write(tmp_path, data):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def test_valid_config(tmp_path):
+    config = load_config(write(tmp_path, {"hosts": {"desk": "http://10.0.0.2:8085/data.json"},
+                                          "mqtt": {"qos": 0, "compact": "short", "protocol": 5}}))
+    assert config.hosts == {"desk": "http://10.0.0.2:8085/data.json"}
+    assert config.mqtt["compact"] == "short"
+
+
+@pytest.mark.parametrize("name", ["a+b", "a#", "a/b", "a\0b"])
+def test_rejects_host_names_unusable_in_topics(tmp_path, name):
+    with pytest.raises(ValueError):
+        load_config(write(tmp_path, {"hosts": {name: "http://10.0.0.2:8085/data.json"}}))
+
+
+@pytest.mark.parametrize("settings", [
+    {"qos": 3},
+    {"compact_qos": -1},
+    {"protocol": 6},
+    {"compact": "tiny"},
+    {"compact_encoding": "protobuf"},
+    {"compact_topic": "c/#"},
+    {"qos": "1"},
+])
+def test_rejects_invalid_mqtt_values(tmp_path, settings):
+    with pytest.raises(ValueError):
+        load_config(write(tmp_path, {"url": "http://10.0.0.2:8085/data.json", "mqtt": settings}))
+
+
+def test_monitor_options(tmp_path):
+    config = load_config(write(tmp_path, {"url": "http://10.0.0.2:8085/data.json", "adaptive": True,
+                                          "max_interval": 20, "auto_discover": True, "include": ["/nvme/**"]}))
+    assert config.options == {"adaptive": True, "max_interval": 20, "auto_discover": True, "include": ("/nvme/**",)}
+
+
+@pytest.mark.parametrize("options", [
+    {"streaming": "yes"},
+    {"min_interval": 0},
+    {"min_interval": 10, "max_interval": 5},
+    {"include": "/nvme/*"},
+    {"exclude": [1]},
+])
+def test_rejects_invalid_monitor_options(tmp_path, options):
+    with pytest.raises(ValueError):
+        load_config(write(tmp_path, {"url": "http://10.0.0.2:8085/data.json", **options}))
+
+
+def test_example_config_loads():
+    config = load_config(os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.example.toml"))
+    assert config.interval == 2
+
+
+def test_deadbands(tmp_path):
+    url = "http://10.0.0.2:8085/data.json"
+    assert load_config(write(tmp_path, {"url": url, "deadbands": True})).options["deadbands"] == DEFAULT_DEADBANDS
+    assert "deadbands" not in load_config(write(tmp_path, {"url": url, "deadbands": False})).options
+    config = load_config(write(tmp_path, {"url": url, "refresh_interval": 30,
+                                          "deadbands": {"cpu_temp": {"absolute": 1, "relative": 0.1}}}))
+    assert config.options == {"deadbands": {"cpu_temp": Deadband(1, 0.1)}, "refresh_interval": 30}
+
+
+@pytest.mark.parametrize("deadbands", ["yes", {"cpu_temp": 1}, {"cpu_temp": {"absolute": -1}},
+                                       {"cpu_temp": {"step": 1}}])
+def test_rejects_invalid_deadbands(tmp_path, deadbands):
+    with pytest.raises(ValueError):
+        load_config(write(tmp_path, {"url": "http://10.0.0.2:8085/data.json", "deadbands": deadbands}))
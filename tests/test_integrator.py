@@ -0,0 +1,39 @@
+from array import array
+
+import pytest
+
+from main import NAN, STATE_LAYOUT, Integral, Integrator
+
+SOURCE = STATE_LAYOUT.index["cpu_power"]
+TARGET = STATE_LAYOUT.index["cpu_energy"]
+# 功率（W）积分为 W·s，便于核对
+INTEGRALS = [Integral("cpu_energy", "cpu_power", 1)]
+
+
+def feed(integrator, samples):
+    values = array("d", [NAN]) * len(STATE_LAYOUT)
+    for now, power in samples:
+        values[SOURCE] = power
+        integrator.update(values, now)
+    return values[TARGET]
+
+
+def test_trapezoidal_sum():
+    integrator = Integrator(INTEGRALS, STATE_LAYOUT)
+    assert feed(integrator, [(0, 100), (2, 200), (4, 200)]) == pytest.approx(300 + 400)
+
+
+def test_gap_longer_than_max_gap_is_skipped():
+    integrator = Integrator(INTEGRALS, STATE_LAYOUT, max_gap=60)
+    assert feed(integrator, [(0, 100), (90, 100), (92, 100)]) == pytest.approx(200)
+
+
+def test_samples_spaced_beyond_60s_integrate_with_wider_gap():
+    # 轮询间隔较长（或自适应放宽）时，max_gap 随之放宽，累计量不能停止增长
+    integrator = Integrator(INTEGRALS, STATE_LAYOUT, max_gap=300)
+    assert feed(integrator, [(0, 100), (100, 100), (200, 300)]) == pytest.approx(10000 + 20000)
+
+
+def test_missing_value_breaks_the_series():
+    integrator = Integrator(INTEGRALS, STATE_LAYOUT)
+    assert feed(integrator, [(0, 100), (2, NAN), (4, 100), (6, 100)]) == pytest.approx(200)
@@ -0,0 +1,70 @@
+import math
+
+from main import RollingStats
+
+WINDOWS = {"1m": 60, "5m": 300}
+
+
+def test_summary_covers_each_window():
+    stats = RollingStats(WINDOWS, capacity=1000)
+    for t in range(0, 300, 10):
+        stats.push(t, float(t))
+    summary = stats.summary("x")
+    # 1分钟窗口只包含最近60秒内的样本（230 < t <= 290）
+    assert summary["x_min_1m"] == 240.0
+    assert summary["x_max_1m"] == 290.0
+    assert summary["x_avg_1m"] == 265.0
+    assert summary["x_min_5m"] == 0.0
+    assert summary["x_max_5m"] == 290.0
+
+
+def test_old_extremes_expire():
+    stats = RollingStats(WINDOWS, capacity=1000)
+    stats.push(0, 100.0)
+    stats.push(1, -100.0)
+    for t in range(2, 120):
+        stats.push(t, 1.0)
+    summary = stats.summary("x")
+    assert summary["x_max_1m"] == 1.0
+    assert summary["x_min_1m"] == 1.0
+    assert summary["x_max_5m"] == 100.0
+    assert summary["x_min_5m"] == -100.0
+
+
+def test_window_expires_by_time_not_count():
+    stats = RollingStats(WINDOWS, capacity=1000)
+    stats.push(0, 5.0)
+    stats.push(100, 7.0)  # 相隔超过1分钟，第一条已经不在1分钟窗口内
+    summary = stats.summary("x")
+    assert summary["x_min_1m"] == 7.0
+    assert summary["x_avg_5m"] == 6.0
+
+
+def test_full_buffer_evicts_oldest_samples():
+    stats = RollingStats({"1h": 3600}, capacity=10)
+    stats.push(0, 50.0)
+    for t in range(1, 20):
+        stats.push(t, 1.0)
+    summary = stats.summary("x")
+    # 缓冲区只能保存10个样本，被覆盖的最大值不能残留在窗口中
+    assert summary["x_max_1h"] == 1.0
+    assert summary["x_avg_1h"] == 1.0
+
+
+def test_empty_window_is_omitted():
+    stats = RollingStats(WINDOWS, capacity=10)
+    assert stats.summary("x") == {}
+
+
+def test_resized_keeps_samples_in_order():
+    stats = RollingStats(WINDOWS, capacity=5)
+    for t, value in enumerate([3.0, 9.0, 1.0, 4.0]):
+        stats.push(t, value)
+    bigger = stats.resized(50)
+    assert bigger.capacity == 50
+    assert bigger.summary("x") == stats.summary("x")
+    for t in range(4, 40):
+        bigger.push(t, 2.0)
+    # 扩容后可以保存更多样本，早期的最大值仍在窗口内
+    assert bigger.summary("x")["x_max_1m"] == 9.0
+    assert math.isclose(bigger.summary("x")["x_avg_1m"], round((3 + 9 + 1 + 4 + 2 * 36) / 40, 2))
@@ -0,0 +1,76 @@
+from main import SpoolLog
+
+
+def drain(spool):
+    """按补发顺序读出并删除所有分段"""
+    messages = []
+    while spool.has_backlog:
+        path = spool.oldest()
+        for _, topic, payload, qos, retain in spool.read(path):
+            messages.append((topic, payload, qos, retain))
+        spool.remove(path)
+    return messages
+
+
+def test_replay_order_across_rotation(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=256, max_bytes=1024 * 1024)
+    sent = [(f"t/{i}", f"payload-{i}", i % 2, i % 3 == 0) for i in range(50)]
+    for message in sent:
+        spool.append(*message)
+    assert len(list(tmp_path.glob("*.seg"))) > 1
+    assert drain(spool) == sent
+    assert not spool.has_backlog
+    assert list(tmp_path.glob("*.seg")) == []
+
+
+def test_replay_order_after_restart(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=256, max_bytes=1024 * 1024)
+    before = [(f"a/{i}", str(i), 1, False) for i in range(20)]
+    for message in before:
+        spool.append(*message)
+    # 模拟进程直接退出：当前分段没有封存
+    del spool
+
+    restarted = SpoolLog(str(tmp_path), segment_size=256, max_bytes=1024 * 1024)
+    assert restarted.has_backlog
+    after = [(f"b/{i}", str(i), 0, True) for i in range(20)]
+    for message in after:
+        restarted.append(*message)
+    assert drain(restarted) == before + after
+
+
+def test_resume_from_offset(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=4096, max_bytes=1024 * 1024)
+    for i in range(5):
+        spool.append(f"t/{i}", str(i), 1, False)
+    path = spool.oldest()
+    offsets = [record[0] for record in spool.read(path)]
+    resumed = [record[1] for record in spool.read(path, offsets[1])]
+    assert resumed == ["t/2", "t/3", "t/4"]
+
+
+def test_binary_payload_round_trip(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=4096, max_bytes=1024 * 1024)
+    spool.append("bin", b"\x00\x01\xff", 0, False)
+    spool.append("text", "温度", 1, True)
+    assert drain(spool) == [("bin", b"\x00\x01\xff", 0, False), ("text", "温度", 1, True)]
+
+
+def test_oldest_segments_evicted_when_full(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=128, max_bytes=256)
+    assert spool.max_segments == 2
+    for i in range(40):
+        spool.append(f"t/{i}", "x" * 20, 0, False)
+    assert spool.evicted > 0
+    assert len(list(tmp_path.glob("*.seg"))) == 2
+    topics = [int(topic[2:]) for topic, *_ in drain(spool)]
+    # 只保留最新的消息，且顺序不变
+    assert topics == sorted(topics)
+    assert topics[-1] == 39
+    assert topics[0] > 0
+
+
+def test_oversized_message_is_dropped(tmp_path):
+    spool = SpoolLog(str(tmp_path), segment_size=64, max_bytes=1024)
+    spool.append("big", "x" * 100, 0, False)
+    assert not spool.has_backlog